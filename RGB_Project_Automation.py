@@ -1,13 +1,11 @@
 from pump import *
 import time
+import datetime
 import math
 import numpy as np
 from threading import Timer
-import seabreeze
-from seabreeze.spectrometers import Spectrometer
-from colormath.color_objects import SpectralColor, CMYColor, sRGBColor
-from colormath.color_conversions import convert_color
-from scipy import interpolate
+# seabreeze, colormath and scipy are imported where they are used, so the
+# tools importing this module (simulator, optimizers, batch scripts) start fast
 
 def set_pump_rates(pumps, flowrates):
     ''' Set pump rates '''
@@ -42,6 +40,29 @@ def calc_time_to_travel(flowrates, tube_dist, tube_dia, extra=15):
     print("Time to travel (sec): "+str(time_to_travel))
     return time_to_travel
 
+def to_transmittance(intensities, ref_intensities, bg_intensities):
+    ''' Calculate transmittance within the range 0-1'''
+    transmittance = (intensities-bg_intensities)/(ref_intensities-bg_intensities)
+    # ignore transmittance out of range [0,1], which is due to noise
+    transmittance[transmittance>1]=1
+    transmittance[transmittance<0]=0
+    return transmittance
+
+def transm_to_rgb(wavelengths, transmittance):
+    ''' Convert transmittance to rgb 0-255 '''
+    from scipy import interpolate
+    from colormath.color_objects import SpectralColor, sRGBColor
+    from colormath.color_conversions import convert_color
+    f = interpolate.interp1d(wavelengths,transmittance)
+    # colormath only accepts wavelength in the following format (some info is lost in this step)
+    wavelengths_new = np.arange(340, 840, 10) 
+    transmittance_new = f(wavelengths_new)
+    spectral = SpectralColor(*transmittance_new,observer='10')
+    rgb = convert_color(spectral, sRGBColor).get_upscaled_value_tuple()
+    rgb = np.asarray(rgb)
+    rgb[rgb>255]=255
+    return rgb
+
 def small_step_Q(flowrates, step_size):
     ''' generate flowrates matrix with a fixed scout step size '''
     small_steps= np.empty(shape=(4,4),dtype='object')
@@ -62,7 +83,7 @@ class AcquireData():
     ''' functions to acquire one data point '''
 
     def __init__(self, pumps, rates, tube_dist, tube_dia, spec, ref_intensities, bg_intensities, wavelengths,\
-    no_of_avg, logger, diffuse_time=60):
+    no_of_avg, logger, diffuse_time=60, processing=None):
         self.pumps = pumps
         self.rates = rates
         self.tube_dist = tube_dist
@@ -74,30 +95,20 @@ class AcquireData():
         self.no_of_avg = no_of_avg
         self.logger = logger
         self.diffuse_time = diffuse_time
+        self.processing = processing # scans to average and boxcar of a spectrometer read without acquisition.py
         self.rgb_avg = []
+        self.rgb_scans = [] # rgb of each scan of the average, to estimate the measurement noise
         self.wait_sec = 0 # wait for running condition flow rates
 
     
 
     def to_transmittance(self, intensities, ref_intensities, bg_intensities):
         ''' Calculate transmittance within the range 0-1'''
-        transmittance = (intensities-bg_intensities)/(ref_intensities-bg_intensities)
-        # ignore transmittance out of range [0,1], which is due to noise
-        transmittance[transmittance>1]=1
-        transmittance[transmittance<0]=0
-        return transmittance
+        return to_transmittance(intensities, ref_intensities, bg_intensities)
 
     def transm_to_rgb(self, wavelengths,transmittance):
         ''' Convert transmittance to rgb 0-255 '''
-        f = interpolate.interp1d(wavelengths,transmittance)
-        # colormath only accepts wavelength in the following format (some info is lost in this step)
-        wavelengths_new = np.arange(340, 840, 10) 
-        transmittance_new = f(wavelengths_new)
-        spectral = SpectralColor(*transmittance_new,observer='10')
-        rgb = convert_color(spectral, sRGBColor).get_upscaled_value_tuple()
-        rgb = np.asarray(rgb)
-        rgb[rgb>255]=255
-        return rgb
+        return transm_to_rgb(wavelengths, transmittance)
 
     def run_one_cond(self):
         # Run pumps at the condition rates until the zcell for uv-vis is filled
@@ -135,12 +146,12 @@ class AcquireData():
         # take spectra, average and convert to RGB
         
         intens_sum = np.zeros(len(self.ref_intensities))
+        rgb_scans = []
         
-        for i in range(self.no_of_avg):
-            intensities = self.spec.spectrum()[1]
+        for intensities, timestamp in self.scans():
             
             # save spectrum
-            self.logger.save_data('spec',intensities) # save to local
+            self.logger.save_data('spec',intensities,timestamp) # save to local
             self.logger.log('log','Capcutred and saved spectrum')
 
 
@@ -151,6 +162,7 @@ class AcquireData():
             rgb = self.transm_to_rgb(self.wavelengths, transmittance)
             print("RGB: "+str(rgb))
             self.logger.log('log','Converted to RGB: '+str(rgb))
+            rgb_scans.append(rgb)
 
             # sum intensities array
             intens_sum += intensities
@@ -164,6 +176,7 @@ class AcquireData():
         transmittance = self.to_transmittance(intens_avg, self.ref_intensities, self.bg_intensities)
         # save averaged transmittance
         self.logger.save_data('avgtrans',transmittance) # save to local
+        self.rgb_scans = rgb_scans
         self.rgb_avg = self.transm_to_rgb(self.wavelengths, transmittance)
         print('RGB of average intensities spectra is '+str(self.rgb_avg))
         self.logger.log('log','Averaged Intensities Spectra RGB: '+str(self.rgb_avg))
@@ -171,6 +184,24 @@ class AcquireData():
 
 
 
+    def scans(self):
+        ''' (intensities, time of the scan) of the no_of_avg scans of the condition '''
+        if hasattr(self.spec, 'iter_after'):
+            # continuous acquisition (acquisition.py): the scans integrated after the liquid reached the cell,
+            # each one processed while the next one integrates
+            for scan in self.spec.iter_after(time.time(), self.no_of_avg):
+                # scans to average and boxcar recorded with the spectrum
+                self.logger.set_context(processing=scan.processing)
+                yield scan.intensities, datetime.datetime.fromtimestamp(scan.ended)
+        elif self.processing is not None:
+            import acquisition as acq
+            self.logger.set_context(processing=self.processing)
+            for i in range(self.no_of_avg):
+                yield acq.read_processed(self.spec, self.processing), None
+        else:
+            for i in range(self.no_of_avg):
+                yield self.spec.spectrum()[1], None
+
     def stop_timer(self):
         ''' Stop any currently running timer if user click stop from the UI '''
         try:
@@ -38,6 +38,46 @@ def scale_rates(old_rates, delta_rates):
     return new_rates_final
 
 
+def scale_rates_batch(old_rates, delta_rates, sum_rates=600):
+    ''' scale_rates for T trajectories of N pumps in one call
+        old_rates: (T, N) or (N,)
+        delta_rates: same shape as old_rates
+        return: new rates of the same shape, each row scaled to sum(rates)=sum_rates
+    '''
+    old_rates = np.asarray(old_rates, dtype=float)
+    delta_rates = np.array(delta_rates, dtype=float)
+    single = old_rates.ndim == 1
+    old_rates = np.atleast_2d(old_rates)
+    delta_rates = np.atleast_2d(delta_rates)
+
+    # if old rates is already non-positive, and the delta is non-positive
+    # ignore the delta, cause the new rates cannot go outside the range <0
+    delta_rates[(old_rates <= 0) & (delta_rates <= 0)] = 0
+
+    # rates plus delta with zeroing if out of range
+    new_rates_before_scale = old_rates + delta_rates
+
+    # find the index of the minimum new rates before scale
+    rows = np.arange(len(old_rates))
+    idx_min = np.argmin(new_rates_before_scale, axis=1)
+    min_rate = new_rates_before_scale[rows, idx_min]
+
+    # if the minimum new rates before scale is negative, then scale down delta
+    # such that the minimum new rates before scale does not go below limit, 0
+    negative = min_rate < 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate_scale = delta_rates[rows, idx_min]/old_rates[rows, idx_min]
+        delta_rates[negative] /= np.abs(rate_scale[negative])[:, None]
+
+    # rates plut scaled delta
+    new_rates_after_scale = old_rates + delta_rates
+
+    # normalize the final rates then scale to sum rates = sum_rates
+    new_rates_final = sum_rates/new_rates_after_scale.sum(axis=1, keepdims=True)*new_rates_after_scale
+
+    return new_rates_final[0] if single else new_rates_final
+
+
 
 
 
@@ -91,4 +131,11 @@ if __name__ == "__main__":
 
 
 
-    print("function return: " + str(scale_rates(rates, delta_rates)))
\ No newline at end of file
+    print("function return: " + str(scale_rates(rates, delta_rates)))
+
+    # batched version gives identical results
+    old = np.random.uniform(0, 300, (1000, 4))
+    old[::3, 0] = 0
+    delta = np.random.uniform(-500, 500, (1000, 4))
+    single = np.array([scale_rates(o, d) for o, d in zip(old, delta)])
+    print("batch == single: " + str(np.array_equal(scale_rates_batch(old, delta), single)))
@@ -23,6 +23,7 @@ from matplotlib.lines import Line2D
 import tkinter as tk
 from tkinter import ttk
 import tkinter.colorchooser
+import tkinter.filedialog
 from serial.tools.list_ports import comports
 import os
 import time
@@ -33,16 +34,15 @@ import logging
 import threading
 from threading import Timer
 import queue
-from bayes_opt import BayesianOptimization, UtilityFunction
-from scipy.optimize import NonlinearConstraint
 
-from seabreeze.spectrometers import Spectrometer
-from colormath.color_objects import SpectralColor, CMYColor, sRGBColor
-from colormath.color_conversions import convert_color
 from pump import *
 import RGB_Project_Automation as auto
-import optimization_4steps as opt
 import RGB_Project_ScaleNewRates as scale
+import campaign as camp
+import live_plot as lpl
+import engine as eng
+import spectrometers as spm
+from prgm_logger import PrgmLogger
 
             
 
@@ -56,139 +56,6 @@ def serial_ports():
     ''' get available com ports '''
     return comports()
 
-class PrgmLogger():
-    ''' log experiment informationm and save data to local
-
-    Directory content:
-    - RGB_Optimization_(datetime):
-        - Ref_(datetime).npy
-        - BG_(datetime).npy
-        - Experiment_(datetime):
-            - Log.log
-            - rgb_tracking.log
-            - plot.png
-            - Data:
-                - Spec_(itr#)_(datetime).npy
-                    :
-                    :
-    '''
-
-    def __init__(self):
-        self.path = os.getcwd()
-        self.run_path = ''
-        self.exp_path = ''
-        self.data_path = ''
-        self.info_log_file = ''
-        self.rgb_log_file = ''
-        self.ref_file = ''
-        self.bg_file = ''
-        self.spec_file = ''
-
-    def setup_logger(self, name, log_file, level=logging.INFO):
-
-        handler = logging.FileHandler(log_file)        
-        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
-
-        logger = logging.getLogger(name)
-        logger.setLevel(level)
-        logger.addHandler(handler)
-
-        return logger
-    
-    def create(self,type=''):
-        # create folder or file path
-        cur_time = datetime.datetime.now()
-        if type == 'RGB':
-            self.run_path = self.path+cur_time.strftime('\Data\RGB_Optimization_%Y-%m-%d_%H-%M-%S')
-            os.makedirs(self.run_path, exist_ok=True)
-        if type == 'Experiment':
-            if self.run_path == '':
-                print('run path does not exist')
-            else:
-                self.exp_path = self.run_path+cur_time.strftime('\Experiment_%Y-%m-%d_%H-%M-%S')
-                os.makedirs(self.exp_path, exist_ok=True)
-
-        if type == 'Data':
-            if self.exp_path == '':
-                print('exp path does not exist')
-            else:
-                self.data_path = self.exp_path + '\Data'
-                os.makedirs(self.data_path, exist_ok=True)
-
-        if type == 'Log':
-            if self.exp_path == '':
-                print('exp path does not exist')
-            else:
-                self.info_log_file = cur_time.strftime(self.exp_path+'\Log.log')
-                self.rgb_log_file = cur_time.strftime(self.exp_path+'\RGB_history.log')
-                self.info_logger = self.setup_logger('info_logger', self.info_log_file)
-                self.rgb_logger = self.setup_logger('rgb_logger', self.rgb_log_file)
-                self.info_logger.info('Color Optimization in RGB Program -- RUN')
-                self.rgb_logger.info('R, G, B')
-                
-    def log(self,type='', input=''):
-        # write to log files
-        if type == 'log':
-            try:
-                self.info_logger.info(str(input))
-            except AttributeError:
-                print('logger not created')
-        if type == 'rgb':
-            try:
-                self.rgb_logger.info(str(input))
-            except AttributeError:
-                print('logger not created')
-
-    def save_data(self,type='',input=None):
-        # save data to local
-        cur_time = datetime.datetime.now()
-        if type == 'ref':
-            if self.run_path == '':
-                print('run path does not exist')
-            else:
-                self.ref_file = cur_time.strftime(self.run_path+'\Reference_%Y-%m-%d_%H-%M-%S')
-                np.save(self.ref_file, input)
-        if type == 'bg':
-            if self.run_path == '':
-                print('run path does not exist')
-            else:
-                self.bg_file = cur_time.strftime(self.run_path+'\Background_%Y-%m-%d_%H-%M-%S')
-                np.save(self.bg_file, input)
-        if type == 'spec':
-            if self.data_path == '':
-                print('data path does not exist')
-            else:
-                self.spec_file = cur_time.strftime(self.data_path+'\Spect_%Y-%m-%d_%H-%M-%S')
-                np.save(self.spec_file, input)
-        if type == 'avgspec':
-            if self.data_path == '':
-                print('data path does not exist')
-            else:
-                self.avg_spec_file = cur_time.strftime(self.data_path+'\AverageSpect_%Y-%m-%d_%H-%M-%S')
-                np.save(self.avg_spec_file, input)
-        if type == 'trans':
-            if self.data_path == '':
-                print('data path does not exist')
-            else:
-                self.trans_file = cur_time.strftime(self.data_path+'\Spect_%Y-%m-%d_%H-%M-%S')
-                np.save(self.trans_file, input)
-        if type == 'avgtrans':
-            if self.data_path == '':
-                print('data path does not exist')
-            else:
-                self.avg_trans_file = cur_time.strftime(self.data_path+'\AverageTrans_%Y-%m-%d_%H-%M-%S')
-                np.save(self.avg_trans_file, input)
-
-    def save_img(self,input=None):
-        ''' save mse and rgb images to local '''
-        plot_fig = input
-        if self.exp_path != '':
-            plot_file = self.exp_path + '\plot.png'
-            try:
-                plot_fig.savefig(plot_file)
-            except:
-                pass
-
 
 
 
@@ -219,10 +86,18 @@ class App(tk.Tk):
         self.no_iter = 21 # max number of iterations
         self.optimal_rates_gd=[0.0, 0.0, 0.0, 0.0] # initial optimial rates by gradient descent
         self.optimal_rates_bo=[0.0, 0.0, 0.0, 0.0] # initial optimial rates by bayesian optimization
+        self.palette = [] # target colors of a campaign, loaded from file
+        self.no_iter_campaign = 150 # max number of measurements of a campaign
+        self.gp_engine = 'sklearn' # BO model: 'sklearn' refits every iteration, 'incremental' for large histories
+        self.sparse_threshold = None # incremental BO model: inducing points past this many observations, None: exact
+        self.bo_history = False # preload the BO model with the colors of the color index
+        self.acquisition = 'ucb' # BO acquisition: 'ucb', or 'cost_ei' to weigh rig time and dye used
+        self.color_index_file = 'color_index.npz' # measured gamut, start next to the closest known color if it exists
+        self.random_seed = None # seed of the scout steps and BO, None: a new seed each run (logged for replay.py)
 
         # create queues to pass values between the main thread (UI) and run experiment thread
-        self.qplot = queue.Queue() # plot queue
-        self.qmsg = queue.Queue()  # message queue
+        self.qevent = queue.Queue() # engine events [event, args], see engine.py
+        self.engine = None # engine of the current run
 
 
         # window setup
@@ -241,13 +116,19 @@ class App(tk.Tk):
                                 width = 18,
                                 command=self.target_RGB)
 
+        # create a button to load a palette of target colors for a campaign
+        self.palette_btn=tk.Button(self,
+                                text='Load Palette',
+                                width = 18,
+                                command=self.load_palette)
+
         # create an option menu to select the algorithm
         self.algo = tk.StringVar(self,'Pick Algorithm')
-        self.algo_menu = tk.OptionMenu(self, self.algo, *['Gradient Descent', 'Bayesian Optim', 'Both'])
+        self.algo_menu = tk.OptionMenu(self, self.algo, *['Gradient Descent', 'Bayesian Optim', 'Both', 'Campaign'])
         self.algo_menu.config(width=16)
 
         # create an option menu to select com port of syringe pumps
-        ports = [str(port).split(' ')[0] for port in serial_ports()]
+        ports = [str(port).split(' ')[0] for port in serial_ports()] + [spm.SIMULATED_PORT]
         self.com_port = tk.StringVar(self, 'Select Port')
         self.com_menu=tk.OptionMenu(self,self.com_port,*ports if ports else [None])
         self.com_menu.config(width=16)
@@ -359,6 +240,8 @@ class App(tk.Tk):
         self.legend_elements = [Line2D([0], [0], marker='o', color='k', label='gd',
                           markerfacecolor='w'),
                           Line2D([0], [0], marker='^', color='k', label='bo',
+                          markerfacecolor='w'),
+                          Line2D([0], [0], marker='s', color='k', label='campaign',
                           markerfacecolor='w')]
         self.mse_fig.legend(handles=self.legend_elements, bbox_to_anchor=(1, 1.02),loc="lower right")
         self.rgb_fig = self.fig.add_subplot(3,1,(2,3),projection='3d')
@@ -372,6 +255,8 @@ class App(tk.Tk):
         #toolbar = NavigationToolbar2Tk(canvas, self)
         #toolbar.update()
         self.fig.subplots_adjust(top=0.88,bottom=0.05,hspace=0.15)
+        # persistent artists per algorithm, redrawn at most 4 times per second
+        self.live_plot = lpl.LivePlot(self.mse_fig, self.rgb_fig, self.canvas.draw_idle, min_interval=0.25)
 
 
         # UI layout
@@ -381,6 +266,7 @@ class App(tk.Tk):
         self.title_label.grid(columnspan=2,pady=5)
         self.status_label.grid(columnspan=2,pady=5)
         self.pick_btn.grid(pady=5)
+        self.palette_btn.grid()
         self.algo_menu.grid()
         self.rdm_size_check.grid()
         self.com_menu.grid()
@@ -403,6 +289,7 @@ class App(tk.Tk):
         self.ref_spec_bool.trace('w',self.enable_start) # condition1/3 to enable start button
         self.bg_spec_bool.trace('w',self.enable_start) # condition2/3 to enable start button
         self.target_color_UI.trace('w',self.enable_start) #condition3/3 to enable start button
+        self.algo.trace('w',self.enable_start)
 
         # Create logger
         self.logger = PrgmLogger()
@@ -412,6 +299,8 @@ class App(tk.Tk):
     def on_closing(self): 
         ''' close application '''
         if tk.messagebox.askokcancel("Quit", "Do you want to quit?"):
+            # write what is still queued before quitting
+            self.logger.writer.close()
             self.destroy()
 
     def port_select(self):
@@ -430,22 +319,12 @@ class App(tk.Tk):
     def connect_pump(self):
         ''' connect to pumps chain '''
         pump_port = self.com_port.get()
-        #no_of_pumps = int(self.no_of_pumps.get())
-        no_of_pumps = 4 # fixed number of pumps
         pumps = self.pumps
 
         if len(pumps)==0:
             try:
-                chain = Chain(port=pump_port)
-                for i in range(no_of_pumps):
-                    pumps.append(Pump(chain, address=i))
-                # stop all pumps
-                for pump in pumps:
-                    pump.stop()
-                    time.sleep(0.1)
-
-                # return pumps chain
-                self.pumps = pumps
+                # stopped pumps with the syringe diameters set (since JUL2023 demo)
+                self.pumps = eng.connect_pumps(pump_port)
 
                 # enable buttons
                 #self.syringe_diam['state']='normal'
@@ -456,20 +335,12 @@ class App(tk.Tk):
                 self.optimal_gd_btn['state']='normal'
 
                 self.pump_conn_bool.set(1)
-                 
+                self.status_string.set('CMY Syringes diameter is set')
+
             except serial.serialutil.SerialException as msg:
                 tk.messagebox.showerror(title='Pump Connection Error', message=msg)
-
-
-            # set diameter (since JUL2023 demo)
-            diameter = [14.57, 14.57, 23.0, 14.57]
-            for i in range(4):
-                try:
-                    pumps[i].set_diameter(diameter[i])
-                    print(pumps[i].read_cur_dia())
-                    self.status_string.set('CMY Syringes diameter is set')
-                except Exception as msg:
-                    tk.messagebox.showerror(title='Pump Error', message=msg)
+            except Exception as msg:
+                tk.messagebox.showerror(title='Pump Error', message=msg)
 
 
 
@@ -478,13 +349,15 @@ class App(tk.Tk):
         
         if self.spec == None:
             try:
-                self.spec = Spectrometer.from_first_available()
+                # the simulated spectrometer goes with the simulated pumps,
+                # seabreeze is only imported to connect a real one (spectrometers.open_spectrometer)
+                self.spec = eng.connect_spectrometer(spm.backend_for_port(self.com_port.get()))
                 # enable buttons
                 for button in [self.take_bg,self.take_ref,self.integ_time_btn]:
                     button['state']='normal'
 
                 self.spec_conn_bool.set(1)
-            except Spectrometer._backend.SeaBreezeError as msg:
+            except Exception as msg: # SeaBreezeError, seabreeze missing, ...
                 tk.messagebox.showerror(title='Spectrometer Connection Error', message=msg)
 
     def set_diam(self,event):
@@ -566,28 +439,9 @@ class App(tk.Tk):
 
     def find_integ_time(self):
         ''' auto set the uv-vis integration time '''
-        integr_time = self.init_integ_time
-
         try:
             self.status_string.set('Optimizing spectrometer integration time...')
-            self.spec.integration_time_micros(integr_time)
-            time.sleep(2)
-            intensities = self.spec.spectrum()[1]
-
-            while max(intensities) < 55000 and integr_time < 1000000:
-                # max integration time: 1sec
-                # target max intensity in range(55000, 60000)
-                integr_time += 10000
-                self.spec.integration_time_micros(integr_time)
-                time.sleep(2)
-                intensities = self.spec.spectrum()[1]
-                if max(intensities) > 60000:
-                    integr_time -= 10000
-                    self.spec.integration_time_micros(integr_time)
-                    time.sleep(2)
-                    self.spec.spectrum()
-                    break
-
+            integr_time = eng.find_integ_time(self.spec, self.init_integ_time)
             self.integ_time = integr_time
             self.status_string.set('Integration time is set to '+str(integr_time)+'microsecond')
         except Exception as msg:
@@ -596,7 +450,10 @@ class App(tk.Tk):
     def get_spectrum(self, button):
         ''' acquire one background/reference spectrum '''
         try:
-            self.wavelength, spectrum = self.spec.spectrum()
+            if button == 'bg':
+                self.wavelength, spectrum = spm.measure_background(self.spec)
+            else:
+                self.wavelength, spectrum = self.spec.spectrum()
             if button == 'bg':
                 self.bg_spec = spectrum
                 self.bg_spec_bool.set(1)
@@ -635,6 +492,30 @@ class App(tk.Tk):
         except: # pass if selection is canceled
             pass
 
+    def load_palette(self):
+        ''' load the target colors of a campaign from a csv file of R, G, B rows '''
+        path = tk.filedialog.askopenfilename(filetypes=[('Palette', '*.csv *.txt'), ('All files', '*.*')])
+        if not path:
+            return
+        try:
+            self.palette = camp.load_targets(path)
+        except (OSError, ValueError) as msg:
+            tk.messagebox.showerror(title='Palette Error', message=msg)
+            return
+        self.plot_palette()
+        self.canvas.draw()
+        self.status_string.set('Palette of '+str(len(self.palette))+' colors loaded. Pick algorithm "Campaign".')
+        self.enable_start()
+
+    def plot_palette(self):
+        ''' plot all campaign targets in the 3d plot '''
+        self.rgb_fig.cla()
+        self.rgb_fig.set_xlabel('R')
+        self.rgb_fig.set_ylabel('G')
+        self.rgb_fig.set_zlabel('B')
+        for target in self.palette:
+            self.rgb_fig.scatter(*target, color=target/255.0, marker='*')
+
     
     def run_optimal(self, widget):
         ''' run the pumps at the flowrates of optimal color'''
@@ -688,7 +569,10 @@ class App(tk.Tk):
         ''' check if the conditions are met to enable "start" button '''
         cond1 = self.ref_spec_bool.get()   # reference spectrum saved
         cond2 = self.bg_spec_bool.get()    # background spectrum saved
-        cond3 = len(self.target_color_UI.get())!=0 # target color selected
+        if self.algo.get() == 'Campaign':
+            cond3 = len(self.palette)!=0 # palette loaded
+        else:
+            cond3 = len(self.target_color_UI.get())!=0 # target color selected
         if cond1 and cond2 and cond3:
             self.start_btn.config(state="normal")
     
@@ -698,6 +582,7 @@ class App(tk.Tk):
 
         # disable all other buttons 
         self.pick_btn['state']='disabled'
+        self.palette_btn['state']='disabled'
         #self.syringe_diam['state']='disabled'
         #self.water_syringe_diam['state']='disabled'
         self.flush_all_btn['state']='disabled'
@@ -708,390 +593,51 @@ class App(tk.Tk):
         self.optimal_gd_btn['state']='disabled'
         self.optimal_bo_btn['state']='disabled'
 
-        # create data folder
-        self.logger.create('Experiment')
-        self.logger.create('Data')
-        self.logger.create('Log')
-
-        # get user selected target rgb
-        target = np.array([int(i) for i in eval(self.target_color_UI.get())])
-
-        # Initialize variables
-        self.prev_cost = 1 # cost of previous iteration
-        self.iteration = 0 # iteration index of while loop. itr=0 : run initial condition
-        self.min_gd_cost = 100000 # initial minimum gd cost, start from large value
-        self.min_bo_cost = 100000 # initial minimum bo cost, start from large value
-        self.optimal_rates_gd=[0.0, 0.0, 0.0, 0.0] # initial optimial rates by gradient descent
-        self.optimal_rates_bo=[0.0, 0.0, 0.0, 0.0] # initial optimial rates by bayesian optimization
-
-        # Set constants
-        small_step_size = 30.0 # first size of small steps for each pump before a real step
-        learning_rate = 0.6 # learning rate of the gradient descent optimization
-        #diffuse_time = 0.5*0.254**2/(5.75*10**-4) # estimated time to sufficiently diffuse
-        diffuse_time = 5
-        kappa = 10 # BO parameter to indicate how close the next parameters are sampled
-
-
-        self.logger.log('log','Experiment START!')
-        self.logger.log('log', 'Spectra Integration Time: '+str(self.integ_time))
-        self.logger.log('log','Number of Spectra to Average RGB: '+str(self.no_of_avg))
-        self.logger.log('log','Diffusion Time: '+str(diffuse_time)+' sec')
-        self.logger.log('log','Initial Scout Step Size: '+str(small_step_size))
-        self.logger.log('log','Target RGB: '+str(target))
-        # Get run experiment thread
-        self.run_thread = threading.currentThread()
-
-
-        def get_one_data(crate, mrate, wrate, yrate, prev_cost = self.prev_cost, iteration = self.iteration, algo="gd"):
-            ''' Acquire one real data for GD
-                Target function for BO '''
-            
-            rgb = []
-
-            rates = [crate, mrate, wrate, yrate]
-            #rates = [wrate, mrate, yrate, crate]
-            
-            # create an automation  object
-            run_cond = auto.AcquireData(self.pumps,rates,self.tube_dist,self.tube_dia,self.spec,self.ref_spec,
-                                                self.bg_spec,self.wavelength,self.no_of_avg,self.logger,diffuse_time)
-
-            # run one step
-            run_cond.run_one_cond()
-            self.status_string.set("Running at flow rates: "+str([int(i) for i in run_cond.rates])+' for '
-                        +str(int(run_cond.wait_sec))+' sec...'
-                        #+'\n and diffuse for '
-                        #+str(int(diffuse_time))+' sec...'
-                        )
-            
-            # wait to complete one step and get the rgb values
-            while len(rgb) == 0:
-                # abort if stop button pressed
-                if not getattr(self.run_thread, "do_run", True):
-                    run_cond.stop_timer()  
-                    self.logger.save_img(self.fig)
-                    self.logger.log('log','Experiment aborted')
-                    self.status_string.set("Experiment Aborted")
-                    return None
-                # get the average rgb values
-                rgb = run_cond.rgb_avg
-
-            # calculate cost in MSE
-            cost = opt.cal_cost(target, rgb)
-            self.logger.log('log', 'Cost: ' + str(cost))
-            #self.status_string.set(self.status_string.get()+' RGB: '+str(rgb)+' Cost: '+str(int(cost)))
-
-            # add to queue to pass to self.updateUI(), looping every 0.1sec
-            self.qplot.put([algo,iteration,cost,rgb])
-
-            # update optimal rates for gd or bo
-            if algo == "gd":
-                if cost < self.min_gd_cost:
-                    self.min_gd_cost = cost
-                    self.optimal_rates_gd = rates
-            if algo == 'bo':
-                if cost < self.min_bo_cost:
-                    self.min_bo_cost = cost
-                    self.optimal_rates_bo = rates
-
-            # show a warning if the cost increased
-            if cost-prev_cost > 3000 and prev_cost > 1:
-                self.qmsg.put(['Warning', 'Cost increased. Please check if bubbles are stuck in the zcell'])
-                self.logger.log('log','Cost increased. Warned user to check bubbles in the tube.')
-
-            # show a warning if the RGB is close to boundary
-            boundary1 = rgb[1] <= 85
-            boundary2 = rgb[2] > 180 and rgb[1] < 1.2*rgb[2] - 126
-            boundary3 = rgb[0] < 150 and rgb[1] < 220-0.9*rgb[0]
-
-            if boundary1 or boundary2 or boundary3:
-                if algo == 'gd':
-                    self.qmsg.put(['Warning', 'The algorithm is reaching the boundary, it may not converge further.'])
-                    self.logger.log('log','Warned user the algorithm is reaching rgb boundary.')
-
-            prev_cost = cost
-
-            return cost
-
-        def get_four_scout(rates, cost):
-            ''' proceed to acquire four scout data points '''
-
-            nonlocal small_step_size
-            rgb_steps = [] # list to store scout steps rates
-
-            # create an automation  object
-            run_cond = auto.AcquireData(self.pumps,rates,self.tube_dist,self.tube_dia,self.spec,self.ref_spec,
-                                        self.bg_spec,self.wavelength,self.no_of_avg,self.logger,diffuse_time)
-
-            # get scout steps matrix
-            if self.scout_size_rdm_bool.get() == True:
-               small_steps_Q = auto.random_small_step_Q(rates) # random scout step size
-            else: small_steps_Q = auto.small_step_Q(rates,small_step_size) # fixed scout step size
-             
-            ## scale scout steps matrix to sum=600
-            #for i in range(4):
-            #    small_steps_Q[i] *= 600.0/np.sum(small_steps_Q, axis=1)[i]
-
-            self.logger.log('log','Flowrates with Small Step Size: '+str(small_steps_Q))
-            
-            # loop through scout steps
-            for idx, small_step in enumerate(small_steps_Q):
-                self.status_string.set("Running small step #"+str(idx+1)
-                                        +" at: "+str([int(i) for i in small_step])+' for '
-                                        +str(int(run_cond.wait_sec))+' sec...'
-                                        #+'\n and diffuse for '
-                                        #+str(int(diffuse_time))+' sec...'
-                                        )
-                # move one scout step
-                rgb_step = []
-                run_cond.rgb_avg = []
-                run_cond.rates = small_step
-                run_cond.run_one_cond()
-                # wait to complete one big step
-                while len(rgb_step) == 0:
-                    # abort if stop button is pressed
-                    if not getattr(self.run_thread, "do_run", True):
-                        run_cond.stop_timer()  
-                        self.logger.save_img(self.fig)
-                        self.logger.log('log','Experiment aborted')
-                        self.status_string.set("Experiment Aborted")
-                        return None
-                    rgb_step = run_cond.rgb_avg
-                # add new rgb to list
-                rgb_steps.append(rgb_step)
-
-            # Gradient Descent
-            # suggest next flow rates based on the gradients from scout steps
-            delta_rates = np.empty(4) # change of rates between the new rates and current rates
-            for i in range(len(rgb_steps)):
-                delta_rates += opt.gradient_descent_4steps(target, rgb_steps[i], small_steps_Q[i], cost,
-                                                    rates, learning_rate)
-
-            # new rates before scaling
-            rates_new = rates + delta_rates
-            self.logger.log('log','Gradient Descent Predicted Flowrate (before rescale): '+str(rates_new))
-            print('Predicted Flowrate (before rescale): '+str(rates_new))
-
-            # scale new rates
-            rates_new_scaled = scale.scale_rates(rates, delta_rates)
-
-            self.logger.log('log', 'Gradient Descent Predicted Flowrate (after rescale): '+str(rates_new_scaled))
-            print('Predicted Flowrate (after rescale): '+str(rates_new_scaled))
-
-            # reduce scout step size
-            small_step_size = 30.0
-            #small_step_size = int((cost+1000)/200) # proportional scout step size
-            # step size should be no smaller than 18 to ensure not overpowered by +-3% error on RGB measuring 
-            if small_step_size < 18:
-                small_step_size = 18
-            return rates_new_scaled
-
-                
-        # Constraint for BO
-        # !!! not used in bo.suggest
-        def constraint_function(wrate, crate, mrate, yrate):
-            ''' constraint inequality function is about the sum of rates '''
-            return wrate+crate+mrate+yrate
-        constraint_limit = 600 # total rates <= 600
-        constraint = NonlinearConstraint(constraint_function, 0, constraint_limit)
-
-        def run_BO():
-            ''' bayesian optimization process '''
-
-            iteration = self.iteration
-
-            pbounds = { "crate":(0,600), "mrate":(0,600),"wrate":(0,600), "yrate":(0,600)}
-
-            # create an optimizer
-            bo = BayesianOptimization(f=get_one_data,
-                                      constraint = constraint,
-                                      pbounds = pbounds,
-                                      verbose=2,
-                                      random_state=None)
-            # set acquisition function
-            acquisition_function = UtilityFunction(kind="ucb", kappa=kappa)
-
-            # initialize bo rates
-            bo_rates = bo._space.array_to_params(self.init_rates)
-
-            self.logger.log('log','Algorithm: BO')
-            self.logger.log('log','Kappa: '+str(kappa))
-
-            # optimize loop
-            while iteration < self.no_iter:
-
-                self.logger.log('log', 'Iteration ' + str(iteration))
-
-                # BO
-                try:
-                    bo_cost = -get_one_data(**bo_rates, iteration=iteration,algo="bo")
-                except TypeError:
-                    break
-                print("BO rates and MSE")
-                print(bo_rates, bo_cost)
-                bo.register(params=bo_rates, target=bo_cost,constraint_value=600)
-                bo_rates = bo.suggest(acquisition_function)
-                bo_rates_array = np.array(list(bo_rates.values()))
-                bo_rates_array = 600*bo_rates_array/sum(bo_rates_array)
-                bo_rates.update({'crate':bo_rates_array[0],
-                                 'mrate':bo_rates_array[1],
-                                 'wrate':bo_rates_array[2],
-                                 'yrate':bo_rates_array[3]})
-                bo_prev_cost = bo_cost
-                self.logger.log('log', 'Bayesian Optimization Cost: '+str(bo_cost))
-                self.logger.log('log', 'Bayesian Optimization Predicted Flowrate: '+str(bo_rates))
-                print("BO predicted rates: " + str(bo_rates))
-                
-                iteration += 1
-
-            if iteration >= self.no_iter:
-                # if terminated because reached max no of iteration set
-                self.logger.save_img(self.fig)
-                self.logger.log('log','Experiment reached maximum number of iterations')
-                self.status_string.set("Experiment reached maximum number of iterations")
-
-
-        def run_GD():
-            ''' run gradient descent process '''
-
-            iteration = self.iteration
-            prev_cost = self.prev_cost
-            # initialize rates
-            gd_rates = self.init_rates
-
-            # log
-            self.logger.log('log','Learning Rate: '+str(learning_rate))
-
-            # optimization loop
-            while iteration < self.no_iter:
-
-                self.logger.log('log', 'Iteration ' + str(iteration))
-
-                gd_cost = get_one_data(*gd_rates, iteration=iteration, algo="gd")
-                # terminate if user stop from UI
-                if gd_cost == None:
-                    break
-                # terminate if the cost is small enough
-                if gd_cost < 150: # because the Blue Dye has a mse 838
-                    auto.stop_all(self.pumps)
-                    self.logger.save_img(self.fig)
-                    self.status_string.set("Optimized flow rates are found at "+str(gd_rates))
-                    self.logger.log('log','Completed! Found the flow rates with the possible minimum cost')
-                    break
-                gd_rates = get_four_scout(gd_rates, gd_cost)
-
-                # terminate if user stop from UI
-                if gd_rates is None:
-                    break
-                prev_cost = gd_cost
-                self.logger.log('log', 'Gradient Descent Cost: '+str(gd_cost))
-                self.logger.log('log', 'Gradient Descent Predicted Flowrate: '+str(gd_rates))
-
-                iteration += 1
-
-            if iteration >= self.no_iter:
-                # if terminated because reached max no of iteration set
-                self.logger.save_img(self.fig)
-                self.logger.log('log','Experiment reached maximum number of iterations')
-                self.status_string.set("Experiment reached maximum number of iterations")
-
-
-        def run_both():
-            ''' run bayesian optimization and gradient descent in parallel '''
-
-            iteration = self.iteration
-            prev_cost = self.prev_cost
-            # initialize bo_rates and gd_rates
-            gd_rates = self.init_rates
-
-            # initialize bo_prev_cost and gd_prev_cost
-            bo_prev_cost = prev_cost
-            gd_prev_cost = prev_cost
-
-            pbounds = { "crate":(0,600),"mrate":(0,600), "wrate":(0,600),"yrate":(0,600)}
-
-            # create an optimizer
-            bo = BayesianOptimization(f=get_one_data,
-                                      constraint = constraint,
-                                      pbounds = pbounds,
-                                      verbose=2,
-                                      random_state=None)
-            
-            # set acquisition function
-            acquisition_function = UtilityFunction(kind="ucb", kappa=kappa)
-
-            # initialize bo rates
-            bo_rates = bo._space.array_to_params(self.init_rates)
-
-            # log
-            self.logger.log('log','Algorithm: BO & GD')
-            self.logger.log('log','BO Kappa: '+str(kappa))
-            self.logger.log('log','GD Learning Rate: '+str(learning_rate))
-
-            # optimize loop
-            while iteration < self.no_iter:
-
-                self.logger.log('log', 'Iteration ' + str(iteration))
-
-                # BO
-                bo_cost = -get_one_data(**bo_rates, prev_cost=bo_prev_cost, iteration=iteration, algo="bo")
-                if bo_cost == None: # abort if user stop from UI
-                    break
-                print("BO rates and MSE")
-                print(bo_rates, bo_cost)
-                bo.register(params=bo_rates, target=bo_cost, constraint_value=600)
-                bo_rates = bo.suggest(acquisition_function)
-                bo_rates_array = np.array(list(bo_rates.values()))
-                bo_rates_array = 600*bo_rates_array/sum(bo_rates_array)
-                bo_rates.update({'crate':bo_rates_array[0],
-                                 'mrate':bo_rates_array[1],
-                                 'wrate':bo_rates_array[2],
-                                 'yrate':bo_rates_array[3]})
-                bo_prev_cost = bo_cost
-                self.logger.log('log', 'Bayesian Optimization Cost: '+str(bo_cost))
-                self.logger.log('log', 'Bayesian Optimization Predicted Flowrate: '+str(bo_rates))
-                
-                print("BO predicted rates: " + str(bo_rates))
-                
-                # GD
-                gd_cost = get_one_data(*gd_rates, gd_prev_cost, iteration=iteration,algo="gd")
-                if gd_cost == None: # abort if user stop from UI
-                    break
-                gd_rates = get_four_scout(gd_rates, gd_cost)
-
-                # reduce scout step size
-                #small_step_size = 10.0
-                # small_step_size = int((cost+1000)/200) # proportional scout step size
-
-                if gd_rates is None: # abort if user stop from UI
-                    break
-                gd_prev_cost = gd_cost
-                self.logger.log('log', 'Gradient Descent Cost: '+str(gd_cost))
-                self.logger.log('log', 'Gradient Descent Predicted Flowrate: '+str(gd_rates))
-                print("GD rates and MSE")
-                print(gd_rates, gd_cost)
-
-                iteration += 1
-
-            if iteration >= self.no_iter:
-                # if terminated because reached max no of iteration set
-                self.logger.save_img(self.fig)
-                self.logger.log('log','Experiment reached maximum number of iterations')
-                self.status_string.set("Experiment reached maximum number of iterations")
-
-
+        # get user selected target rgb (a campaign uses the palette instead)
         algo_pick = self.algo.get()
-        if algo_pick == 'Gradient Descent':
-            run_GD()
-        elif algo_pick == 'Bayesian Optim':
-            run_BO()
-        elif algo_pick == 'Both':
-            run_both()
-
+        if algo_pick == 'Campaign':
+            target = np.array(self.palette)
+        else:
+            target = np.array([int(i) for i in eval(self.target_color_UI.get())])
 
-        # Stop all pumps
-        auto.stop_all(self.pumps)
+        # the engine runs on the experiment thread, its events reach self.updateUI() through the queue
+        self.engine = eng.Engine(self.pumps, self.spec, self.wavelength, self.ref_spec, self.bg_spec, self.logger,
+                                 self.integ_time,
+                                 init_rates=self.init_rates,
+                                 no_iter=self.no_iter,
+                                 no_iter_campaign=self.no_iter_campaign,
+                                 no_of_avg=self.no_of_avg,
+                                 tube_dist=self.tube_dist,
+                                 tube_dia=self.tube_dia,
+                                 random_scout=bool(self.scout_size_rdm_bool.get()),
+                                 random_seed=self.random_seed,
+                                 gp_engine=self.gp_engine,
+                                 sparse_threshold=self.sparse_threshold,
+                                 bo_history=self.bo_history,
+                                 acquisition=self.acquisition,
+                                 color_index_file=self.color_index_file)
+        for event in eng.EVENTS:
+            self.engine.subscribe(event, lambda *args, event=event: self.qevent.put([event, args]))
+        self.run_thread = threading.Thread(target=self.run_engine, args=(algo_pick, target), daemon=True)
+        self.run_thread.start()
+
+    def run_engine(self, algo_pick, target):
+        ''' experiment thread '''
+        try:
+            self.engine.run(algo_pick, target)
+        except Exception as msg:
+            auto.stop_all(self.pumps)
+            self.qevent.put(['warning', ('Experiment Error', str(msg))])
+            self.qevent.put(['done', (None,)])
+
+    def run_done(self, result):
+        ''' the experiment thread is over, called from self.updateUI() '''
+        if result is not None:
+            self.optimal_rates_gd = result['optimal_rates_gd']
+            self.optimal_rates_bo = result['optimal_rates_bo']
         # enable all other buttons 
         self.pick_btn['state']='normal'
+        self.palette_btn['state']='normal'
         #self.syringe_diam['state']='normal'
         #self.water_syringe_diam['state']='normal'
         self.flush_all_btn['state']='normal'
@@ -1106,19 +652,18 @@ class App(tk.Tk):
 
     def _start_signal(self):
 
-        # create a thread of running experiment
-        self.run_thread = threading.Thread(target=self.run)
-        self.run_thread.setDaemon(True)
-
         # start runnning experiment
         if self.start_btn["text"] == "Start":
             # clear plots
-            target = np.array([int(i) for i in eval(self.target_color_UI.get())])
-            self.rgb_fig.cla()
-            self.rgb_fig.set_xlabel('R')
-            self.rgb_fig.set_ylabel('G')
-            self.rgb_fig.set_zlabel('B')
-            self.rgb_fig.scatter(*target, color=target/255.0, marker='*')
+            if self.algo.get() == 'Campaign':
+                self.plot_palette()
+            else:
+                target = np.array([int(i) for i in eval(self.target_color_UI.get())])
+                self.rgb_fig.cla()
+                self.rgb_fig.set_xlabel('R')
+                self.rgb_fig.set_ylabel('G')
+                self.rgb_fig.set_zlabel('B')
+                self.rgb_fig.scatter(*target, color=target/255.0, marker='*')
             self.mse_fig.cla()
             self.mse_fig.legend(handles=self.legend_elements, bbox_to_anchor=(1, 1.02),loc="lower right")
             self.mse_fig.xaxis.set_major_locator(MaxNLocator(integer=True, min_n_ticks=1))
@@ -1132,15 +677,15 @@ class App(tk.Tk):
             self.pick_btn["state"] = "disabled"
             self.status_string.set("Experiment START!")
             # start run experiment thread
-            self.run_thread.start()
+            self.run()
 
 
         else:
             # ========> Set run experiment condition flag, to break loop <==========
             self.start_btn["text"] = "Start"
             self.pick_btn["state"] = "normal"
-            # set thread property to stop run experiment thread
-            self.run_thread.do_run = False
+            # stop the engine after the current condition
+            self.engine.stop()
 
 
 
@@ -1149,37 +694,31 @@ class App(tk.Tk):
         # update the mse and rgb image
         # notice: tkinter does not allow plotting outside the main thread.
         # in order to scatter while running the run experiment thread,
-        # need to pass [iteration, cost, [rgb]] value to a queue
-        # this function loops every 0.1sec to update the plot from values in the queue
-        try:
-            # get value from queue
-            [algo,iteration,cost,rgb] = self.qplot.get(False)
-
-            if algo == "gd":
-                marker = 'o'
-            else:
-                marker = '^'
-
-            # plot mse 
-            self.mse_fig.scatter(int(iteration), int(cost), label=algo,marker=marker,color=rgb/255.0)
-            self.mse_fig.annotate(int(cost), xy=(int(iteration),int(cost)), fontsize=8, xycoords='data')
-
-            # plot rgb 
-            self.rgb_fig.scatter(*rgb, label=algo,marker=marker,color=rgb/255.0)
-
-            self.canvas.draw()
-        except queue.Empty:
-            # Handle empty queue here
-            pass
-
-        try:
-            [title, message] = self.qmsg.get(False)
-            tk.messagebox.showinfo(title=title, message=message)
-        except queue.Empty:
-            pass
+        # the engine events are passed as [event, args] to a queue
+        # this function loops every 0.1sec to handle the events in the queue
+        # take every pending event, a fast run queues many per tick
+        while True:
+            try:
+                [event, args] = self.qevent.get(False)
+            except queue.Empty:
+                break
+            if event == 'plot':
+                self.live_plot.add(*args)
+            elif event == 'status':
+                self.status_string.set(args[0])
+            elif event == 'warning':
+                tk.messagebox.showinfo(title=args[0], message=args[1])
+            elif event == 'finish':
+                # save the plot with every point of the run
+                self.live_plot.draw(force=True)
+                self.logger.save_img(self.fig)
+            elif event == 'done':
+                self.run_done(*args)
+        # redraw at a capped frame rate
+        self.live_plot.draw()
 
 
-        root.after(100, self.updateUI)
+        self.after(100, self.updateUI)
 
         
 
@@ -1190,7 +729,7 @@ class App(tk.Tk):
 
 if __name__ == "__main__":
     root = App()
-    root.after(100, root.updateUI()) 
+    root.after(100, root.updateUI)
     root.mainloop()
 
 
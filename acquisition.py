@@ -0,0 +1,332 @@
+''' Free-running spectrometer acquisition into a timestamped ring buffer
+
+    A spec.spectrum() call blocks for the whole integration time, and the
+    detector sits idle while the previous scan is converted, saved and logged.
+    Acquisition keeps one thread scanning back to back and stores every scan,
+    with the times its integration started and ended, in a bounded ring buffer
+    of the last `capacity` scans. Consumers ask for scans by time:
+
+    iter_after(t, n)     the first n scans whose integration started after t, as they arrive
+    get_after(t, n)      the same as a list
+    get_window(t0, t1)   the buffered scans integrated within [t0, t1]
+
+    so a condition uses exactly the scans taken once its liquid reached the
+    cell, and each scan is processed while the next one integrates.
+
+    Acquisition also stands in for the spectrometer (spectrum, intensities,
+    wavelengths, integration_time_micros), the device itself is only touched by
+    the acquisition thread while it runs. The first scan after an integration
+    time change is dropped, it may have started with the old setting.
+
+    set_processing(scans_to_average, boxcar_width) makes every buffered scan an
+    average of scans_to_average detector scans smoothed by a boxcar of
+    2*boxcar_width+1 pixels. It runs on the spectrometer (seabreeze
+    spectrum_processing feature: one transfer per average, no Python per scan)
+    where the backend has it, else the same on the host (see configure_processing).
+    The configuration is kept with each scan and recorded in the experiment store.
+'''
+
+import threading
+import time
+import numpy as np
+
+
+# scan processing of a plain spectrometer read
+NO_PROCESSING = {'scans_to_average': 1, 'boxcar_width': 0, 'processing': 'none'}
+
+
+def boxcar(intensities, width):
+    ''' mean of the 2*width+1 pixels centred on each pixel (fewer at the ends) along the last axis '''
+    intensities = np.asarray(intensities, dtype=float)
+    if width <= 0:
+        return intensities
+    n = intensities.shape[-1]
+    cumsum = np.cumsum(intensities, axis=-1)
+    cumsum = np.concatenate([np.zeros(intensities.shape[:-1] + (1,)), cumsum], axis=-1)
+    pixels = np.arange(n)
+    low = np.clip(pixels - width, 0, n)
+    high = np.clip(pixels + width + 1, 0, n)
+    return (cumsum[..., high] - cumsum[..., low])/(high - low)
+
+
+def configure_processing(spec, scans_to_average=1, boxcar_width=0):
+    ''' set scans to average and boxcar width on the spectrometer if it has the feature,
+        return the configuration: {'scans_to_average', 'boxcar_width', 'processing': 'device' or 'host'}
+    '''
+    processing = {'scans_to_average': int(scans_to_average), 'boxcar_width': int(boxcar_width), 'processing': 'host'}
+    feature = getattr(getattr(spec, 'f', None), 'spectrum_processing', None)
+    if feature is not None:
+        try:
+            feature.set_scans_to_average(processing['scans_to_average'])
+            feature.set_boxcar_width(processing['boxcar_width'])
+            if feature.get_scans_to_average() == processing['scans_to_average'] \
+                    and feature.get_boxcar_width() == processing['boxcar_width']:
+                processing['processing'] = 'device'
+                return processing
+        except Exception: # not implemented for this model, or out of its range
+            pass
+        try:
+            # back to plain scans, the host does it all
+            feature.set_scans_to_average(1)
+            feature.set_boxcar_width(0)
+        except Exception:
+            pass
+    return processing
+
+
+def read_processed(spec, processing):
+    ''' counts of one read of spec with a configuration of configure_processing '''
+    if processing['processing'] != 'host':
+        return np.asarray(spec.intensities(), dtype=float)
+    n = processing['scans_to_average']
+    scans = np.array([spec.intensities() for _ in range(n)], dtype=float) if n > 1 else spec.intensities()
+    intensities = scans.mean(axis=0) if n > 1 else np.asarray(scans, dtype=float)
+    return boxcar(intensities, processing['boxcar_width'])
+
+
+class Scan():
+    ''' one buffered scan: sequence number, integration start and end (time.time()), integration time, counts
+        and processing (configuration of configure_processing)
+    '''
+
+    def __init__(self, seq, started, ended, integ_time, intensities, processing=None):
+        self.seq = seq
+        self.started = started
+        self.ended = ended
+        self.integ_time = integ_time
+        self.intensities = intensities
+        self.processing = processing if processing is not None else dict(NO_PROCESSING)
+
+
+class Acquisition():
+    ''' scans of spec acquired back to back on a thread
+
+        spec: spectrometer (seabreeze Spectrometer or spectrometers.SimulatedSpectrometer)
+        capacity: number of scans kept in the ring buffer
+        integ_time: integration time to start with (microsecond), None to keep the device setting
+    '''
+
+    def __init__(self, spec, capacity=64, integ_time=None):
+        self.device = spec
+        self.capacity = capacity
+        self.wavelengths_ = np.asarray(spec.wavelengths(), dtype=float)
+        pixels = len(self.wavelengths_)
+        # ring buffer, scan seq is kept at seq % capacity
+        self.intensities_ = np.zeros((capacity, pixels))
+        self.started = np.zeros(capacity)
+        self.ended = np.zeros(capacity)
+        self.integ_times = np.zeros(capacity, dtype=int)
+        self.processings = [None]*capacity
+        self.seq = 0 # number of scans acquired so far
+        self.dropped = 0 # scans dropped after an integration time change
+        if integ_time is not None:
+            spec.integration_time_micros(integ_time)
+        self.integ_time = integ_time
+        self.pending_integ_time = integ_time # applied by the thread before its next scan
+        self.processing = dict(NO_PROCESSING)
+        self.pending_processing = None # (scans_to_average, boxcar_width) applied before the next scan
+        self.error = None # exception stopping the thread, raised to the consumers
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.active = False # thread scanning, cleared (and the consumers woken up) when it ends
+
+    # ----- thread -----
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stop_event.clear()
+            self.error = None
+            self.active = True
+            self.thread = threading.Thread(target=self.work, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+
+    def running(self):
+        return self.active
+
+    def work(self):
+        discard = False
+        try:
+            while not self.stop_event.is_set():
+                with self.condition:
+                    pending = self.pending_integ_time
+                    pending_processing, self.pending_processing = self.pending_processing, None
+                if pending is not None and pending != self.integ_time:
+                    self.device.integration_time_micros(pending)
+                    self.integ_time = pending
+                    discard = True
+                if pending_processing is not None:
+                    processing = configure_processing(self.device, *pending_processing)
+                    with self.condition:
+                        self.processing = processing
+                    discard = True
+                started = time.time()
+                intensities = read_processed(self.device, self.processing)
+                ended = time.time()
+                if discard:
+                    discard = False
+                    self.dropped += 1
+                    continue
+                with self.condition:
+                    i = self.seq % self.capacity
+                    self.intensities_[i] = intensities
+                    self.started[i] = started
+                    self.ended[i] = ended
+                    self.integ_times[i] = self.integ_time or 0
+                    self.processings[i] = self.processing
+                    self.seq += 1
+                    self.condition.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.active = False
+                self.condition.notify_all()
+
+    # ----- consumers -----
+    def scan(self, seq):
+        # caller holds the condition
+        i = seq % self.capacity
+        return Scan(seq, self.started[i], self.ended[i], int(self.integ_times[i]), self.intensities_[i].copy(),
+                    dict(self.processings[i]))
+
+    def first_after(self, t):
+        # oldest buffered seq whose integration started after t, caller holds the condition
+        oldest = max(self.seq - self.capacity, 0)
+        for seq in range(oldest, self.seq):
+            if self.started[seq % self.capacity] > t:
+                return seq
+        return self.seq
+
+    def iter_after(self, t, n, timeout=None):
+        ''' yield the first n scans whose integration started after t (time.time()) as they arrive
+
+            timeout: max seconds to wait for each scan, TimeoutError after it
+            Scans overwritten before they were read are skipped.
+        '''
+        if not self.running():
+            raise RuntimeError('acquisition is not running')
+        with self.condition:
+            seq = self.first_after(t)
+        for _ in range(n):
+            with self.condition:
+                if not self.condition.wait_for(lambda: self.seq > seq or self.error is not None
+                                               or not self.running(), timeout):
+                    raise TimeoutError('no scan within '+str(timeout)+' sec')
+                if self.error is not None:
+                    raise self.error
+                if self.seq <= seq:
+                    raise RuntimeError('acquisition stopped')
+                seq = max(seq, self.seq - self.capacity)
+                scan = self.scan(seq)
+            yield scan
+            seq += 1
+
+    def get_after(self, t, n, timeout=None):
+        ''' list of the first n scans whose integration started after t '''
+        return list(self.iter_after(t, n, timeout))
+
+    def get_window(self, t0, t1):
+        ''' buffered scans integrated within [t0, t1], oldest first '''
+        with self.condition:
+            seqs = range(max(self.seq - self.capacity, 0), self.seq)
+            return [self.scan(seq) for seq in seqs
+                    if self.started[seq % self.capacity] >= t0 and self.ended[seq % self.capacity] <= t1]
+
+    def latest(self, n=1):
+        ''' last n buffered scans, oldest first '''
+        with self.condition:
+            return [self.scan(seq) for seq in range(max(self.seq - min(n, self.capacity), 0), self.seq)]
+
+    # ----- spectrometer interface -----
+    def wavelengths(self):
+        return self.wavelengths_.copy()
+
+    def integration_time_micros(self, integration_time_micros):
+        ''' set the integration time, applied before the next scan '''
+        if not self.running():
+            self.device.integration_time_micros(integration_time_micros)
+            self.integ_time = integration_time_micros
+        with self.condition:
+            self.pending_integ_time = integration_time_micros
+
+    def set_processing(self, scans_to_average=1, boxcar_width=0, timeout=None):
+        ''' average and smooth every scan from the next one on, on the device if it can (see configure_processing)
+            returns the configuration once applied
+        '''
+        if not self.running():
+            self.processing = configure_processing(self.device, scans_to_average, boxcar_width)
+            return dict(self.processing)
+        request = (int(scans_to_average), int(boxcar_width))
+        with self.condition:
+            self.pending_processing = request
+            self.condition.wait_for(lambda: not self.active or (self.pending_processing is None and (
+                self.processing['scans_to_average'], self.processing['boxcar_width']) == request), timeout)
+            return dict(self.processing)
+
+    def intensities(self, correct_dark_counts=False, correct_nonlinearity=False):
+        ''' counts of the next scan started after this call with the current settings '''
+        if correct_dark_counts or correct_nonlinearity:
+            if self.running():
+                raise RuntimeError('corrected scans are only read with the acquisition stopped')
+            return self.device.intensities(correct_dark_counts, correct_nonlinearity)
+        if not self.running():
+            return read_processed(self.device, self.processing)
+        t = time.time()
+        with self.condition:
+            integ_time = self.pending_integ_time
+            # a requested processing change is applied before the next scan
+            settled = lambda scan: self.pending_processing is None and scan.processing == self.processing
+        for scan in self.iter_after(t, 1):
+            while (integ_time is not None and scan.integ_time != integ_time) or not settled(scan):
+                scan = self.get_after(scan.started, 1)[0]
+            return scan.intensities
+
+    def spectrum(self, correct_dark_counts=False, correct_nonlinearity=False):
+        ''' wavelengths and intensities of the next scan as one (2, pixels) array '''
+        return np.vstack((self.wavelengths_, self.intensities(correct_dark_counts, correct_nonlinearity)))
+
+    def __getattr__(self, name):
+        # anything else (serial_number, max_intensity, rig of a simulated spectrometer) from the device
+        if name == 'device':
+            raise AttributeError(name)
+        return getattr(self.device, name)
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    import spectrometers as spm
+
+    acquisition = Acquisition(spm.SimulatedSpectrometer(seed=0), capacity=32, integ_time=40000).start()
+    start = time.time()
+    time.sleep(0.5)
+    # process each scan while the next one integrates
+    for scan in acquisition.iter_after(start + 0.2, 5):
+        print('scan %d: %.3f-%.3f sec, %d us, max %d counts' % (
+            scan.seq, scan.started - start, scan.ended - start, scan.integ_time, scan.intensities.max()))
+    print('%d scans within [0.1, 0.3] sec' % len(acquisition.get_window(start + 0.1, start + 0.3)))
+
+    acquisition.integration_time_micros(20000)
+    print('max at 20 ms: %d counts' % acquisition.spectrum()[1].max())
+    acquisition.stop()
+    print(str(acquisition.seq)+' scans, '+str(acquisition.dropped)+' dropped after the integration time change')
+
+    # scans to average and boxcar on the (simulated) device and on the host give the same noise
+    for device_processing in [True, False]:
+        spec = spm.SimulatedSpectrometer(seed=0, device_processing=device_processing)
+        acquisition = Acquisition(spec, integ_time=20000).start()
+        single = np.array([acquisition.intensities() for _ in range(10)])
+        acquisition.set_processing(scans_to_average=8, boxcar_width=2)
+        start = time.time()
+        averaged = np.array([acquisition.intensities() for _ in range(10)])
+        seconds = time.time() - start
+        scan = acquisition.latest()[0]
+        acquisition.stop()
+        print('%s: noise %.1f -> %.1f counts, %.2f sec per reading' % (
+            scan.processing, single.std(axis=0).mean(), averaged.std(axis=0).mean(), seconds/10))
@@ -0,0 +1,316 @@
+''' Memory-mapped reader over the experiment archive
+
+    Finds every spectral store (spectral_store.SpectralStore, one per experiment
+    Data folder) under a root folder, and exposes the stored spectra as lazy
+    selections filtered by run, kind, iteration, condition, rates or time range.
+    Rows are read from memory maps only when a selection is sliced or streamed,
+    so the archive is never loaded into RAM as a whole.
+
+    Experiments saved before the store (one .npy per spectrum) are read as well,
+    each .npy memory mapped on access.
+
+    Compact stores (raw counts only, see spectral_codec.py) are decoded row by
+    row, and their derived kinds are computed on read: trans from each spec row,
+    avgspec as the mean of the consecutive spec rows of one condition, avgtrans
+    from avgspec, with the reference and background saved in the store.
+
+    Example:
+        archive = ExperimentArchive('Data')
+        selection = archive.select('avgspec', start='2023-07-01', rates=[5, 5, 600, 5], rates_tol=1)
+        for rows, spectra in selection.chunks(512):
+            ...
+'''
+
+import csv
+import datetime
+import json
+import os
+import re
+import numpy as np
+
+import spectral_codec as codec
+import spectral_store as ss
+
+# prefixes of the npy files saved before the spectral store (raw spectra and transmittance shared Spect_)
+LEGACY_PREFIX = {'Spect': 'spec', 'AverageSpect': 'avgspec', 'AverageTrans': 'avgtrans'}
+LEGACY_NAME = re.compile(r'^(Spect|AverageSpect|AverageTrans)_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\.npy$')
+# kinds computed from the raw counts of a compact store
+DERIVED = ['trans', 'avgspec', 'avgtrans']
+
+
+def to_datetime64(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return np.datetime64(datetime.datetime.fromisoformat(value))
+    return np.datetime64(value)
+
+
+def number(text, dtype=float):
+    return dtype(text) if text not in ('', None) else (np.nan if dtype is float else -1)
+
+
+class Selection():
+    ''' lazily read rows of one kind across stores
+
+        index: dict of column arrays (run, row, iteration, condition, rates, timestamp, integ_time,
+               scans_to_average, boxcar_width, processing)
+    '''
+
+    def __init__(self, archive, kind, index):
+        self.archive = archive
+        self.kind = kind
+        self.index = index
+
+    def __len__(self):
+        return len(self.index['row'])
+
+    def read(self, positions):
+        ''' rows at the given positions of the selection, (len(positions), n_points) '''
+        positions = np.asarray(positions, dtype=int)
+        runs = self.index['run'][positions]
+        rows = self.index['row'][positions]
+        out = None
+        for run in np.unique(runs):
+            mask = runs == run
+            data = self.archive.rows(run, self.kind, rows[mask])
+            if out is None:
+                out = np.empty((len(positions), data.shape[1]), dtype=data.dtype)
+            out[mask] = data
+        return out if out is not None else np.empty((0, 0))
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self.read([item])[0]
+        return self.read(np.arange(len(self))[item])
+
+    def chunks(self, size=1024):
+        ''' stream the selection: (index of the chunk, rows of the chunk) '''
+        for start in range(0, len(self), size):
+            positions = np.arange(start, min(start + size, len(self)))
+            yield {key: value[positions] for key, value in self.index.items()}, self.read(positions)
+
+    def to_array(self):
+        ''' all rows in memory, for selections known to be small '''
+        return self.read(np.arange(len(self)))
+
+
+class ExperimentArchive():
+    ''' every experiment store (and legacy npy Data folder) under root '''
+
+    def __init__(self, root):
+        self.root = root
+        self.maps = {} # (run, kind) -> memory map (offsets of the rows if encoded)
+        self.legacy = {} # run -> list of npy files by kind
+        self.derived = {} # run of a compact store -> spec rows of each avgspec row
+        self.references = {} # run of a compact store -> (ref, bg)
+        columns = {'run': [], 'kind': [], 'row': [], 'iteration': [], 'condition': [], 'rates': [],
+                   'timestamp': [], 'integ_time': [], 'scans_to_average': [], 'boxcar_width': [], 'processing': []}
+        for folder, _, files in os.walk(root):
+            if 'index.csv' in files and 'meta.json' in files:
+                self.read_store_index(folder, columns)
+            elif any(LEGACY_NAME.match(name) for name in files):
+                self.read_legacy_index(folder, files, columns)
+
+        self.index = {'run': np.array(columns['run'], dtype=object),
+                      'kind': np.array(columns['kind'], dtype=object),
+                      'row': np.array(columns['row'], dtype=int),
+                      'iteration': np.array(columns['iteration'], dtype=int),
+                      'condition': np.array(columns['condition'], dtype=int),
+                      'rates': np.array(columns['rates'], dtype=float).reshape(-1, 4),
+                      'timestamp': np.array(columns['timestamp'], dtype='datetime64[us]'),
+                      'integ_time': np.array(columns['integ_time'], dtype=float),
+                      'scans_to_average': np.array(columns['scans_to_average'], dtype=int),
+                      'boxcar_width': np.array(columns['boxcar_width'], dtype=int),
+                      'processing': np.array(columns['processing'], dtype=object)}
+
+    def read_store_index(self, folder, columns):
+        with open(os.path.join(folder, 'meta.json')) as f:
+            meta = json.load(f)
+        complete = {kind: self.store_rows(folder, kind, meta[kind]) for kind in meta}
+        spec_lines = []
+        with open(os.path.join(folder, 'index.csv'), newline='') as f:
+            for line in csv.DictReader(f):
+                # skip index lines of rows cut short by a crash
+                if line['kind'] not in complete or int(line['row']) >= complete[line['kind']]:
+                    continue
+                self.add_line(folder, line['kind'], int(line['row']), line, columns)
+                if line['kind'] == 'spec':
+                    spec_lines.append(line)
+        self.maps.update({(folder, kind): meta[kind] for kind in meta})
+
+        reference = os.path.join(folder, 'reference.npz')
+        if 'codec' in meta.get('spec', {}) and not any(kind in meta for kind in DERIVED):
+            self.add_derived(folder, spec_lines, os.path.exists(reference), columns)
+            if os.path.exists(reference):
+                with np.load(reference) as data:
+                    self.references[folder] = (data['ref'], data['bg'])
+
+    def add_line(self, folder, kind, row, line, columns):
+        columns['run'].append(folder)
+        columns['kind'].append(kind)
+        columns['row'].append(row)
+        columns['iteration'].append(number(line['iteration'], int))
+        columns['condition'].append(number(line['condition'], int))
+        columns['rates'].append([number(line[i]) for i in ['crate', 'mrate', 'wrate', 'yrate']])
+        columns['timestamp'].append(np.datetime64(datetime.datetime.fromisoformat(line['timestamp'])))
+        columns['integ_time'].append(number(line['integ_time']))
+        # stores written before the scan processing was recorded: plain scans
+        columns['scans_to_average'].append(number(line.get('scans_to_average') or '1', int))
+        columns['boxcar_width'].append(number(line.get('boxcar_width') or '0', int))
+        columns['processing'].append(line.get('processing') or '')
+
+    def add_derived(self, folder, spec_lines, transmittance, columns):
+        # consecutive spec rows of the same condition make one average
+        groups = []
+        for line in spec_lines:
+            key = tuple(line[i] for i in ['iteration', 'condition', 'crate', 'mrate', 'wrate', 'yrate'])
+            if groups and groups[-1][0] == key:
+                groups[-1][1].append(line)
+            else:
+                groups.append((key, [line]))
+        self.derived[folder] = [np.array([int(line['row']) for line in lines]) for _, lines in groups]
+        if transmittance:
+            for line in spec_lines:
+                self.add_line(folder, 'trans', int(line['row']), line, columns)
+        for row, (_, lines) in enumerate(groups):
+            # average saved after its last scan
+            self.add_line(folder, 'avgspec', row, lines[-1], columns)
+            if transmittance:
+                self.add_line(folder, 'avgtrans', row, lines[-1], columns)
+
+    def store_rows(self, folder, kind, meta):
+        path = os.path.join(folder, kind+'.bin')
+        if not os.path.exists(path):
+            return 0
+        if 'codec' in meta:
+            offsets = ss.read_offsets(os.path.join(folder, kind+'.off'))
+            return int(np.sum(offsets.sum(axis=1) <= os.path.getsize(path)))
+        return os.path.getsize(path)//(meta['n_points']*np.dtype(meta['dtype']).itemsize)
+
+    def read_legacy_index(self, folder, files, columns):
+        self.legacy[folder] = {}
+        for name in sorted(files):
+            match = LEGACY_NAME.match(name)
+            if not match:
+                continue
+            kind = LEGACY_PREFIX[match.group(1)]
+            paths = self.legacy[folder].setdefault(kind, [])
+            columns['run'].append(folder)
+            columns['kind'].append(kind)
+            columns['row'].append(len(paths))
+            columns['iteration'].append(-1)
+            columns['condition'].append(-1)
+            columns['rates'].append([np.nan]*4)
+            columns['timestamp'].append(np.datetime64(datetime.datetime.strptime(match.group(2), '%Y-%m-%d_%H-%M-%S')))
+            columns['integ_time'].append(np.nan)
+            columns['scans_to_average'].append(1)
+            columns['boxcar_width'].append(0)
+            columns['processing'].append('')
+            paths.append(os.path.join(folder, name))
+
+    @property
+    def runs(self):
+        return sorted(set(self.index['run']))
+
+    def rows(self, run, kind, rows):
+        ''' rows of one kind of one run, read through a memory map '''
+        if run in self.legacy:
+            return np.stack([np.load(self.legacy[run][kind][row], mmap_mode='r') for row in rows])
+        if run in self.derived and kind in DERIVED:
+            return self.derived_rows(run, kind, rows)
+        spec = self.maps[(run, kind)]
+        if isinstance(spec, dict) and 'codec' in spec:
+            spec['offsets'] = spec.get('offsets', ss.read_offsets(os.path.join(run, kind+'.off')))
+            return ss.read_encoded(os.path.join(run, kind+'.bin'), spec['offsets'][np.asarray(rows, dtype=int)])
+        if not isinstance(spec, np.memmap):
+            n_rows = self.store_rows(run, kind, spec)
+            spec = np.memmap(os.path.join(run, kind+'.bin'), dtype=spec['dtype'], mode='r',
+                             shape=(n_rows, spec['n_points']))
+            self.maps[(run, kind)] = spec
+        rows = np.asarray(rows)
+        # a contiguous block is a view of the map, anything else copies only the selected rows
+        if len(rows) and np.all(np.diff(rows) == 1):
+            return spec[rows[0]:rows[-1]+1]
+        return spec[rows]
+
+    def derived_rows(self, run, kind, rows):
+        # computed from the decoded raw counts
+        if kind == 'trans':
+            return codec.transmittance(self.rows(run, 'spec', rows), *self.references[run])
+        groups = self.derived[run]
+        average = np.stack([self.rows(run, 'spec', groups[row]).mean(axis=0) for row in rows])
+        if kind == 'avgtrans':
+            return codec.transmittance(average, *self.references[run])
+        return average
+
+    def select(self, kind='avgspec', runs=None, iterations=None, conditions=None, rates=None, rates_tol=0.5,
+               start=None, end=None, scans_to_average=None, boxcar_width=None):
+        ''' lazy selection of the rows of one kind
+
+            runs: run folders (or substrings of them, e.g. 'Experiment_2023-07-')
+            iterations, conditions: lists of iteration or condition numbers
+            rates: flow rates [crate, mrate, wrate, yrate] within rates_tol (ul/min) of each pump
+            start, end: time range (datetime or iso string), end excluded
+            scans_to_average, boxcar_width: only spectra averaged and smoothed alike, to compare them
+        '''
+        index = self.index
+        mask = index['kind'] == kind
+        if runs is not None:
+            mask &= np.array([any(r in run for r in runs) for run in index['run']], dtype=bool)
+        if iterations is not None:
+            mask &= np.isin(index['iteration'], iterations)
+        if conditions is not None:
+            mask &= np.isin(index['condition'], conditions)
+        if rates is not None:
+            mask &= np.all(np.abs(index['rates'] - np.asarray(rates, dtype=float)) <= rates_tol, axis=1)
+        if start is not None:
+            mask &= index['timestamp'] >= to_datetime64(start)
+        if end is not None:
+            mask &= index['timestamp'] < to_datetime64(end)
+        if scans_to_average is not None:
+            mask &= index['scans_to_average'] == scans_to_average
+        if boxcar_width is not None:
+            mask &= index['boxcar_width'] == boxcar_width
+        return Selection(self, kind, {key: value[mask] for key, value in index.items()})
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    import tempfile
+    import time
+    import spectral_store as ss
+
+    root = tempfile.mkdtemp()
+    for experiment in range(3):
+        store = ss.SpectralStore(os.path.join(root, 'Experiment_'+str(experiment), 'Data'))
+        for condition in range(200):
+            rates = [5, 5, 600, 5] if condition % 10 == 0 else [100, 200, 200, 100]
+            for scan in range(3):
+                store.append('spec', np.random.rand(2048), iteration=condition//5, condition=condition, rates=rates)
+            store.append('avgspec', np.full(2048, condition, dtype=float), iteration=condition//5,
+                         condition=condition, rates=rates)
+        store.close()
+
+    start = time.time()
+    archive = ExperimentArchive(root)
+    print('indexed %d rows of %d runs in %.2f sec' % (len(archive.index['row']), len(archive.runs), time.time()-start))
+
+    selection = archive.select('avgspec', rates=[5, 5, 600, 5])
+    print('avgspec at [5, 5, 600, 5]: '+str(len(selection))+' rows, first values '+str(selection[:5][:, 0]))
+    total = 0
+    for rows, spectra in archive.select('spec', iterations=range(10)).chunks(256):
+        total += len(spectra)
+    print('streamed '+str(total)+' spec rows')
+
+    # compact store: raw counts only, derived kinds computed on read
+    store = ss.SpectralStore(os.path.join(root, 'Experiment_compact', 'Data'), compact=True)
+    store.set_reference(np.full(2048, 10000.0), np.full(2048, 1000.0))
+    for condition in range(20):
+        for scan in range(3):
+            store.append('spec', np.full(2048, 1000.0 + 100*condition + scan), iteration=condition, condition=condition,
+                         rates=[100, 200, 200, 100])
+    store.close()
+    archive = ExperimentArchive(root)
+    compact = archive.select('avgtrans', runs=['Experiment_compact'])
+    print('compact avgtrans: '+str(len(compact))+' rows, first values '+str(compact[:3][:, 0]))
@@ -0,0 +1,107 @@
+''' Background writer thread for data and log output
+
+    Disk and log writes are queued and run on one daemon thread, in order, so
+    the acquisition never waits on storage latency (e.g. a networked drive)
+    unless the queue is full.
+
+    Back-pressure policy when the queue is full:
+    - 'block': wait for room (default, nothing is lost, acquisition slows down)
+    - 'drop': drop the write and count it in dropped (for output that may be lost)
+
+    flush() waits until every queued write is done and raises the first error
+    of a write, so the end of an experiment is durable once flush() returns.
+'''
+
+import queue
+import threading
+
+
+class BackgroundWriter():
+    ''' run write calls on a background thread through a bounded queue
+
+        maxsize: max number of queued writes
+        policy: 'block' or 'drop' when the queue is full
+        timeout: max seconds to block for room (None: no limit), then the write is dropped
+    '''
+
+    def __init__(self, maxsize=1000, policy='block', timeout=None):
+        if policy not in ('block', 'drop'):
+            raise ValueError('unknown policy: '+str(policy))
+        self.policy = policy
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0 # writes lost to a full queue
+        self.error = None # first exception raised by a write
+        self.closed = False
+        self.thread = threading.Thread(target=self.work, name='BackgroundWriter', daemon=True)
+        self.thread.start()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                func, args, kwargs = item
+                func(*args, **kwargs)
+            except Exception as msg:
+                if self.error is None:
+                    self.error = msg
+                print('Background write failed: '+repr(msg))
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        ''' queue func(*args, **kwargs), return False if it was dropped '''
+        if self.closed:
+            raise RuntimeError('writer is closed')
+        try:
+            if self.policy == 'block':
+                self.queue.put((func, args, kwargs), timeout=self.timeout)
+            else:
+                self.queue.put_nowait((func, args, kwargs))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def flush(self):
+        ''' wait for every queued write, raise the first error of a write if any '''
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        ''' flush and stop the thread '''
+        if self.closed:
+            return
+        self.queue.join()
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.flush()
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    import time
+
+    def slow_write(lines, line):
+        time.sleep(0.01) # e.g. a networked drive
+        lines.append(line)
+
+    lines = []
+    writer = BackgroundWriter(maxsize=100)
+    start = time.time()
+    for i in range(50):
+        writer.submit(slow_write, lines, i)
+    print('queued 50 writes in %.4f sec' % (time.time()-start))
+    writer.flush()
+    print('written %d lines in order: %s, after %.2f sec' % (len(lines), lines == list(range(50)), time.time()-start))
+
+    writer = BackgroundWriter(maxsize=5, policy='drop')
+    for i in range(50):
+        writer.submit(slow_write, lines, i)
+    writer.close()
+    print('dropped with a full queue: '+str(writer.dropped))
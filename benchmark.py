@@ -0,0 +1,175 @@
+''' Headless benchmark of the optimization algorithms on the simulated plant
+
+    Runs the unchanged optimizers.Optimizer loops (GD, BO and both) against many
+    targets and seeds in parallel processes, and reports the wet evaluations and
+    the simulated wall time needed to reach a given delta E.
+
+    Example:
+        python benchmark.py --algos gd bo both --targets 8 --seeds 3 --delta-e 5
+'''
+
+import argparse
+import contextlib
+import csv
+import io
+import multiprocessing
+import warnings
+import numpy as np
+
+import optimization_4steps as opt
+import optimizers as optim
+import plant_simulator as sim
+import color_convert as cc
+import campaign as camp
+import convergence as conv
+
+# benchmark name -> algorithm name of the UI
+ALGOS = {'gd': 'Gradient Descent', 'bo': 'Bayesian Optim', 'both': 'Both'}
+
+
+def random_targets(n, seed=None, model=None):
+    ''' reachable targets: noise-free colors of random compositions '''
+    model = model if model is not None else sim.MixingModel()
+    rates = camp.random_rates(n, rng=seed)
+    return np.round(model.rgb(rates))
+
+
+def run_trial(trial):
+    ''' run one algorithm on one target with one seed, return its trace
+        trace: list of [evaluation, simulated time (sec), delta E of the measured composition]
+    '''
+    algo, target, seed, plant_settings, optimizer_settings = trial
+    target = np.asarray(target, dtype=float)
+    target_lab = cc.rgb_to_lab(target)
+
+    # the scout steps draw from the global numpy generator
+    np.random.seed(seed)
+    plant = sim.SimulatedPlant(seed=seed, **plant_settings)
+    noise = conv.NoiseEstimator()
+    trace = []
+
+    def get_one_rgb(rates, label="Running"):
+        rgb = plant.measure(rates)
+        noise.add_scans(plant.last_scans)
+        # judge convergence on the noise-free color, so noise cannot fake a success
+        trace.append([plant.evaluations, plant.clock, float(cc.delta_e(cc.rgb_to_lab(plant.last_true_rgb), target_lab))])
+        return rgb
+
+    def get_one_data(crate, mrate, wrate, yrate, prev_cost=1, iteration=0, algo="gd"):
+        rgb = get_one_rgb([crate, mrate, wrate, yrate])
+        return opt.cal_cost(target, rgb)
+
+    optimizer = optim.Optimizer(get_one_data, get_one_rgb, target, random_state=seed, noise=noise,
+                                **optimizer_settings)
+    error = None
+    # the loops print their progress, keep the benchmark output readable
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            optimizer.run(ALGOS[algo])
+        except Exception as msg: # e.g. the loop suggested invalid rates, the rig would fail as well
+            error = repr(msg)
+
+    return {'algo': algo, 'target': target.tolist(), 'seed': seed, 'trace': trace, 'error': error}
+
+
+def time_to_delta_e(trace, delta_e):
+    ''' wet evaluations and simulated time (sec) until delta E is first reached, None if never '''
+    for evaluation, clock, de in trace:
+        if de <= delta_e:
+            return evaluation, clock
+    return None, None
+
+
+def summarize(results, delta_e):
+    ''' per algorithm: success rate, median evaluations and time to reach delta E, median best delta E '''
+    summary = {}
+    for algo in sorted(set(r['algo'] for r in results)):
+        runs = [r for r in results if r['algo'] == algo]
+        reached = [time_to_delta_e(r['trace'], delta_e) for r in runs]
+        reached = [i for i in reached if i[0] is not None]
+        best = [min(de for _, _, de in r['trace']) for r in runs if len(r['trace'])]
+        summary[algo] = {'runs': len(runs),
+                         'success': len(reached)/len(runs),
+                         'median_evals': float(np.median([i[0] for i in reached])) if reached else None,
+                         'median_minutes': float(np.median([i[1] for i in reached]))/60 if reached else None,
+                         'median_best_delta_e': float(np.median(best)) if best else None,
+                         'total_evals': int(np.mean([len(r['trace']) for r in runs])),
+                         'errors': sum(r['error'] is not None for r in runs)}
+    return summary
+
+
+def run_benchmark(algos, targets, seeds, plant_settings=None, optimizer_settings=None, processes=None):
+    ''' run every algorithm on every target and seed in parallel processes '''
+    plant_settings = plant_settings if plant_settings is not None else {}
+    optimizer_settings = optimizer_settings if optimizer_settings is not None else {}
+    optimizer_settings.setdefault('init_rates', [5.0, 5.0, 600.0, 5.0])
+    trials = [(algo, list(target), seed, plant_settings, optimizer_settings)
+              for algo in algos for target in targets for seed in seeds]
+    with multiprocessing.Pool(processes) as pool:
+        return pool.map(run_trial, trials)
+
+
+def save_results(path, results, delta_e):
+    ''' write one row per trial to csv '''
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['algo', 'R', 'G', 'B', 'seed', 'evaluations', 'sim_seconds',
+                         'best_delta_e', 'evals_to_delta_e', 'sec_to_delta_e', 'error'])
+        for r in results:
+            evals, clock = time_to_delta_e(r['trace'], delta_e)
+            last = r['trace'][-1] if r['trace'] else [0, 0.0, None]
+            best = min(de for _, _, de in r['trace']) if r['trace'] else None
+            writer.writerow([r['algo'], *r['target'], r['seed'], last[0], last[1], best, evals, clock, r['error'] or ''])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark GD, BO and both on the simulated plant')
+    parser.add_argument('--algos', nargs='+', default=['gd', 'bo', 'both'], choices=list(ALGOS))
+    parser.add_argument('--targets', default='8', help='number of random reachable targets, or a palette file')
+    parser.add_argument('--seeds', type=int, default=3, help='number of seeds per target')
+    parser.add_argument('--delta-e', type=float, default=5.0, help='delta E counted as converged')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--csv', default=None, help='save one row per trial to this file')
+    # optimizer settings
+    parser.add_argument('--no-iter', type=int, default=21)
+    parser.add_argument('--learning-rate', type=float, default=0.6)
+    parser.add_argument('--kappa', type=float, default=10)
+    parser.add_argument('--small-step', type=float, default=30.0)
+    parser.add_argument('--gp-engine', default='sklearn', choices=['sklearn', 'incremental'])
+    parser.add_argument('--acquisition', default='ucb', choices=['ucb', 'cost_ei'])
+    # plant settings
+    parser.add_argument('--noise', type=float, default=1.5, help='rgb measurement noise (std)')
+    parser.add_argument('--jitter', type=float, default=0.01, help='relative pump jitter (std)')
+    parser.add_argument('--transit-scale', type=float, default=1.0, help='true/modelled transit time')
+    args = parser.parse_args()
+
+    if args.targets.isdigit():
+        targets = random_targets(int(args.targets), seed=0)
+    else:
+        targets = camp.load_targets(args.targets)
+
+    plant_settings = {'noise_rgb': args.noise, 'pump_jitter': args.jitter, 'transit_scale': args.transit_scale}
+    optimizer_settings = {'no_iter': args.no_iter, 'learning_rate': args.learning_rate,
+                          'kappa': args.kappa, 'small_step_size': args.small_step,
+                          'gp_engine': args.gp_engine, 'acquisition': args.acquisition}
+
+    results = run_benchmark(args.algos, targets, range(args.seeds), plant_settings, optimizer_settings,
+                            args.processes)
+
+    print('delta E <= '+str(args.delta_e)+' on '+str(len(targets))+' targets x '+str(args.seeds)+' seeds')
+    print('algo  runs  success  median evals  median minutes  median best dE  evals per run  errors')
+    for algo, s in summarize(results, args.delta_e).items():
+        print('%-5s %4d  %6.0f%%  %12s  %14s  %14s  %13d  %6d' % (
+            algo, s['runs'], 100*s['success'],
+            '-' if s['median_evals'] is None else '%.0f' % s['median_evals'],
+            '-' if s['median_minutes'] is None else '%.1f' % s['median_minutes'],
+            '-' if s['median_best_delta_e'] is None else '%.2f' % s['median_best_delta_e'],
+            s['total_evals'], s['errors']))
+
+    if args.csv:
+        save_results(args.csv, results, args.delta_e)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+''' Multi-target campaign: optimize a palette of target colors on one shared
+    surrogate of the rates -> RGB map.
+
+    Every measurement is evidence for every target. The next condition is the one
+    with the largest expected improvement summed over the whole palette.
+'''
+
+import csv
+import warnings
+import numpy as np
+
+import optimization_4steps as opt
+
+
+def load_targets(path):
+    ''' read target colors from a file, one "R, G, B" per line
+        a header line and lines starting with '#' are skipped
+    '''
+    targets = []
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) == 0 or row[0].strip().startswith('#'):
+                continue
+            try:
+                rgb = [float(i) for i in row[:3]]
+            except ValueError:
+                continue # header line
+            if len(rgb) != 3:
+                continue
+            targets.append(rgb)
+    targets = np.clip(np.array(targets), 0, 255)
+    if len(targets) == 0:
+        raise ValueError('no target colors found in ' + str(path))
+    return targets
+
+
+def random_rates(n, n_pumps=4, sum_rates=600, rng=None):
+    ''' uniformly random flow rates on the composition simplex, sum(rates)=sum_rates '''
+    rng = np.random.default_rng(rng)
+    return sum_rates*rng.dirichlet(np.ones(n_pumps), size=n)
+
+
+class SharedSurrogate():
+    ''' Gaussian process of the measured RGB over the composition fractions
+        (rates/sum(rates)), one output per color channel
+    '''
+
+    def __init__(self, random_state=None):
+        # sklearn is only imported when a campaign runs
+        from sklearn.gaussian_process import GaussianProcessRegressor
+        from sklearn.gaussian_process.kernels import ConstantKernel, Matern, WhiteKernel
+        kernel = ConstantKernel(1.0) * Matern(length_scale=0.3, length_scale_bounds=(1e-2, 1e1), nu=2.5) \
+            + WhiteKernel(noise_level=1e-2, noise_level_bounds=(1e-6, 1e0))
+        self.gp = GaussianProcessRegressor(kernel=kernel,
+                                           normalize_y=True,
+                                           n_restarts_optimizer=2,
+                                           random_state=random_state)
+
+    def fit(self, fractions, rgbs):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.gp.fit(fractions, rgbs)
+
+    def predict(self, fractions):
+        ''' mean and standard deviation of RGB, both of shape (n, 3) '''
+        mean, std = self.gp.predict(fractions, return_std=True)
+        return mean, std.reshape(mean.shape)
+
+    def sample(self, fractions, n_samples, rng):
+        ''' draw RGB samples of shape (n_samples, n, 3) from the marginal predictions '''
+        mean, std = self.predict(fractions)
+        noise = rng.standard_normal((n_samples,) + mean.shape)
+        return np.clip(mean + noise*std, 0, 255)
+
+
+class Campaign():
+    ''' optimize a list of target RGB colors with one shared model
+
+        targets: (T, 3) array of target rgb
+        sum_rates: constant sum of the flow rates
+        n_init: number of random conditions measured before the model is used
+        n_candidates: number of random compositions scored for each suggestion
+        n_samples: number of model samples used to estimate the expected improvement
+    '''
+
+    def __init__(self, targets, sum_rates=600, n_pumps=4, n_init=5, n_candidates=2000, n_samples=32,
+                 random_state=None):
+        self.targets = np.asarray(targets, dtype=float).reshape(-1, 3)
+        self.sum_rates = sum_rates
+        self.n_pumps = n_pumps
+        self.n_init = n_init
+        self.n_candidates = n_candidates
+        self.n_samples = n_samples
+        self.rng = np.random.default_rng(random_state)
+        self.surrogate = SharedSurrogate(random_state=random_state)
+
+        self.rates = [] # measured rates
+        self.rgbs = []  # measured rgb
+        self.best_cost = np.full(len(self.targets), np.inf)
+        self.best_idx = np.full(len(self.targets), -1)
+
+    def costs(self, rgb):
+        ''' MSE cost of one measured rgb against every target, same as opt.cal_cost '''
+        return np.square(self.targets - np.asarray(rgb, dtype=float)).mean(axis=1)
+
+    def register(self, rates, rgb):
+        ''' add one measurement, return its cost against every target '''
+        self.rates.append(np.asarray(rates, dtype=float))
+        self.rgbs.append(np.asarray(rgb, dtype=float))
+        costs = self.costs(rgb)
+        improved = costs < self.best_cost
+        self.best_cost[improved] = costs[improved]
+        self.best_idx[improved] = len(self.rates) - 1
+        return costs
+
+    def expected_improvement(self, rates):
+        ''' expected improvement of the best cost of each target, shape (n, T) '''
+        rates = np.atleast_2d(rates)
+        fractions = rates/rates.sum(axis=1, keepdims=True)
+        samples = self.surrogate.sample(fractions, self.n_samples, self.rng) # (S, n, 3)
+
+        # mean((rgb - t)^2) expanded so the (S, n, T, 3) difference is never built
+        sample_sq = np.square(samples).mean(axis=2)[:, :, None]
+        target_sq = np.square(self.targets).mean(axis=1)[None, None, :]
+        cross = samples @ self.targets.T * (2.0/3.0)
+        costs = sample_sq - cross + target_sq # (S, n, T)
+
+        improvement = np.maximum(self.best_cost[None, None, :] - costs, 0)
+        return improvement.mean(axis=0)
+
+    def suggest(self):
+        ''' next flow rates, chosen by the largest expected improvement over all targets '''
+        if len(self.rates) < self.n_init:
+            return random_rates(1, self.n_pumps, self.sum_rates, self.rng)[0]
+
+        fractions = np.array(self.rates)/np.sum(self.rates, axis=1, keepdims=True)
+        self.surrogate.fit(fractions, np.array(self.rgbs))
+
+        candidates = random_rates(self.n_candidates, self.n_pumps, self.sum_rates, self.rng)
+        total_ei = self.expected_improvement(candidates).sum(axis=1)
+        return candidates[np.argmax(total_ei)]
+
+    def best(self):
+        ''' best rates, rgb and cost found so far for each target '''
+        results = []
+        for target, cost, idx in zip(self.targets, self.best_cost, self.best_idx):
+            if idx < 0:
+                results.append([target, None, None, None])
+            else:
+                results.append([target, self.rates[idx], self.rgbs[idx], cost])
+        return results
+
+    def save(self, path):
+        ''' write the best condition of each target to csv '''
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['target_R', 'target_G', 'target_B', 'crate', 'mrate', 'wrate', 'yrate',
+                             'R', 'G', 'B', 'cost'])
+            for target, rates, rgb, cost in self.best():
+                if rates is None:
+                    writer.writerow([*target] + ['']*8)
+                else:
+                    writer.writerow([*target, *rates, *rgb, cost])
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+
+    # toy linear mixing model instead of the rig
+    pure = np.array([[0, 180, 230], [230, 40, 150], [255, 255, 255], [250, 230, 20]]) # c, m, w, y
+    def measure(rates):
+        fractions = np.asarray(rates)/np.sum(rates)
+        return fractions @ pure
+
+    palette = np.array([[120, 200, 230], [240, 140, 90], [200, 200, 200], [60, 120, 190]])
+    campaign = Campaign(palette, random_state=0)
+    for i in range(30):
+        rates = campaign.suggest()
+        campaign.register(rates, measure(rates))
+
+    for target, rates, rgb, cost in campaign.best():
+        print(target, np.round(rates), np.round(rgb), round(cost, 1), opt.cal_cost(target, rgb))
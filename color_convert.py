@@ -0,0 +1,63 @@
+''' Vectorized color conversions between sRGB (0-255) and CIE Lab (D65),
+    used wherever many colors are compared at once
+'''
+
+import numpy as np
+
+# sRGB (D65) linear rgb -> XYZ
+RGB_TO_XYZ = np.array([[0.4124564, 0.3575761, 0.1804375],
+                       [0.2126729, 0.7151522, 0.0721750],
+                       [0.0193339, 0.1191920, 0.9503041]])
+WHITE_D65 = np.array([0.95047, 1.00000, 1.08883])
+
+
+def rgb_to_lab(rgb):
+    ''' convert rgb 0-255 of shape (..., 3) to Lab of the same shape '''
+    rgb = np.asarray(rgb, dtype=float)/255.0
+    # undo the sRGB gamma
+    linear = np.where(rgb <= 0.04045, rgb/12.92, ((rgb + 0.055)/1.055)**2.4)
+    xyz = linear @ RGB_TO_XYZ.T / WHITE_D65
+
+    eps = 216/24389
+    kappa = 24389/27
+    f = np.where(xyz > eps, np.cbrt(xyz), (kappa*xyz + 16)/116)
+    L = 116*f[..., 1] - 16
+    a = 500*(f[..., 0] - f[..., 1])
+    b = 200*(f[..., 1] - f[..., 2])
+    return np.stack([L, a, b], axis=-1)
+
+
+def lab_to_rgb(lab):
+    ''' convert Lab of shape (..., 3) to rgb 0-255, clipped to the sRGB range '''
+    lab = np.asarray(lab, dtype=float)
+    fy = (lab[..., 0] + 16)/116
+    fx = fy + lab[..., 1]/500
+    fz = fy - lab[..., 2]/200
+    f = np.stack([fx, fy, fz], axis=-1)
+
+    eps = 216/24389
+    kappa = 24389/27
+    xyz = np.where(f**3 > eps, f**3, (116*f - 16)/kappa) * WHITE_D65
+    linear = xyz @ np.linalg.inv(RGB_TO_XYZ).T
+    linear = np.clip(linear, 0, 1)
+    rgb = np.where(linear <= 0.0031308, 12.92*linear, 1.055*linear**(1/2.4) - 0.055)
+    return 255.0*rgb
+
+
+def delta_e(lab1, lab2):
+    ''' CIE76 color difference between Lab colors, broadcast over leading axes '''
+    return np.linalg.norm(np.asarray(lab1, dtype=float) - np.asarray(lab2, dtype=float), axis=-1)
+
+
+def delta_e_rgb(rgb1, rgb2):
+    ''' CIE76 color difference between rgb 0-255 colors '''
+    return delta_e(rgb_to_lab(rgb1), rgb_to_lab(rgb2))
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    rgb = np.array([[255, 255, 255], [0, 0, 200], [166, 174, 176]])
+    lab = rgb_to_lab(rgb)
+    print(lab)
+    print(lab_to_rgb(lab))
+    print(delta_e_rgb(rgb[1], rgb[2]))
@@ -0,0 +1,219 @@
+''' Nearest-neighbour color index over the measured gamut
+
+    A k-d tree in Lab space over every measured (rates, rgb) pair, from the
+    explore scans (csv), the experiment results tables (Results.csv, or Log.log
+    for older experiments) and campaign results.
+    It returns the closest measured colors of a target and an initial guess of
+    the flow rates, so GD and BO can start next to a known neighbour instead of
+    the fixed init_rates.
+
+    Rates are kept in the pump order of the UI [crate, mrate, wrate, yrate].
+
+    Example:
+        python color_index.py --out color_index.npz "Nov3 Parameter Scan ratio_w 0.csv" Data
+        python color_index.py --out color_index.npz --query 120 80 150
+'''
+
+import argparse
+import csv
+import os
+import re
+import numpy as np
+
+import color_convert as cc
+import results_table as rt
+
+# explore_color_space.py saves [W, M, Y, C], the UI uses [C, M, W, Y]
+SCAN_TO_UI = [3, 1, 0, 2]
+
+
+def read_scan_csv(path):
+    ''' rates [crate, mrate, wrate, yrate] and rgb of an explore_color_space.py csv '''
+    rates, rgb = [], []
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 7 or row[0] == 'Qwater':
+                continue
+            rates.append([float(row[i]) for i in SCAN_TO_UI])
+            rgb.append([float(i) for i in row[4:7]])
+    return np.array(rates).reshape(-1, 4), np.array(rgb).reshape(-1, 3)
+
+
+def read_campaign_csv(path):
+    ''' best rates and rgb of each target of a Campaign_results.csv '''
+    rates, rgb = [], []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            if row['crate'] == '':
+                continue
+            rates.append([float(row[i]) for i in ['crate', 'mrate', 'wrate', 'yrate']])
+            rgb.append([float(row[i]) for i in ['R', 'G', 'B']])
+    return np.array(rates).reshape(-1, 4), np.array(rgb).reshape(-1, 3)
+
+
+def parse_numbers(text):
+    # numpy prints np.float64(1.0) in lists since numpy 2
+    text = re.sub(r'np\.\w+\(', '', text)
+    return [float(i) for i in re.findall(r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?', text)]
+
+
+def read_log(path):
+    ''' rates and averaged rgb of each condition of an experiment Log.log
+
+        pairs 'Start infusing with flow rates [...]' with the next 'Averaged Intensities Spectra RGB: [...]'
+    '''
+    rates, rgb = [], []
+    current = None
+    with open(path, errors='replace') as f:
+        for line in f:
+            if 'Start infusing with flow rates' in line:
+                numbers = parse_numbers(line.split('flow rates', 1)[1].split(' for ')[0])
+                current = numbers if len(numbers) == 4 else None
+            elif 'Averaged Intensities Spectra RGB:' in line and current is not None:
+                numbers = parse_numbers(line.split('RGB:', 1)[1])
+                if len(numbers) == 3:
+                    rates.append(current)
+                    rgb.append(numbers)
+                current = None
+    return np.array(rates).reshape(-1, 4), np.array(rgb).reshape(-1, 3)
+
+
+def read_results_csv(path):
+    ''' rates and rgb of every measured condition of an experiment Results.csv '''
+    table = rt.load(path)
+    rates = np.stack([table[i] for i in ['crate', 'mrate', 'wrate', 'yrate']], axis=-1)
+    rgb = np.stack([table[i] for i in ['R', 'G', 'B']], axis=-1)
+    return rates.reshape(-1, 4), rgb.reshape(-1, 3)
+
+
+def read_source(path):
+    ''' measured pairs of a scan csv, results or campaign csv, Log.log, or of every such file under a directory '''
+    if os.path.isdir(path):
+        # Results.csv holds the same conditions as the Log.log next to it
+        parts = [read_source(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files
+                 if name in ('Results.csv', 'Campaign_results.csv') or (name == 'Log.log' and 'Results.csv' not in files)]
+        parts = [p for p in parts if len(p[0])]
+        if not parts:
+            return np.empty((0, 4)), np.empty((0, 3))
+        return np.vstack([p[0] for p in parts]), np.vstack([p[1] for p in parts])
+    if os.path.basename(path) == 'Campaign_results.csv':
+        return read_campaign_csv(path)
+    if os.path.basename(path) == 'Results.csv':
+        return read_results_csv(path)
+    if path.endswith('.csv'):
+        return read_scan_csv(path)
+    return read_log(path)
+
+
+class ColorIndex():
+    ''' k-d tree in Lab space over measured conditions
+
+        rates: (n, 4) flow rates [crate, mrate, wrate, yrate]
+        rgb: (n, 3) measured rgb 0-255
+    '''
+
+    def __init__(self, rates=None, rgb=None):
+        self.rates = np.empty((0, 4)) if rates is None else np.asarray(rates, dtype=float).reshape(-1, 4)
+        self.rgb = np.empty((0, 3)) if rgb is None else np.asarray(rgb, dtype=float).reshape(-1, 3)
+        self.build()
+
+    def build(self):
+        from scipy.spatial import cKDTree # slow import, only needed once an index is built
+        # drop conditions without dye or with broken measurements
+        keep = (self.rates.sum(axis=1) > 0) & np.all(np.isfinite(self.rgb), axis=1)
+        self.rates, self.rgb = self.rates[keep], self.rgb[keep]
+        self.lab = cc.rgb_to_lab(self.rgb)
+        self.tree = cKDTree(self.lab) if len(self.lab) else None
+
+    def __len__(self):
+        return len(self.rates)
+
+    def add(self, rates, rgb):
+        ''' add measured conditions and rebuild the tree '''
+        self.rates = np.vstack([self.rates, np.asarray(rates, dtype=float).reshape(-1, 4)])
+        self.rgb = np.vstack([self.rgb, np.asarray(rgb, dtype=float).reshape(-1, 3)])
+        self.build()
+
+    def query(self, target, k=5):
+        ''' the k measured colors closest to the target rgb: (delta E, rates, rgb) '''
+        if self.tree is None:
+            return np.empty(0), np.empty((0, 4)), np.empty((0, 3))
+        k = min(k, len(self))
+        distance, idx = self.tree.query(cc.rgb_to_lab(target), k=k)
+        distance, idx = np.atleast_1d(distance), np.atleast_1d(idx)
+        return distance, self.rates[idx], self.rgb[idx]
+
+    def initial_guess(self, target, k=4, interpolate=True, sum_rates=600):
+        ''' flow rates to start an optimization at, None if the index is empty
+
+            interpolate: inverse delta E weighted mean of the compositions of the k
+                         nearest colors, otherwise the composition of the nearest one
+        '''
+        distance, rates, _ = self.query(target, k if interpolate else 1)
+        if len(rates) == 0:
+            return None
+        fractions = rates/rates.sum(axis=1, keepdims=True)
+        if not interpolate or distance[0] < 1e-9:
+            guess = fractions[0]
+        else:
+            weights = 1/distance
+            guess = weights @ fractions/weights.sum()
+        return sum_rates*guess
+
+    def save(self, path):
+        # write a temporary file next to it and swap it in, readers never see a partly written index
+        tmp_path = path+'.'+str(os.getpid())+'.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, rates=self.rates, rgb=self.rgb)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['rates'], data['rgb'])
+
+    @classmethod
+    def from_sources(cls, paths):
+        index = cls()
+        for path in paths:
+            rates, rgb = read_source(path)
+            index.add(rates, rgb)
+            print(str(len(rates))+' conditions from '+str(path))
+        return index
+
+
+def merge(path, rates, rgb):
+    ''' add measured conditions to the index in path (a new one if there is none yet), return the index '''
+    index = ColorIndex.load(path) if os.path.exists(path) else ColorIndex()
+    index.add(rates, rgb)
+    index.save(path)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query the color index of the measured gamut')
+    parser.add_argument('sources', nargs='*', help='scan csv, Log.log, Campaign_results.csv or data folders')
+    parser.add_argument('--out', default='color_index.npz', help='index file')
+    parser.add_argument('--query', nargs=3, type=float, default=None, metavar=('R', 'G', 'B'))
+    parser.add_argument('--k', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.sources:
+        index = ColorIndex.from_sources(args.sources)
+        index.save(args.out)
+        print(str(len(index))+' conditions in '+args.out)
+    else:
+        index = ColorIndex.load(args.out)
+
+    if args.query is not None:
+        for de, rates, rgb in zip(*index.query(args.query, args.k)):
+            print('delta E %6.2f  rgb %s  rates %s' % (de, np.round(rgb), np.round(rates, 1)))
+        print('initial guess: '+str(np.round(index.initial_guess(args.query), 1)))
+
+
+if __name__ == '__main__':
+    main()
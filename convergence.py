@@ -0,0 +1,127 @@
+''' Noise-aware convergence and early stopping of the optimization loops
+
+    NoiseEstimator pools the spread of the repeated scans of each measurement,
+    with the +-3 rgb precision of the rig (see explore_color_space.py) as a floor.
+    StoppingRule stops a loop when
+    - converged: the cost is within the noise of a perfect match
+    - stalled: the best cost did not improve by more than the noise for `patience` iterations
+    - out of gamut: a gamut query (e.g. gamut.Gamut.contains on the target) says
+      the target is unreachable. A pump at a low rate says nothing about it,
+      interior colors often need one.
+'''
+
+import numpy as np
+
+
+class NoiseEstimator():
+    ''' rgb measurement noise (standard deviation per channel of one averaged measurement)
+
+        precision: +-precision rgb is taken as 2 standard deviations, the lower bound of the noise
+    '''
+
+    def __init__(self, precision=3.0):
+        self.precision = precision
+        self.sum_sq = 0.0 # pooled sum of squared deviations of the scans
+        self.dof = 0      # pooled degrees of freedom
+        self.no_of_avg = 1
+
+    def add_scans(self, rgb_scans):
+        ''' add the per-scan rgb of one measurement, shape (no_of_avg, 3) '''
+        rgb_scans = np.asarray(rgb_scans, dtype=float)
+        if len(rgb_scans) < 2:
+            return
+        self.sum_sq += np.square(rgb_scans - rgb_scans.mean(axis=0)).sum()
+        self.dof += (len(rgb_scans) - 1)*rgb_scans.shape[1]
+        self.no_of_avg = len(rgb_scans)
+
+    @property
+    def sigma(self):
+        floor = self.precision/2
+        if self.dof == 0:
+            return floor
+        # noise of the average of no_of_avg scans
+        return max(np.sqrt(self.sum_sq/self.dof/self.no_of_avg), floor)
+
+    def cost_noise(self, cost):
+        ''' standard deviation of the MSE cost caused by the rgb noise
+            cost = mean((rgb-target)^2) over 3 channels, so d(cost) ~ 2/3*|rgb-target|*sigma
+        '''
+        sigma = self.sigma
+        return 2*sigma*np.sqrt(3*max(cost, 0))/3 + sigma**2
+
+
+class StoppingRule():
+    ''' decide when an optimization loop should stop
+
+        noise: NoiseEstimator shared with the acquisition
+        tolerance: number of noise standard deviations counted as no difference
+        patience: iterations without significant improvement before stalling
+        min_iter: never stop before this number of iterations
+        target_cost: optional absolute cost below which the loop stops (e.g. the old 150)
+        in_gamut: optional callable() -> False if the target is known to be unreachable
+    '''
+
+    def __init__(self, noise=None, tolerance=2.0, patience=4, min_iter=3, target_cost=None, in_gamut=None):
+        self.noise = noise if noise is not None else NoiseEstimator()
+        self.tolerance = tolerance
+        self.patience = patience
+        self.min_iter = min_iter
+        self.target_cost = target_cost
+        self.in_gamut = in_gamut
+
+        self.costs = []
+        self.best_cost = np.inf
+        self.best_rates = None
+        self.since_improved = 0
+        self.reason = None
+
+    def converged(self, cost):
+        # a perfect match measures cost ~ sigma^2, allow `tolerance` sigma per channel
+        if self.target_cost is not None and cost < self.target_cost:
+            return True
+        return cost <= (self.tolerance*self.noise.sigma)**2
+
+    def update(self, cost, rates=None):
+        ''' add the cost of one real step, return the reason to stop or None '''
+        self.costs.append(cost)
+
+        # improvement counts only if it is larger than the noise of the cost
+        if cost < self.best_cost - self.tolerance*self.noise.cost_noise(min(cost, self.best_cost)):
+            self.since_improved = 0
+        else:
+            self.since_improved += 1
+        if cost < self.best_cost:
+            self.best_cost = cost
+            self.best_rates = rates
+
+        if self.converged(cost):
+            self.reason = 'converged within measurement noise'
+        elif len(self.costs) < self.min_iter:
+            self.reason = None
+        elif self.in_gamut is not None and not self.in_gamut():
+            self.reason = 'target is outside the gamut'
+        elif self.since_improved >= self.patience:
+            self.reason = 'no improvement beyond measurement noise'
+        else:
+            self.reason = None
+        return self.reason
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    noise = NoiseEstimator()
+    rng = np.random.default_rng(0)
+    for i in range(10):
+        noise.add_scans(rng.normal([100, 120, 200], 3.0, size=(3, 3)))
+    print('sigma: ' + str(noise.sigma))
+
+    rule = StoppingRule(noise)
+    for cost in [3000, 1500, 600, 300, 280, 290, 270, 285, 275]:
+        print(cost, rule.update(cost, rates=[100, 200, 300, 0]))
+
+    # a target the gamut query puts out of reach
+    import gamut as gm
+    gamut = gm.Gamut.from_model(n=256)
+    rule = StoppingRule(noise, in_gamut=lambda: bool(gamut.contains([0, 255, 0], tolerance=3.0)))
+    for cost in [9000, 8000, 7900]:
+        print(cost, rule.update(cost))
@@ -0,0 +1,112 @@
+''' Dye- and time-cost-aware acquisition function for bayesian optimization
+
+    UCB treats every candidate as equally expensive. CostAwareEI divides the
+    expected improvement of a candidate by its predicted cost, so BO picks the
+    most information per second of rig time and per microlitre of solution:
+
+    seconds = transit (calc_time_to_travel) + overhead + flush
+    flush   = dispersion_tau*log(1 + distance/flush_tolerance)
+              distance: fraction of the composition that changes from the current condition
+    ul      = rates*seconds/60 pumped by each syringe
+    cost    = seconds + seconds_per_ul * sum(price*ul/remaining)
+              remaining: fraction of each syringe still full, so an emptying syringe gets expensive
+'''
+
+import math
+import warnings
+import numpy as np
+
+import RGB_Project_Automation as auto
+
+# syringes in the pump order [crate, mrate, wrate, yrate] (since JUL2023 demo)
+DIAMETER = [14.57, 14.57, 23.0, 14.57] # mm
+
+
+class CostAwareEI():
+    ''' expected improvement per unit cost, used as bo.suggest(CostAwareEI(...))
+
+        current: rates in the flow cell [crate, mrate, wrate, yrate], updated by observe()
+        xi: exploration margin of the expected improvement
+        sum_rates: total flow rate the suggested rates are scaled to (ul/min)
+        tube_dist, tube_dia, extra: transit model of calc_time_to_travel
+        overhead_sec: pump commands and spectra per measurement (sec)
+        dispersion_tau: time constant (sec) of the washout of the previous condition
+        flush_tolerance: fraction of the previous condition left once flushed
+        diameter: syringe diameters (mm)
+        stroke: usable plunger travel of the syringes (mm)
+        price: relative price of one ul from each syringe, water is cheap but its syringe still empties
+        seconds_per_ul: seconds of rig time one (priced) ul is worth
+    '''
+
+    def __init__(self, current, xi=0.0, sum_rates=600, tube_dist=200, tube_dia=0.254, extra=15,
+                 overhead_sec=1.1, dispersion_tau=5.0, flush_tolerance=0.01, diameter=None, stroke=60.0,
+                 price=None, seconds_per_ul=0.1):
+        self.xi = xi
+        self.sum_rates = sum_rates
+        self.tube_dist = tube_dist
+        self.tube_dia = tube_dia
+        self.extra = extra
+        self.overhead_sec = overhead_sec
+        self.dispersion_tau = dispersion_tau
+        self.flush_tolerance = flush_tolerance
+        diameter = DIAMETER if diameter is None else diameter
+        self.capacity = np.pi*(np.asarray(diameter, dtype=float)/2)**2*stroke # ul (mm^3)
+        self.price = np.asarray([1.0, 1.0, 0.1, 1.0] if price is None else price, dtype=float)
+        self.seconds_per_ul = seconds_per_ul
+
+        self.used = np.zeros(len(self.capacity)) # ul pumped from each syringe so far
+        self.current = self.scale(current)
+        # all suggestions are scaled to sum_rates, so the transit time is the same for every candidate
+        self.transit_sec = auto.calc_time_to_travel(self.current, tube_dist, tube_dia, extra)
+
+    def scale(self, rates):
+        rates = np.clip(np.asarray(rates, dtype=float), 0, None)
+        total = rates.sum(axis=-1, keepdims=True)
+        return self.sum_rates*rates/np.where(total > 0, total, 1)
+
+    def observe(self, rates):
+        ''' the rig ran rates: move the current condition and book the volume it used '''
+        rates = self.scale(rates)
+        self.used += rates*self.seconds(rates)/60
+        self.current = rates
+
+    def seconds(self, rates):
+        ''' predicted time (sec) to measure rates of shape (..., no_of_pumps) from the current condition '''
+        # smoothed |change| (within 1 ul/min), a kink at the current rates slows down the L-BFGS search
+        change = np.sqrt((rates - self.current)**2 + 1.0)
+        distance = 0.5*change.sum(axis=-1)/self.sum_rates
+        flush = self.dispersion_tau*np.log1p(distance/self.flush_tolerance)
+        return self.transit_sec + self.overhead_sec + flush
+
+    def cost(self, x):
+        ''' predicted cost (equivalent sec) of candidates x of shape (n, no_of_pumps) '''
+        rates = self.scale(x)
+        seconds = self.seconds(rates)
+        ul = rates*seconds[..., None]/60
+        remaining = np.clip(1 - self.used/self.capacity, 0.05, 1)
+        return seconds + self.seconds_per_ul*(ul*self.price/remaining).sum(axis=-1)
+
+    def utility(self, x, gp, y_max):
+        ''' same interface as bayes_opt UtilityFunction.utility '''
+        from scipy.special import ndtr # scipy only loads once BO runs
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            mean, std = gp.predict(x, return_std=True)
+        a = mean - y_max - self.xi
+        z = a/std
+        ei = a*ndtr(z) + std*np.exp(-0.5*z**2)/math.sqrt(2*math.pi)
+        return ei/self.cost(x)
+
+    def update_params(self):
+        pass
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    acquisition = CostAwareEI([5, 5, 600, 5])
+    candidates = np.array([[5, 5, 600, 5], [100, 100, 300, 100], [600, 0, 0, 0], [0, 0, 600, 0]])
+    print('cost (sec): ' + str(acquisition.cost(candidates)))
+    for i in range(20):
+        acquisition.observe([5, 5, 600, 5])
+    print('water syringe used (ul): ' + str(acquisition.used[2]))
+    print('cost (sec): ' + str(acquisition.cost(candidates)))
@@ -0,0 +1,512 @@
+''' Headless optimization engine of the RGB color optimization project
+
+    Runs one experiment (GD, BO, both or a campaign) on one rig from hardware
+    handles, a target and settings, without any UI. Progress is emitted as
+    events to the callbacks subscribed to them, the Tk app is one subscriber and
+    the command line below another:
+
+    status(message)                    progress message
+    plot(algo, iteration, cost, rgb)   one measured step
+    warning(title, message)            something the user should check (bubbles, gamut edge, ...)
+    finish()                           the loop completed, e.g. save the plot
+    done(result)                       the run is over, result of Engine.run
+
+    Callbacks run on the thread of Engine.run, a UI must hand them over to its
+    own thread. Each engine keeps its own state, only the scout steps draw from
+    the global numpy generator, so engines running at the same time should live
+    in separate processes to stay reproducible.
+
+    Example:
+        python engine.py --port COM3 --algo gd --target 120 80 150 --ref Reference.npy --bg Background.npy
+        python engine.py --port SIMULATED --algo gd --target 120 80 150 --ref now --bg now
+'''
+
+import argparse
+import os
+import threading
+import time
+import numpy as np
+
+from pump import Chain, Pump
+import RGB_Project_Automation as auto
+import optimization_4steps as opt
+import optimizers as optim
+import convergence as conv
+import color_index as ci
+import gamut as gm
+import cost_aware as ca
+import spectrometers as spm
+import acquisition as acq
+from prgm_logger import PrgmLogger
+
+EVENTS = ['status', 'plot', 'warning', 'finish', 'done']
+# command line name -> algorithm name of the UI
+ALGOS = {'gd': 'Gradient Descent', 'bo': 'Bayesian Optim', 'both': 'Both', 'campaign': 'Campaign'}
+# settings of a run and their defaults
+DEFAULTS = {'init_rates': [5.0, 5.0, 600.0, 5.0], # initial flow rates
+            'no_iter': 21, # max number of iterations
+            'no_iter_campaign': 150, # max number of measurements of a campaign
+            'no_of_avg': 3, # number of spectra to average before converting to an rgb_avg
+            'scans_to_average': 1, # detector scans averaged into each spectrum, on the device if it can
+            'boxcar_width': 0, # pixels on each side of the boxcar smoothing each spectrum, on the device if it can
+            'tube_dist': 200, # mm
+            'tube_dia': 0.254, # mm
+            'small_step_size': 30.0, # first size of small steps for each pump before a real step
+            'learning_rate': 0.6, # learning rate of the gradient descent optimization
+            'diffuse_time': 5, # sec, estimated time to sufficiently diffuse
+            'kappa': 10, # BO parameter to indicate how close the next parameters are sampled
+            'random_scout': False, # random scout steps size
+            'random_seed': None, # seed of the scout steps and BO, None: a new seed each run
+            'gp_engine': 'sklearn', # BO model: 'sklearn' or 'incremental'
+            'sparse_threshold': None, # incremental BO model: inducing points past this many observations,
+                                      # None: exact (about 500 keeps a suggestion under a second on large histories)
+            'bo_history': False, # preload the BO model with the colors of the color index (cost to the target)
+            'acquisition': 'ucb', # BO acquisition: 'ucb' or 'cost_ei'
+            'color_index_file': 'color_index.npz', # measured gamut, start next to the closest known color
+            'gamut_file': None, # color index (.npz) of a validated full-gamut scan to project unreachable targets onto,
+                                # None: keep the target and only warn
+            'project_target': True, # with a gamut_file: optimize the closest reachable color of an unreachable target,
+                                    # False: keep the target and stop early as out of gamut
+            'update_color_index': True} # add the measured colors to it (multi_rig.py merges them itself)
+
+
+def connect_pumps(port, diameter=ca.DIAMETER):
+    ''' pumps [crate, mrate, wrate, yrate] on the daisy chain at port, stopped, with their syringe diameters
+        (the simulated pumps on the port spectrometers.SIMULATED_PORT)
+    '''
+    if port == spm.SIMULATED_PORT:
+        pumps = spm.open_pumps(len(diameter))
+    else:
+        chain = Chain(port=port)
+        pumps = [Pump(chain, address=i) for i in range(len(diameter))]
+    for pump in pumps:
+        pump.stop()
+        time.sleep(0.1)
+    for pump, dia in zip(pumps, diameter):
+        pump.set_diameter(dia)
+    return pumps
+
+
+def connect_spectrometer(backend='seabreeze', continuous=True, serial_number=None):
+    ''' first available spectrometer of a backend (see spectrometers.BACKENDS), or the one with serial_number
+        continuous: scan back to back on a thread (acquisition.Acquisition), used in place of the device
+    '''
+    spec = spm.open_spectrometer(backend, serial_number)
+    return acq.Acquisition(spec).start() if continuous else spec
+
+
+def find_integ_time(spec, integ_time=10000):
+    ''' auto set the integration time (microsecond): max intensity within 55000-60000, at most 1 sec '''
+    spec.integration_time_micros(integ_time)
+    time.sleep(2)
+    intensities = spec.spectrum()[1]
+    while max(intensities) < 55000 and integ_time < 1000000:
+        integ_time += 10000
+        spec.integration_time_micros(integ_time)
+        time.sleep(2)
+        intensities = spec.spectrum()[1]
+        if max(intensities) > 60000:
+            integ_time -= 10000
+            spec.integration_time_micros(integ_time)
+            time.sleep(2)
+            spec.spectrum()
+            break
+    return integ_time
+
+
+class Engine():
+    ''' one optimization run on one rig
+
+        pumps: pumps [crate, mrate, wrate, yrate]
+        spec: spectrometer
+        wavelengths: wavelengths of spec
+        ref_spec, bg_spec: reference and background spectra
+        logger: PrgmLogger with a run folder (create('RGB'))
+        integ_time: integration time of spec (microsecond), logged only
+        settings: see DEFAULTS
+
+        An engine makes one run: stop() before run() aborts it, so a job cancelled while
+        its engine is made never starts.
+    '''
+
+    def __init__(self, pumps, spec, wavelengths, ref_spec, bg_spec, logger, integ_time=0, **settings):
+        unknown = set(settings) - set(DEFAULTS)
+        if unknown:
+            raise ValueError('unknown settings: '+str(sorted(unknown)))
+        self.pumps = pumps
+        self.spec = spec
+        self.wavelengths = wavelengths
+        self.ref_spec = ref_spec
+        self.bg_spec = bg_spec
+        self.logger = logger
+        self.integ_time = integ_time
+        self.settings = dict(DEFAULTS)
+        self.settings.update(settings)
+        self.callbacks = {event: [] for event in EVENTS}
+        self.stop_event = threading.Event() # never cleared, see the class docstring
+
+    def subscribe(self, event, callback):
+        ''' call callback(*args) on every event of that name '''
+        if event not in self.callbacks:
+            raise ValueError('unknown event: '+str(event))
+        self.callbacks[event].append(callback)
+
+    def emit(self, event, *args):
+        for callback in self.callbacks[event]:
+            callback(*args)
+
+    def stop(self):
+        ''' abort the run after the current condition (thread safe) '''
+        self.stop_event.set()
+
+    def configure_processing(self):
+        ''' set scans to average and boxcar width of the spectra, return where they run (acquisition.configure_processing) '''
+        s = self.settings
+        if hasattr(self.spec, 'set_processing'):
+            return self.spec.set_processing(s['scans_to_average'], s['boxcar_width'])
+        return acq.configure_processing(self.spec, s['scans_to_average'], s['boxcar_width'])
+
+    def project_target(self, target, gamut, project=False):
+        # warn about a target outside the gamut, optimize the closest reachable color instead if project
+        # (only on the gamut of a full scan: the measured colors cover a part of the gamut only)
+        if not gamut.ready:
+            return target
+        reachable, delta_e = gamut.nearest(target)
+        if not np.any(np.atleast_1d(delta_e) > 3.0):
+            return target
+        if not project:
+            self.emit('warning', 'Warning', 'Target may be outside the gamut measured so far (closest measured '
+                      'color '+str(np.round(reachable).astype(int).tolist())+'), optimizing the target as set')
+            self.logger.log('log','Target outside the measured colors by delta E '+str(delta_e)+', kept')
+            return target
+        target = np.round(reachable).astype(int)
+        self.emit('warning', 'Warning', 'Target is outside the scanned gamut, optimizing the closest reachable '
+                  'color '+str(target.tolist()))
+        self.logger.log('log','Target outside the scanned gamut by delta E '+str(delta_e)+', projected to '+str(target))
+        return target
+
+    def run(self, algo, target):
+        ''' run the algorithm (name of the UI, see ALGOS) to the target rgb (palette of a campaign)
+
+            returns {'target', 'aborted', 'optimal_rates_gd', 'min_gd_cost', 'optimal_rates_bo', 'min_bo_cost',
+                     'campaign' (campaign.Campaign or None), 'measured' ((rates, rgb) of every condition)}
+        '''
+        s = self.settings
+        logger = self.logger
+        target = np.array(target)
+
+        # create data folder
+        logger.create('Experiment')
+        logger.create('Data')
+        logger.create('Log')
+
+        result = {'target': target, 'aborted': False, 'campaign': None,
+                  'optimal_rates_gd': [0.0, 0.0, 0.0, 0.0], 'min_gd_cost': 100000,
+                  'optimal_rates_bo': [0.0, 0.0, 0.0, 0.0], 'min_bo_cost': 100000}
+
+        logger.log('log','Experiment START!')
+        logger.log('log', 'Spectra Integration Time: '+str(self.integ_time))
+        logger.log('log','Number of Spectra to Average RGB: '+str(s['no_of_avg']))
+        processing = self.configure_processing()
+        logger.log('log','Scan Processing: '+str(processing))
+        logger.log('log','Diffusion Time: '+str(s['diffuse_time'])+' sec')
+        logger.log('log','Initial Scout Step Size: '+str(s['small_step_size']))
+        logger.log('log','Target RGB: '+str(target))
+        # seed everything random in the loops, so the run can be replayed from its records (replay.py)
+        seed = s['random_seed'] if s['random_seed'] is not None else int(np.random.SeedSequence().entropy % 2**32)
+        np.random.seed(seed)
+        logger.log('log','Random Seed: '+str(seed))
+        logger.log('log','Random Scout Steps: '+str(s['random_scout']))
+        logger.log('log','Max Iterations: '+str(s['no_iter_campaign'] if algo == 'Campaign' else s['no_iter']))
+
+        # measurement noise, estimated from the repeated scans of every measurement
+        noise = conv.NoiseEstimator()
+
+        # colors measured so far
+        color_index = None
+        if os.path.exists(s['color_index_file']):
+            try:
+                color_index = ci.ColorIndex.load(s['color_index_file'])
+            except Exception as msg: # unreadable, the run starts from init_rates
+                self.emit('warning', 'Warning', 'Cannot read the color index '+s['color_index_file']+': '+str(msg))
+                logger.log('log','Color index unreadable: '+str(msg))
+        measured = [] # (rates, rgb) of this run, added to the color index
+        result['measured'] = measured
+
+        # gamut of the measured colors, warns about targets outside it and near its edge
+        gamut = gm.Gamut(color_index.rgb) if color_index is not None else gm.Gamut()
+        # a validated full scan covers the whole gamut, it decides whether a target is reachable
+        scan_gamut = gm.Gamut(ci.ColorIndex.load(s['gamut_file']).rgb) if s['gamut_file'] is not None else None
+        stopping = {}
+        if scan_gamut is not None and s['project_target']:
+            target = self.project_target(target, scan_gamut, project=True)
+        else:
+            target = self.project_target(target, gamut)
+            if scan_gamut is not None and scan_gamut.ready and algo != 'Campaign':
+                # the stopping rule ends the run after its first iterations if the target is out of reach
+                reachable = bool(scan_gamut.contains(target, tolerance=3.0))
+                stopping['in_gamut'] = lambda: reachable
+                logger.log('log','Target within the scanned gamut: '+str(reachable))
+        result['target'] = target
+
+        # start next to the closest measured color instead of the fixed initial rates
+        init_rates = s['init_rates']
+        if color_index is not None and algo != 'Campaign':
+            guess = color_index.initial_guess(target)
+            if guess is not None:
+                init_rates = list(guess)
+                logger.log('log','Initial Flowrates from Color Index: '+str(init_rates))
+
+        # algorithm, iteration and scout index of the next measurement (scout None: a real step), phase timings
+        step = {'algo': 'campaign' if algo == 'Campaign' else None, 'iteration': 0, 'scout': None,
+                'wait_sec': None, 'total_sec': None}
+
+        def abort():
+            self.emit('finish')
+            logger.log('log','Experiment aborted')
+            self.emit('status', "Experiment Aborted")
+            result['aborted'] = True
+
+        def get_one_rgb(rates, label="Running"):
+            ''' Run one condition and wait for its averaged rgb, None if aborted '''
+
+            rgb = []
+            start = time.time()
+            # stopped before this condition, e.g. before the run started
+            if self.stop_event.is_set():
+                abort()
+                return None
+
+            # recorded with the spectra of this condition in the spectral store
+            logger.set_context(condition=len(measured), rates=list(rates), integ_time=self.integ_time)
+
+            # create an automation  object
+            run_cond = auto.AcquireData(self.pumps,rates,s['tube_dist'],s['tube_dia'],self.spec,self.ref_spec,
+                                        self.bg_spec,self.wavelengths,s['no_of_avg'],logger,s['diffuse_time'],
+                                        None if hasattr(self.spec, 'set_processing') else processing)
+
+            # run one step
+            run_cond.run_one_cond()
+            self.emit('status', label+" at flow rates: "+str([int(i) for i in run_cond.rates])+' for '
+                      +str(int(run_cond.wait_sec))+' sec...')
+
+            # wait to complete one step and get the rgb values
+            while len(rgb) == 0:
+                # abort if stopped
+                if self.stop_event.is_set():
+                    run_cond.stop_timer()
+                    abort()
+                    return None
+                # get the average rgb values
+                rgb = run_cond.rgb_avg
+                time.sleep(0.01)
+
+            noise.add_scans(run_cond.rgb_scans)
+            step['wait_sec'] = run_cond.wait_sec
+            step['total_sec'] = time.time() - start
+
+            # scout steps and campaign measurements have no cost of their own
+            if step['scout'] is not None:
+                step['scout'] += 1
+                logger.log_result(step['algo'], step['iteration'], rates, rgb, scout=step['scout'],
+                                  wait_sec=step['wait_sec'], total_sec=step['total_sec'])
+            elif algo == 'Campaign':
+                logger.log_result('campaign', len(measured), rates, rgb,
+                                  wait_sec=step['wait_sec'], total_sec=step['total_sec'])
+            measured.append((list(run_cond.rates), list(rgb)))
+            return rgb
+
+        def get_one_data(crate, mrate, wrate, yrate, prev_cost=1, iteration=0, algo="gd"):
+            ''' Acquire one real data for GD
+                Target function for BO '''
+
+            rates = [crate, mrate, wrate, yrate]
+
+            logger.set_context(iteration=iteration)
+            step.update(algo=algo, iteration=iteration, scout=None)
+            rgb = get_one_rgb(rates)
+            if rgb is None:
+                return None
+
+            # calculate cost in MSE
+            cost = opt.cal_cost(target, rgb)
+            logger.log('log', 'Cost: ' + str(cost))
+            logger.log_result(algo, iteration, rates, rgb, cost=cost,
+                              wait_sec=step['wait_sec'], total_sec=step['total_sec'])
+            step['scout'] = 0 # the next get_one_rgb calls are scout steps of this iteration
+
+            self.emit('plot', algo, iteration, cost, rgb)
+
+            # update optimal rates for gd or bo
+            if cost < result['min_'+algo+'_cost']:
+                result['min_'+algo+'_cost'] = cost
+                result['optimal_rates_'+algo] = rates
+
+            # show a warning if the cost increased
+            if cost-prev_cost > 3000 and prev_cost > 1:
+                self.emit('warning', 'Warning', 'Cost increased. Please check if bubbles are stuck in the zcell')
+                logger.log('log','Cost increased. Warned user to check bubbles in the tube.')
+
+            # show a warning if the RGB is close to boundary
+            if gamut.ready:
+                near_boundary = gamut.near_edge(rgb)
+            else:
+                # no measured gamut yet, rgb boundaries of the original dye set
+                boundary1 = rgb[1] <= 85
+                boundary2 = rgb[2] > 180 and rgb[1] < 1.2*rgb[2] - 126
+                boundary3 = rgb[0] < 150 and rgb[1] < 220-0.9*rgb[0]
+                near_boundary = boundary1 or boundary2 or boundary3
+
+            if near_boundary and algo == 'gd':
+                self.emit('warning', 'Warning', 'The algorithm is reaching the boundary, it may not converge further.')
+                logger.log('log','Warned user the algorithm is reaching rgb boundary.')
+
+            return cost
+
+        # BO model of large histories: the measured colors of the color index, priced against this target
+        bo_history = None
+        if s['bo_history'] and color_index is not None and len(color_index) and algo in ('Bayesian Optim', 'Both'):
+            rates = 600*color_index.rates/color_index.rates.sum(axis=1, keepdims=True)
+            bo_history = (rates, opt.cal_cost_batch(target, color_index.rgb))
+            logger.log('log','BO History from Color Index: '+str(len(rates))+' conditions')
+        gp_settings = {}
+        if s['sparse_threshold'] is not None:
+            gp_settings['sparse_threshold'] = s['sparse_threshold']
+            logger.log('log','BO Sparse Threshold: '+str(s['sparse_threshold']))
+
+        # run the picked algorithm
+        optimizer = optim.Optimizer(get_one_data, get_one_rgb, target, init_rates,
+                                    no_iter=s['no_iter'],
+                                    no_iter_campaign=s['no_iter_campaign'],
+                                    learning_rate=s['learning_rate'],
+                                    small_step_size=s['small_step_size'],
+                                    kappa=s['kappa'],
+                                    random_scout=s['random_scout'],
+                                    random_state=seed,
+                                    gp_engine=s['gp_engine'],
+                                    gp_settings=gp_settings,
+                                    bo_history=bo_history,
+                                    acquisition=s['acquisition'],
+                                    noise=noise,
+                                    stopping=stopping,
+                                    logger=logger,
+                                    status=lambda message: self.emit('status', message),
+                                    finish=lambda: self.emit('finish'),
+                                    plot=lambda *point: self.emit('plot', *point))
+        try:
+            campaign = optimizer.run(algo)
+            if algo == 'Campaign':
+                result['campaign'] = campaign
+                campaign.save(os.path.join(logger.exp_path, 'Campaign_results.csv'))
+                logger.log('log','Campaign results saved')
+
+            # keep the color index up to date with this run
+            if measured and s['update_color_index']:
+                try:
+                    # read again, someone else may have added to it during the run
+                    color_index = ci.merge(s['color_index_file'], [m[0] for m in measured], [m[1] for m in measured])
+                    logger.log('log','Color index updated: '+str(len(color_index))+' conditions')
+                except Exception as msg: # an unreadable index is left as it is
+                    logger.log('log','Color index not updated: '+str(msg))
+        finally:
+            # Stop all pumps
+            auto.stop_all(self.pumps)
+            # make the data and logs of the experiment durable
+            logger.flush()
+        self.emit('done', result)
+        return result
+
+
+def load_spectrum(spec, source, background=False):
+    ''' wavelengths and spectrum of a saved .npy, or measured now with source 'now'
+        background: measure a background (lamp of a simulated rig off)
+    '''
+    wavelengths, spectrum = spm.measure_background(spec) if background else spec.spectrum()
+    if source != 'now':
+        spectrum = np.load(source)
+    return wavelengths, spectrum
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run one color optimization without the UI')
+    parser.add_argument('--port', required=True, help='serial port of the pump chain, SIMULATED for the simulated rig')
+    parser.add_argument('--algo', required=True, choices=list(ALGOS))
+    parser.add_argument('--target', nargs=3, type=int, default=None, help='target R G B')
+    parser.add_argument('--palette', default=None, help='target colors of a campaign (csv of R, G, B rows)')
+    parser.add_argument('--ref', required=True, help="reference spectrum .npy, or 'now' to measure it as the rig is")
+    parser.add_argument('--bg', required=True, help="background spectrum .npy, or 'now' to measure it as the rig is")
+    parser.add_argument('--integ-time', type=int, default=0, help='integration time (microsecond), 0: auto')
+    parser.add_argument('--no-iter', type=int, default=DEFAULTS['no_iter'])
+    parser.add_argument('--learning-rate', type=float, default=DEFAULTS['learning_rate'])
+    parser.add_argument('--kappa', type=float, default=DEFAULTS['kappa'])
+    parser.add_argument('--random-scout', action='store_true')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--gp-engine', default='sklearn', choices=['sklearn', 'incremental'])
+    parser.add_argument('--sparse-threshold', type=int, default=None,
+                        help='incremental BO model: inducing points past this many observations (default: exact)')
+    parser.add_argument('--bo-history', action='store_true',
+                        help='preload the BO model with the colors of the color index')
+    parser.add_argument('--acquisition', default='ucb', choices=['ucb', 'cost_ei'])
+    parser.add_argument('--gamut-file', default=None,
+                        help='color index .npz of a full-gamut scan, targets outside it are projected onto it')
+    parser.add_argument('--keep-target', action='store_true',
+                        help='with --gamut-file: keep a target outside it and stop early instead of projecting it')
+    parser.add_argument('--scans-to-average', type=int, default=DEFAULTS['scans_to_average'],
+                        help='detector scans averaged into each spectrum, on the spectrometer if it can')
+    parser.add_argument('--boxcar-width', type=int, default=DEFAULTS['boxcar_width'],
+                        help='boxcar smoothing of each spectrum (pixels on each side), on the spectrometer if it can')
+    args = parser.parse_args()
+
+    if args.algo == 'campaign':
+        import campaign as camp
+        if args.palette is None:
+            parser.error('--palette is required by a campaign')
+        target = camp.load_targets(args.palette)
+    elif args.target is None:
+        parser.error('--target is required')
+    else:
+        target = args.target
+
+    pumps = connect_pumps(args.port)
+    spec = connect_spectrometer(spm.backend_for_port(args.port))
+    integ_time = args.integ_time if args.integ_time > 0 else find_integ_time(spec)
+    spec.integration_time_micros(integ_time)
+    print('Integration time: '+str(integ_time)+' microsecond')
+    if hasattr(spec, 'set_processing'):
+        # reference and background averaged and smoothed as the spectra measured against them
+        print('Scan processing: '+str(spec.set_processing(args.scans_to_average, args.boxcar_width)))
+
+    logger = PrgmLogger()
+    logger.create('RGB')
+    wavelengths, bg_spec = load_spectrum(spec, args.bg, background=True)
+    logger.save_data('bg', bg_spec)
+    wavelengths, ref_spec = load_spectrum(spec, args.ref)
+    logger.save_data('ref', ref_spec)
+
+    engine = Engine(pumps, spec, wavelengths, ref_spec, bg_spec, logger, integ_time,
+                    no_iter=args.no_iter, learning_rate=args.learning_rate, kappa=args.kappa,
+                    random_scout=args.random_scout, random_seed=args.seed, gp_engine=args.gp_engine,
+                    sparse_threshold=args.sparse_threshold, bo_history=args.bo_history,
+                    acquisition=args.acquisition, scans_to_average=args.scans_to_average,
+                    boxcar_width=args.boxcar_width, gamut_file=args.gamut_file,
+                    project_target=not args.keep_target)
+    engine.subscribe('status', print)
+    engine.subscribe('warning', lambda title, message: print(title+': '+message))
+    engine.subscribe('plot', lambda algo, iteration, cost, rgb: print(
+        'iteration '+str(iteration)+' '+algo+': cost '+str(int(cost))+', rgb '+str(list(rgb))))
+
+    # run on a thread, so Ctrl+C stops the run cleanly after the current condition
+    thread = threading.Thread(target=engine.run, args=(ALGOS[args.algo], target), daemon=True)
+    thread.start()
+    try:
+        while thread.is_alive():
+            thread.join(0.5)
+    except KeyboardInterrupt:
+        print('Stopping after the current condition...')
+        engine.stop()
+        thread.join()
+    logger.writer.close()
+
+
+if __name__ == '__main__':
+    main()
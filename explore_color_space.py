@@ -1,150 +1,313 @@
+''' Parameter scan of the color space
 
-import tkinter as tk
-from tkinter import ttk
-import tkinter.colorchooser
-from serial.tools.list_ports import comports
-from matplotlib.ticker import MaxNLocator
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
+    Runs the ratio scan as a resumable job:
+    - every condition is appended to the csv (flushed and fsynced) as soon as it is measured
+    - on restart, conditions already in the csv are skipped (repeated ratios are
+      counted, so the repeats kept to check the precision are still measured)
+    - --start-index resumes from a given condition of the scan
+
+    Designs (see scan_designs.py):
+    - lattice: the [3,2,1,0] ratio loops, duplicate ratios removed unless --repeats
+    - sobol, lhs: --n space-filling conditions on the simplex
+    - adaptive: --n conditions added where the colors measured in the csv change fastest,
+      saved next to the csv (<csv>_adaptive.npy) and reloaded until all are measured, so a
+      restart resumes the same refinement
+    --water varies water as well, otherwise it stays at 0 as in the original scan
+    The conditions are run in the order with the least changeover between consecutive
+    conditions (see scan_ordering.py), --order loop keeps the design order.
+
+    Example:
+        python explore_color_space.py --csv "Nov3 Parameter Scan ratio_w 0.csv" --port COM8 --repeats
+        python explore_color_space.py --csv scan.csv --start-index 40 --ref ref.npy --bg bg.npy
+        python explore_color_space.py --csv scan.csv --design sobol --n 128 --water
+        python explore_color_space.py --csv scan.csv --design adaptive --n 32
+        python explore_color_space.py --self-test   (pure C, M, Y, W on the simulated rig)
+'''
+
+import argparse
 import os
 import time
 import datetime
-import math
 import numpy as np
 from numpy import save
-#import logging
-#import threading
-#from threading import Timer
-from scipy import interpolate
 import csv
+from collections import Counter
 
-
-from seabreeze.spectrometers import Spectrometer
-from colormath.color_objects import SpectralColor, CMYColor, sRGBColor
-from colormath.color_conversions import convert_color
-from pump import *
 import RGB_Project_Automation as auto
-import optimization_4steps as opt
-import RGB_Project_ScaleNewRates as scale
+import color_index as ci
+import scan_designs as designs
+import scan_ordering as ordering
 
+HEADER = ["Qwater", "Qmagenta", "Qyellow", "Qcyan", "R", "G", "B"]
+# pump of the simulated rig ([C, M, W, Y] as in the UI) for each scan column [W, M, Y, C]
+SIMULATED_PUMPS = list(np.argsort(ci.SCAN_TO_UI))
 
-# Connect to spectrometer
-spec = Spectrometer.from_first_available()
-print(spec)
 
-# acquire a spectrum
-# set integration time
-spec.integration_time_micros(1000000)  # 1.5 seconds
-spec.spectrum()
-spec.spectrum()
+def condition_key(rates):
+    # rates read back from the csv differ from the computed ones by the float formatting
+    return tuple(round(float(rate), 6) for rate in rates)
+
+
+def read_done(path):
+    ''' number of times each condition key is already saved in the csv '''
+    done = Counter()
+    if not os.path.exists(path):
+        return done
+    with open(path, newline='') as datacsv:
+        for row in csv.reader(datacsv):
+            if len(row) < len(HEADER) or row[0] == HEADER[0]:
+                continue
+            done[condition_key(row[:4])] += 1
+    return done
+
+
+def read_results(path):
+    ''' flow rates [W, M, Y, C] and rgb of the conditions saved in the csv '''
+    rates, rgb = [], []
+    if os.path.exists(path):
+        with open(path, newline='') as datacsv:
+            for row in csv.reader(datacsv):
+                if len(row) < len(HEADER) or row[0] == HEADER[0]:
+                    continue
+                rates.append([float(i) for i in row[:4]])
+                rgb.append([float(i) for i in row[4:7]])
+    return np.array(rates).reshape(-1, 4), np.array(rgb).reshape(-1, 3)
 
-if input("Scan reference"):
-    wavelengths, ref_intensities = spec.spectrum()
-    plt.plot(wavelengths, ref_intensities)
-    plt.xlabel('Wavelengths in (nm)')
-    plt.ylabel('Intensity in (a.u.)')
-    plt.show()
-    if input('save? [y/n]') == 'y':
-        title = input("save as title: ")
-        save(str(title)+'.npy',ref_intensities)
 
-if input("Scan background"):
-    wavelengths, bg_intensities = spec.spectrum()
-    plt.plot(wavelengths, bg_intensities)
+def adaptive_design_file(path):
+    return os.path.splitext(path)[0]+'_adaptive.npy'
+
+
+def pending(conditions, done):
+    ''' number of conditions not saved in the csv yet (repeated ratios counted) '''
+    seen = Counter()
+    left = 0
+    for rates in conditions:
+        key = condition_key(rates)
+        seen[key] += 1
+        left += seen[key] > done[key]
+    return left
+
+
+def scan_conditions(design, path, n=64, water=False, repeats=False, sum_rates=600, seed=0, order='tour'):
+    ''' flow rates [W, M, Y, C] of the scan, in scan order (the index of a condition is its position)
+
+        order: 'tour' minimizes the changeover between consecutive conditions, 'loop' keeps the design order
+    '''
+    explore_ratio = [3,2,1,0] # ratio of flowrates
+    if design == 'lattice':
+        conditions = designs.lattice(explore_ratio, explore_ratio if water else [0], sum_rates, unique=not repeats)
+        return conditions[ordering.order_conditions(conditions)] if order == 'tour' else conditions
+    fixed = None if water else {0: 0}
+    if design in ('sobol', 'lhs'):
+        conditions = designs.space_filling(n, design, 4, sum_rates, fixed, seed)
+        return conditions[ordering.order_conditions(conditions)] if order == 'tour' else conditions
+    if design == 'adaptive':
+        # resume the refinement of the first run, the csv now holds part of it
+        design_file = adaptive_design_file(path)
+        if os.path.exists(design_file):
+            conditions = np.load(design_file)
+            if pending(conditions, read_done(path)):
+                print('Resuming the adaptive design in '+design_file)
+                return conditions
+        # conditions already measured (skipped by run_scan) followed by the refinement
+        rates, rgb = read_results(path)
+        if len(rates) < 2:
+            raise ValueError('adaptive design needs a csv with measured conditions: '+path)
+        new = designs.refine(rates, rgb, n)
+        if not water:
+            new = new[new[:, 0] <= 0]
+        if order == 'tour' and len(new):
+            # continue from the last condition measured
+            new = new[ordering.order_conditions(new, start=rates[-1])]
+        conditions = np.vstack([rates, new])
+        np.save(design_file, conditions)
+        return conditions
+    raise ValueError('unknown design: '+str(design))
+
+
+def append_row(path, row):
+    ''' append one row and force it to disk, a crash loses at most the condition being measured '''
+    new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, 'a', newline='') as datacsv:
+        datawriter = csv.writer(datacsv, delimiter=',')
+        if new_file:
+            datawriter.writerow(HEADER + [datetime.datetime.now()])
+        datawriter.writerow(row)
+        datacsv.flush()
+        os.fsync(datacsv.fileno())
+
+
+def scan_reference(spec, name):
+    ''' interactive reference or background scan, as before the scan '''
+    import matplotlib.pyplot as plt # only the interactive scan plots
+    import spectrometers as spm
+    wavelengths, intensities = spm.measure_background(spec) if name == 'background' else spec.spectrum()
+    plt.plot(wavelengths, intensities)
     plt.xlabel('Wavelengths in (nm)')
     plt.ylabel('Intensity in (a.u.)')
     plt.show()
-    if input('save? [y/n]') == 'y':
+    if input('save '+name+'? [y/n]') == 'y':
         title = input("save as title: ")
-        save(str(title)+'.npy',bg_intensities)
+        save(str(title)+'.npy', intensities)
+    return wavelengths, intensities
 
 
-save('wavelength.npy',wavelengths)
+def measure(spec, pumps, rates, wavelengths, ref_intensities, bg_intensities, tube_dist, extra_waiting):
+    ''' run one condition and return its rgb '''
+    for i in range(4):
+        pumps[i].set_infuse_rate(rates[i])
 
+    #(keep the repeating rates ratio, e.g. 30:30:30:30 and 60:60:60:60
+    # to check the data precision. Precision error should be <+-3)
 
+    # run pumps
+    for pump in pumps:
+        pump.infuse()
+        time.sleep(0.1)
 
+    wait_time = auto.calc_time_to_travel(rates, tube_dist, 0.254, extra_waiting)
+    time.sleep(wait_time)
 
-# Connect to pumps
-chain = Chain(port='COM8')
-no_of_pumps = 4
-pumps = [Pump(chain, address=i) for i in range(no_of_pumps)]  #Create a list of pump objects
+    intensities = spec.spectrum()[1]
+    save('intensity_of_'+str(rates)+'.npy', intensities)
 
-# Set syringe diameter
-syr_dia = 14.57
-for pump in pumps:
-    pump.set_diameter(syr_dia)
+    transmittance = auto.to_transmittance(intensities, ref_intensities, bg_intensities)
+    return auto.transm_to_rgb(wavelengths, transmittance)
 
 
-# Set Constants
-explore_rates = [0, 30, 60, 90, 120, 150] # ul/min
-explore_ratio = [3,2,1,0] # ratio of flowrates
-tube_dist = 1000 #mm
-extra_waiting = 10 #sec
-sum_rates = 600 # constant sum flowrates
+def run_scan(spec, pumps, conditions, path, wavelengths, ref_intensities, bg_intensities,
+             start_index=0, tube_dist=1000, extra_waiting=10):
+    ''' measure the conditions from start_index on, skipping those already in the csv '''
+    done = read_done(path)
+    print(str(sum(done.values()))+' conditions already in '+path)
+    seen = Counter() # occurrences of each condition so far in the scan
+    index = start_index
+    try:
+        for index, rates in enumerate(conditions):
+            key = condition_key(rates)
+            seen[key] += 1
+            if index < start_index or seen[key] <= done[key]:
+                continue
+            print('Condition #'+str(index)+': '+str(rates))
+            rgb = measure(spec, pumps, rates, wavelengths, ref_intensities, bg_intensities, tube_dist, extra_waiting)
+            # save to csv
+            append_row(path, [*rates, *rgb])
+            done[key] += 1
+    except BaseException:
+        print('Scan interrupted at condition #'+str(index)+', rerun to resume (or --start-index '+str(index)+')')
+        raise
+    finally:
+        for pump in pumps:
+            pump.stop()
+            time.sleep(0.1)
+
+
+def check_simulated_scan():
+    ''' pure W, M, Y and C scan conditions on the simulated rig measure the expected hue '''
+    import tempfile
+    import spectrometers as spm
+    rig = spm.SimulatedRig(seed=0)
+    spec = spm.SimulatedSpectrometer(rig, seed=0)
+    pumps = spm.open_pumps(rig=rig, order=SIMULATED_PUMPS)
+    spec.integration_time_micros(40000)
+    wavelengths, bg_intensities = spm.measure_background(spec)
+    wavelengths, ref_intensities = spec.spectrum()
+    # name, scan rates [W, M, Y, C], check of the rgb
+    checks = [('water', [600, 0, 0, 0], lambda rgb: min(rgb) > 230),
+              ('magenta', [0, 600, 0, 0], lambda rgb: np.argmin(rgb) == 1),
+              ('yellow', [0, 0, 600, 0], lambda rgb: np.argmin(rgb) == 2),
+              ('cyan', [0, 0, 0, 600], lambda rgb: np.argmin(rgb) == 0)]
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp) # measure saves the intensities of each condition
+        try:
+            for name, rates, check in checks:
+                rgb = measure(spec, pumps, rates, wavelengths, ref_intensities, bg_intensities, 200, 1)
+                print('%-8s %s rgb %s' % (name, rates, np.asarray(rgb).tolist()))
+                assert check(rgb), name+' condition measured rgb '+str(np.asarray(rgb).tolist())
+        finally:
+            os.chdir(cwd)
+            for pump in pumps:
+                pump.stop()
+    print('simulated pump order ok')
 
-# Open Data csv
-with open('Nov3 Parameter Scan ratio_w 0.csv', 'w', newline='') as datacsv:
-    datawriter = csv.writer(datacsv, delimiter=',')
-    datawriter.writerow(["Qwater", "Qmagenta", "Qyellow", "Qcyan", "R", "G", "B", datetime.datetime.now()])
 
+def main():
+    from pump import Chain, Pump
+    import spectrometers as spm
 
-    # Set rates based on flowrates intervals
-    #for rate_W in explore_rates:
-    #    pumps[0].set_infuse_rate(rate_W)
-    #    for rate_M in explore_rates:
-    #        pumps[1].set_infuse_rate(rate_M)
-    #        for rate_Y in explore_rates:
-    #            pumps[2].set_infuse_rate(rate_Y)
-    #            for rate_C in explore_rates:
-    #                pumps[3].set_infuse_rate(rate_C)
+    parser = argparse.ArgumentParser(description='Resumable parameter scan of the color space')
+    parser.add_argument('--csv', default='Nov3 Parameter Scan ratio_w 0.csv')
+    parser.add_argument('--port', default='COM8', help='com port of the syringe pumps, SIMULATED for the simulated rig')
+    parser.add_argument('--integ-time', type=int, default=1000000,
+                        help='integration time (microsecond), about 40000 on the simulated rig')
+    parser.add_argument('--start-index', type=int, default=0, help='first condition of the scan to run')
+    parser.add_argument('--ref', default=None, help='reference spectrum .npy (default: scan it)')
+    parser.add_argument('--bg', default=None, help='background spectrum .npy (default: scan it)')
+    parser.add_argument('--design', default='lattice', choices=['lattice', 'sobol', 'lhs', 'adaptive'])
+    parser.add_argument('--n', type=int, default=64, help='number of conditions of sobol, lhs and adaptive')
+    parser.add_argument('--water', action='store_true', help='vary the water rate as well')
+    parser.add_argument('--repeats', action='store_true', help='keep repeated ratios to check the precision')
+    parser.add_argument('--seed', type=int, default=0, help='seed of sobol and lhs (keep it to resume)')
+    parser.add_argument('--order', default='tour', choices=['tour', 'loop'],
+                        help='tour: least changeover between consecutive conditions, loop: design order')
+    parser.add_argument('--self-test', action='store_true', help='check the scan pump order on the simulated rig')
+    args = parser.parse_args()
+    if args.self_test:
+        return check_simulated_scan()
 
-    # Set rates based on ratio intervals 
-    for W in [0]:
-        for M in explore_ratio:
-            for Y in explore_ratio:
-                for C in explore_ratio:
-                    if W+M+Y+C == 0:
-                        continue
-                    rates = [sum_rates/(W+M+Y+C)*i for i in [W, M, Y, C]]
+    # Set Constants
+    tube_dist = 1000 #mm
+    extra_waiting = 10 #sec
+    sum_rates = 600 # constant sum flowrates
+    conditions = scan_conditions(args.design, args.csv, args.n, args.water, args.repeats, sum_rates, args.seed,
+                                 args.order)
+    D = ordering.changeover_matrix(conditions)
+    print(str(len(conditions))+' conditions in the '+args.design+' scan, total changeover '
+          +str(round(ordering.path_length(np.arange(len(conditions)), D), 2)))
 
-                    for i in range(4):
-                        pumps[i].set_infuse_rate(rates[i])
-                    
+    # Connect to spectrometer
+    spec = spm.open_spectrometer(spm.backend_for_port(args.port))
+    print(spec)
 
-                    #(keep the repeating rates ratio, e.g. 30:30:30:30 and 60:60:60:60
-                    # to check the data precision. Precision error should be <+-3)
+    # acquire a spectrum
+    # set integration time
+    spec.integration_time_micros(args.integ_time)
+    spec.spectrum()
+    spec.spectrum()
+    wavelengths = spec.wavelengths()
 
-                    # run pumps
-                    for pump in pumps:
-                        pump.infuse()
-                        time.sleep(0.1)
+    if args.ref is not None:
+        ref_intensities = np.load(args.ref)
+    else:
+        input("Scan reference")
+        wavelengths, ref_intensities = scan_reference(spec, 'reference')
 
+    if args.bg is not None:
+        bg_intensities = np.load(args.bg)
+    else:
+        input("Scan background")
+        wavelengths, bg_intensities = scan_reference(spec, 'background')
 
-                    wait_time = auto.calc_time_to_travel(rates, tube_dist, 0.254, extra_waiting)
-                    time.sleep(wait_time)
+    save('wavelength.npy',wavelengths)
 
-                    intensities = spec.spectrum()[1]
-                    save('intensity_of_'+str(rates)+'.npy', intensities)
-            
-                    transmittance = (intensities-bg_intensities)/(ref_intensities-bg_intensities)
-                    # ignore transmittance out of range, which is due to the noise
-                    transmittance[transmittance>1]=1
-                    transmittance[transmittance<0]=0
+    # Connect to pumps
+    no_of_pumps = 4
+    if args.port == spm.SIMULATED_PORT:
+        pumps = spm.open_pumps(no_of_pumps, order=SIMULATED_PUMPS)
+    else:
+        chain = Chain(port=args.port)
+        pumps = [Pump(chain, address=i) for i in range(no_of_pumps)]  #Create a list of pump objects
 
-                    f = interpolate.interp1d(wavelengths,transmittance)
-                    wavelengths_new = np.arange(340, 840, 10)
-                    transmittance_new = f(wavelengths_new)
-                    spectral = SpectralColor(*transmittance_new,observer='10')
-                    rgb = convert_color(spectral, sRGBColor).get_upscaled_value_tuple()
-                    rgb = np.asarray(rgb)
-                    rgb[rgb>255]=255
+    # Set syringe diameter
+    syr_dia = 14.57
+    for pump in pumps:
+        pump.set_diameter(syr_dia)
 
-                    rgb_info = [*rates, *rgb]
+    run_scan(spec, pumps, conditions, args.csv, wavelengths, ref_intensities, bg_intensities,
+             args.start_index, tube_dist, extra_waiting)
 
-                    # save to csv
-                    datawriter.writerow(rgb_info)
 
-            
-for pump in pumps:
-    pump.stop()
-    time.sleep(0.1)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+''' Gamut of the rig: the color region reachable with the current dyes
+
+    Gamut is the convex hull in Lab space of measured (or modelled) colors.
+    It answers, for one color or a batch of shape (..., 3) rgb 0-255:
+    - contains: is the color reachable
+    - distance: signed delta E to the hull surface (negative inside)
+    - nearest: the closest reachable color
+
+    The hull is rebuilt whenever colors are added, e.g. after each run or when
+    the dyes change, so it never depends on hand-tuned rgb inequalities.
+'''
+
+import numpy as np
+
+import color_convert as cc
+
+
+def closest_on_triangles(p, A, B, C):
+    ''' closest point to p on each triangle (A[i], B[i], C[i]), shape (n_triangles, 3) '''
+    AB, AC = B - A, C - A
+    normal = np.cross(AB, AC)
+    normal /= np.linalg.norm(normal, axis=1, keepdims=True)
+    projection = p - ((p - A)*normal).sum(axis=1, keepdims=True)*normal
+
+    # barycentric coordinates of the projection
+    d00, d01, d11 = (AB*AB).sum(1), (AB*AC).sum(1), (AC*AC).sum(1)
+    AP = projection - A
+    d20, d21 = (AP*AB).sum(1), (AP*AC).sum(1)
+    denom = d00*d11 - d01**2
+    v = (d11*d20 - d01*d21)/denom
+    w = (d00*d21 - d01*d20)/denom
+    inside = (v >= 0) & (w >= 0) & (v + w <= 1)
+
+    # otherwise the closest point is on one of the edges
+    best = projection.copy()
+    best_dist = np.where(inside, np.linalg.norm(p - projection, axis=1), np.inf)
+    for P, Q in [(A, B), (B, C), (C, A)]:
+        PQ = Q - P
+        t = np.clip(((p - P)*PQ).sum(1)/(PQ*PQ).sum(1), 0, 1)
+        on_edge = P + t[:, None]*PQ
+        dist = np.linalg.norm(p - on_edge, axis=1)
+        closer = ~inside & (dist < best_dist)
+        best[closer], best_dist[closer] = on_edge[closer], dist[closer]
+    return best, best_dist
+
+
+class Gamut():
+    ''' convex hull in Lab space of the reachable colors
+
+        rgb: (n, 3) measured or modelled rgb 0-255
+    '''
+
+    def __init__(self, rgb=None):
+        self.rgb = np.empty((0, 3)) if rgb is None else np.asarray(rgb, dtype=float).reshape(-1, 3)
+        self.hull = None
+        self.build()
+
+    def build(self):
+        from scipy.spatial import ConvexHull, QhullError # slow import, only needed once a gamut is built
+        self.lab = cc.rgb_to_lab(self.rgb)
+        try:
+            self.hull = ConvexHull(self.lab)
+        except (QhullError, ValueError): # fewer than 4 colors, or all in a plane
+            self.hull = None
+            return
+        # unit normals and offsets: normal.x + offset is the signed distance to each facet plane
+        self.normals = self.hull.equations[:, :3]
+        self.offsets = self.hull.equations[:, 3]
+        self.triangles = self.lab[self.hull.simplices]
+
+    @property
+    def ready(self):
+        return self.hull is not None
+
+    def add(self, rgb):
+        ''' add measured colors and rebuild the hull '''
+        self.rgb = np.vstack([self.rgb, np.asarray(rgb, dtype=float).reshape(-1, 3)])
+        self.build()
+
+    def distance(self, rgb):
+        ''' signed distance (delta E) to the surface, negative inside
+
+            exact inside the hull, a lower bound of the distance outside
+        '''
+        lab = cc.rgb_to_lab(rgb)
+        return (lab @ self.normals.T + self.offsets).max(axis=-1)
+
+    def contains(self, rgb, tolerance=0.0):
+        ''' True for colors inside the gamut, or outside by at most tolerance (delta E) '''
+        return self.distance(rgb) <= tolerance
+
+    def near_edge(self, rgb, margin=3.0):
+        ''' True for colors within margin (delta E) of the surface or outside '''
+        return self.distance(rgb) >= -margin
+
+    def nearest(self, rgb):
+        ''' closest reachable rgb (the color itself if reachable) and its delta E from the color '''
+        rgb = np.asarray(rgb, dtype=float)
+        lab = cc.rgb_to_lab(rgb).reshape(-1, 3)
+        outside = (lab @ self.normals.T + self.offsets).max(axis=-1) > 0
+        nearest_lab = lab.copy()
+        delta_e = np.zeros(len(lab))
+        A, B, C = self.triangles[:, 0], self.triangles[:, 1], self.triangles[:, 2]
+        for i in np.flatnonzero(outside):
+            points, dist = closest_on_triangles(lab[i], A, B, C)
+            j = np.argmin(dist)
+            nearest_lab[i], delta_e[i] = points[j], dist[j]
+        nearest_rgb = np.where(outside[:, None], cc.lab_to_rgb(nearest_lab), rgb.reshape(-1, 3))
+        return nearest_rgb.reshape(rgb.shape), delta_e.reshape(rgb.shape[:-1])
+
+    @classmethod
+    def from_model(cls, model=None, n=1024, seed=0):
+        ''' gamut of a plant_simulator.MixingModel, from n compositions spread over the simplex '''
+        import plant_simulator as sim
+        import scan_designs as designs
+        model = model if model is not None else sim.MixingModel()
+        rates = designs.sobol(n, n_pumps=model.absorbance.shape[0], seed=seed)
+        return cls(model.rgb(rates))
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    import time
+
+    gamut = Gamut.from_model(n=512)
+    print('hull: '+str(len(gamut.hull.vertices))+' vertices, '+str(len(gamut.hull.simplices))+' facets')
+
+    targets = np.random.default_rng(0).uniform(0, 255, size=(10000, 3))
+    start = time.time()
+    inside = gamut.contains(targets)
+    print('contains: %.0f%% of random colors, %.1f us per color' % (100*inside.mean(), (time.time()-start)/len(targets)*1e6))
+
+    start = time.time()
+    nearest, delta_e = gamut.nearest(targets[:100])
+    print('nearest: %.2f ms per color, max distance after projection %.2e' % (
+        (time.time()-start)/100*1e3, gamut.distance(nearest).max()))
+    print(targets[:3].round(), nearest[:3].round(), delta_e[:3].round(1))
@@ -0,0 +1,84 @@
+''' Import-time budget of the project modules
+
+    Heavy libraries (bayes_opt, sklearn, scipy, seabreeze, colormath) and the
+    hardware are only loaded where a feature first needs them, so the tools
+    start fast. This script imports each module in a fresh interpreter, takes
+    the best of a few runs and compares it with its budget, so a top-level
+    import slipping back in is caught. Exits with 1 if a budget is exceeded.
+
+    Measured on the lab PC class of machine (numpy alone is ~60 ms), before and
+    after moving the heavy imports:
+        optimizers 942 -> 67 ms, engine 985 -> 79 ms, replay 993 -> 92 ms,
+        explore_color_space 1236 -> 72 ms, UI 1298 -> 413 ms (matplotlib and tk)
+
+    Example:
+        python import_budget.py
+        python import_budget.py --details optimizers
+'''
+
+import argparse
+import subprocess
+import sys
+
+UI = 'RGB_Project_UI_thread_Bayesian(DemoJul2023+optimalColor)'
+# module -> import time budget (ms)
+BUDGETS = {'RGB_Project_Automation': 250, 'optimizers': 300, 'plant_simulator': 250, 'benchmark': 300,
+           'replay': 300, 'archive_reader': 250, 'results_table': 250, 'spectral_store': 250,
+           'color_index': 250, 'gamut': 250, 'scan_designs': 250, 'explore_color_space': 300,
+           'campaign': 250, 'cost_aware': 250, 'spectrometers': 250, 'acquisition': 250, 'engine': 300, 'job_service': 300,
+           'multi_rig': 300, UI: 1000}
+MEASURE = "import importlib, time; t = time.perf_counter(); importlib.import_module(%r); print(time.perf_counter() - t)"
+
+
+def import_time(module, repeat=3):
+    ''' best import time (ms) of module in a fresh interpreter over repeat runs '''
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', MEASURE % module], capture_output=True, text=True)
+        if out.returncode != 0:
+            raise RuntimeError('cannot import '+module+':\n'+out.stderr)
+        times.append(1000*float(out.stdout.split()[-1]))
+    return min(times)
+
+
+def slowest_imports(module, n=15):
+    ''' (cumulative ms, name) of the n slowest imports made by module, from python -X importtime '''
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import importlib; importlib.import_module(%r)' % module],
+                         capture_output=True, text=True)
+    imports = []
+    for line in out.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line.split('|')
+            if cumulative.strip().isdigit():
+                imports.append((int(cumulative)/1000, name.rstrip()))
+    return sorted(imports, reverse=True)[:n]
+
+
+def check(budgets, repeat=3):
+    ''' {module: (ms, budget ms)} of every module in budgets '''
+    return {module: (import_time(module, repeat), budget) for module, budget in budgets.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of the project modules against their budget')
+    parser.add_argument('modules', nargs='*', help='modules to check (default: all budgeted modules)')
+    parser.add_argument('--repeat', type=int, default=3, help='imports per module, the best one counts')
+    parser.add_argument('--details', action='store_true', help='print the slowest imports of each module')
+    args = parser.parse_args()
+
+    budgets = {m: BUDGETS.get(m, 250) for m in args.modules} if args.modules else BUDGETS
+    over = []
+    for module, (ms, budget) in check(budgets, args.repeat).items():
+        ok = ms <= budget
+        print('%-26s %7.0f ms  (budget %d ms)%s' % (module[:26], ms, budget, '' if ok else '  OVER BUDGET'))
+        if not ok:
+            over.append(module)
+        if args.details or not ok:
+            for cumulative, name in slowest_imports(module):
+                print('    %7.1f ms  %s' % (cumulative, name))
+    print(str(len(budgets)-len(over))+'/'+str(len(budgets))+' modules within budget')
+    sys.exit(1 if over else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+''' Incremental Gaussian process for long-running BO campaigns
+
+    IncrementalGP is a drop-in for the scikit-learn GaussianProcessRegressor that
+    bayes_opt refits from scratch (O(n^3)) in every bo.suggest:
+    - new observations extend the Cholesky factor by a block update, O(n^2)
+    - kernel hyperparameters are refitted only every refit_every observations,
+      on at most max_refit_points of them
+    - optionally, past sparse_threshold observations it switches to an inducing-point
+      (DTC) approximation whose update and prediction cost does not grow with n.
+      Off by default: its predictions are worse than the exact GP's (see the test)
+'''
+
+import warnings
+import numpy as np
+from scipy.linalg import cholesky, cho_solve, solve_triangular, LinAlgError
+from scipy.special import ndtr
+from sklearn.gaussian_process import GaussianProcessRegressor
+from sklearn.gaussian_process.kernels import Matern
+from bayes_opt.constraint import ConstraintModel
+
+
+def safe_cholesky(K, jitter=1e-10, max_tries=6):
+    ''' lower Cholesky factor of K, adding diagonal jitter until K is positive definite '''
+    for i in range(max_tries):
+        try:
+            return cholesky(K + (jitter*10**i if i else 0)*np.eye(len(K)), lower=True)
+        except LinAlgError:
+            continue
+    raise LinAlgError('kernel matrix is not positive definite')
+
+
+class IncrementalGP():
+    ''' GP regressor with incremental Cholesky updates and an optional sparse mode
+
+        kernel: initial kernel, Matern(nu=2.5) as used by bayes_opt
+        alpha: noise added to the diagonal of the kernel matrix (exact mode)
+        refit_every: refit the kernel hyperparameters every k new observations
+        max_refit_points: max number of observations used for a hyperparameter refit
+        sparse_threshold: switch to the inducing-point approximation past this size (None: never)
+        n_inducing: number of inducing points of the sparse mode
+        sparse_noise: noise variance (of the normalized target) of the sparse mode
+    '''
+
+    def __init__(self, kernel=None, alpha=1e-6, refit_every=10, max_refit_points=300, sparse_threshold=None,
+                 n_inducing=200, sparse_noise=1e-3, n_restarts_optimizer=5, random_state=None):
+        self.kernel = kernel if kernel is not None else Matern(nu=2.5)
+        self.alpha = alpha
+        self.refit_every = refit_every
+        self.max_refit_points = max_refit_points
+        self.sparse_threshold = sparse_threshold
+        self.n_inducing = n_inducing
+        self.sparse_noise = sparse_noise
+        self.n_restarts_optimizer = n_restarts_optimizer
+        self.rng = random_state if isinstance(random_state, np.random.RandomState) \
+            else np.random.RandomState(random_state)
+
+        self.kernel_ = None # kernel with fitted hyperparameters
+        self.X_train_ = None
+        self.y_train_ = None
+        self.n_at_refit = 0
+        self.sparse = False
+
+    # ------------------------- fitting -------------------------
+    def fit(self, X, y):
+        ''' fit to X, y; X extending the previous X by new rows is an incremental update '''
+        X = np.asarray(X, dtype=float)
+        y = np.asarray(y, dtype=float).ravel()
+        self.n_features_in_ = X.shape[1]
+
+        n_old = 0 if self.X_train_ is None else len(self.X_train_)
+        extends = 0 < n_old <= len(X) and np.array_equal(X[:n_old], self.X_train_) \
+            and np.array_equal(y[:n_old], self.y_train_)
+
+        if self.kernel_ is None or len(X) - self.n_at_refit >= self.refit_every or len(X) < self.n_at_refit:
+            self.refit_hyperparameters(X, y)
+            self.rebuild(X, y)
+        elif not extends:
+            self.rebuild(X, y)
+        elif len(X) > n_old:
+            self.append(X[n_old:], y[n_old:])
+        return self
+
+    def refit_hyperparameters(self, X, y):
+        ''' optimize the kernel hyperparameters with scikit-learn on a subset of the data '''
+        if len(X) > self.max_refit_points:
+            # keep the best points, the rest at random
+            n_best = self.max_refit_points//4
+            best = np.argsort(y)[-n_best:]
+            rest = np.setdiff1d(np.arange(len(X)), best)
+            idx = np.concatenate([best, self.rng.choice(rest, self.max_refit_points - n_best, replace=False)])
+        else:
+            idx = np.arange(len(X))
+        gp = GaussianProcessRegressor(kernel=self.kernel if self.kernel_ is None else self.kernel_,
+                                      alpha=self.alpha,
+                                      normalize_y=True,
+                                      n_restarts_optimizer=self.n_restarts_optimizer,
+                                      random_state=self.rng)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            gp.fit(X[idx], y[idx])
+        self.kernel_ = gp.kernel_
+        self.n_at_refit = len(X)
+
+        # the target normalization is frozen until the next refit, so updates stay exact
+        self.y_mean = y.mean()
+        self.y_std = y.std() if y.std() > 0 else 1.0
+
+    def rebuild(self, X, y):
+        ''' factorize from scratch '''
+        self.X_train_ = X.copy()
+        self.y_train_ = y.copy()
+        y_norm = (y - self.y_mean)/self.y_std
+        self.sparse = self.sparse_threshold is not None and len(X) > self.sparse_threshold
+        if self.sparse:
+            self.choose_inducing(X, y)
+            Kmn = self.kernel_(self.Z, X)
+            self.A = self.sparse_noise*self.Kmm + Kmn @ Kmn.T
+            self.b = Kmn @ y_norm
+            self.solve_sparse()
+        else:
+            K = self.kernel_(X) + self.alpha*np.eye(len(X))
+            self.L = safe_cholesky(K)
+            self.alpha_ = cho_solve((self.L, True), y_norm)
+
+    def append(self, X_new, y_new):
+        ''' add new observations without refactorizing '''
+        X = np.vstack([self.X_train_, X_new])
+        y = np.concatenate([self.y_train_, y_new])
+        y_new_norm = (y_new - self.y_mean)/self.y_std
+
+        if self.sparse:
+            Kmb = self.kernel_(self.Z, X_new)
+            self.A += Kmb @ Kmb.T
+            self.b += Kmb @ y_new_norm
+            self.X_train_, self.y_train_ = X, y
+            self.solve_sparse()
+            return
+
+        if self.sparse_threshold is not None and len(X) > self.sparse_threshold:
+            self.rebuild(X, y)
+            return
+
+        # block Cholesky update: [[L, 0], [L21, L22]]
+        K_ob = self.kernel_(self.X_train_, X_new)
+        K_bb = self.kernel_(X_new) + self.alpha*np.eye(len(X_new))
+        L21 = solve_triangular(self.L, K_ob, lower=True).T
+        try:
+            L22 = cholesky(K_bb - L21 @ L21.T, lower=True)
+        except LinAlgError:
+            self.rebuild(X, y)
+            return
+        n_old, n_new = len(self.L), len(X_new)
+        L = np.zeros((n_old + n_new, n_old + n_new))
+        L[:n_old, :n_old] = self.L
+        L[n_old:, :n_old] = L21
+        L[n_old:, n_old:] = L22
+        self.L = L
+        self.X_train_, self.y_train_ = X, y
+        self.alpha_ = cho_solve((self.L, True), (y - self.y_mean)/self.y_std)
+
+    def choose_inducing(self, X, y):
+        ''' inducing points: the best observations plus a random subset of the rest '''
+        m = min(self.n_inducing, len(X))
+        n_best = m//4
+        best = np.argsort(y)[-n_best:] if n_best else np.array([], dtype=int)
+        rest = np.setdiff1d(np.arange(len(X)), best)
+        idx = np.concatenate([best, self.rng.choice(rest, m - n_best, replace=False)])
+        self.Z = X[idx].copy()
+        self.Kmm = self.kernel_(self.Z) + 1e-8*np.eye(m)
+        self.Lmm = safe_cholesky(self.Kmm)
+
+    def solve_sparse(self):
+        self.LA = safe_cholesky(self.A)
+        self.w = cho_solve((self.LA, True), self.b)
+
+    # ------------------------- prediction -------------------------
+    def predict(self, X, return_std=False):
+        ''' posterior mean (and standard deviation) at X, same interface as scikit-learn '''
+        X = np.asarray(X, dtype=float)
+        if self.sparse:
+            Ksm = self.kernel_(X, self.Z)
+            mean = Ksm @ self.w
+            if return_std:
+                v = solve_triangular(self.Lmm, Ksm.T, lower=True)
+                u = solve_triangular(self.LA, Ksm.T, lower=True)
+                var = self.kernel_.diag(X) - np.sum(v**2, axis=0) + self.sparse_noise*np.sum(u**2, axis=0)
+        else:
+            Ks = self.kernel_(X, self.X_train_)
+            mean = Ks @ self.alpha_
+            if return_std:
+                v = solve_triangular(self.L, Ks.T, lower=True)
+                var = self.kernel_.diag(X) - np.sum(v**2, axis=0)
+
+        mean = mean*self.y_std + self.y_mean
+        if return_std:
+            return mean, np.sqrt(np.clip(var, 1e-12, None))*self.y_std
+        return mean
+
+
+class IncrementalConstraintModel(ConstraintModel):
+    ''' bayes_opt ConstraintModel on IncrementalGP
+
+        predict() evaluates the probability of feasibility with vectorized normal cdfs,
+        bayes_opt builds a frozen scipy.stats distribution on every call, which
+        dominates the acquisition optimization once the GP itself is fast
+    '''
+
+    def __init__(self, fun, lb, ub, random_state=None, **settings):
+        super().__init__(fun, lb, ub, random_state=random_state)
+        self._model = [IncrementalGP(random_state=random_state, **settings) for _ in range(len(self._lb))]
+
+    def predict(self, X):
+        X_shape = X.shape
+        X = X.reshape((-1, self._model[0].n_features_in_))
+        result = np.ones(X.shape[0])
+        for j, gp in enumerate(self._model):
+            y_mean, y_std = gp.predict(X, return_std=True)
+            p_lower = ndtr((self._lb[j] - y_mean)/y_std) if self._lb[j] != -np.inf else 0
+            p_upper = ndtr((self._ub[j] - y_mean)/y_std) if self._ub[j] != np.inf else 1
+            result = result * (p_upper - p_lower)
+        return result.reshape(X_shape[:-1])
+
+
+def use_incremental_gp(bo, **settings):
+    ''' swap the GPs of a bayes_opt BayesianOptimization (and its constraint model) for IncrementalGP '''
+    bo._gp = IncrementalGP(random_state=bo._random_state, **settings)
+    if bo.is_constrained:
+        constraint = bo.constraint
+        bo._space._constraint = IncrementalConstraintModel(constraint.fun, constraint.lb, constraint.ub,
+                                                           random_state=bo._random_state, **settings)
+    return bo
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    import time
+
+    rng = np.random.RandomState(0)
+    f = lambda X: -np.square(X/600 - [0.2, 0.3, 0.4, 0.1]).sum(axis=1)*1e4
+    X = rng.uniform(0, 600, size=(3000, 4))
+    y = f(X) + rng.normal(0, 1, len(X))
+    X_test = rng.uniform(0, 600, size=(10000, 4))
+
+    # exact (default) and sparse past 300 observations
+    for gp in [IncrementalGP(random_state=0), IncrementalGP(sparse_threshold=300, random_state=0)]:
+        for n in [50, 51, 52, 299, 300, 301, 1000, 3000]:
+            start = time.time()
+            gp.fit(X[:n], y[:n])
+            mean, std = gp.predict(X_test, return_std=True)
+            rmse = np.sqrt(np.mean((mean - f(X_test))**2))
+            print('n=%5d sparse=%d fit+predict(10000) %.3f sec, rmse %.1f' % (n, gp.sparse, time.time()-start, rmse))
+
+    # exact incremental update equals refactorizing
+    a = IncrementalGP(refit_every=1000, sparse_threshold=None, random_state=0).fit(X[:40], y[:40])
+    b = IncrementalGP(refit_every=1000, sparse_threshold=None, random_state=0).fit(X[:40], y[:40])
+    a.fit(X[:60], y[:60])
+    b.rebuild(X[:60], y[:60])
+    print('incremental == rebuild:', np.allclose(a.predict(X_test[:100]), b.predict(X_test[:100])))
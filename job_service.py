@@ -0,0 +1,399 @@
+''' Local job service that keeps the rig busy without the UI
+
+    Targets are submitted over a small JSON API on localhost and kept in a
+    persistent priority queue (sqlite), so queued jobs survive a restart. One
+    worker runs the jobs back to back through engine.Engine, highest priority
+    first (then oldest), and flushes the lines with water after each job.
+
+    API:
+        POST   /jobs        {"algo": "gd", "target": [R, G, B], "priority": 0, "settings": {"no_iter": 21}}
+                            ("palette": [[R, G, B], ...] instead of "target" for a campaign) -> {"id": ...}
+        GET    /jobs        every job (?status=queued for one status)
+        GET    /jobs/<id>   one job, with the progress of a running job and the result of a done job
+        DELETE /jobs/<id>   cancel a queued job, or stop a running one after its current condition
+        GET    /status      running job and number of queued jobs
+
+    Job status: queued, running, done, failed, cancelled. Jobs found running
+    at start (the service was stopped during the run) are queued again.
+
+    Example:
+        python job_service.py --port COM3 --ref Reference.npy --bg Background.npy
+        curl -X POST localhost:8765/jobs -d '{"algo": "gd", "target": [120, 80, 150]}'
+'''
+
+import argparse
+import datetime
+import json
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+
+import RGB_Project_Automation as auto
+import engine as eng
+import spectrometers as spm
+from prgm_logger import PrgmLogger
+
+COLUMNS = ['id', 'priority', 'status', 'algo', 'target', 'settings', 'created', 'started', 'finished',
+           'progress', 'result', 'error']
+JSON_COLUMNS = ['target', 'settings', 'progress', 'result']
+
+
+def to_json(value):
+    # numpy values of results and progress
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('not serializable: '+repr(value))
+
+
+def dumps(value):
+    return json.dumps(value, default=to_json)
+
+
+class JobQueue():
+    ''' persistent priority queue of jobs in a sqlite file, safe to use from several threads and processes
+
+        recover: queue the jobs left running again, only the first process opening the queue should
+    '''
+
+    def __init__(self, path='jobs.sqlite', recover=True):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, priority INTEGER, '
+                        'status TEXT, algo TEXT, target TEXT, settings TEXT, created TEXT, started TEXT, '
+                        'finished TEXT, progress TEXT, result TEXT, error TEXT)')
+        # a job running when the service stopped is run again
+        if recover:
+            self.db.execute("UPDATE jobs SET status = 'queued', started = NULL, progress = NULL "
+                            "WHERE status = 'running'")
+        self.db.commit()
+
+    def row_to_job(self, row):
+        job = dict(zip(COLUMNS, row))
+        for name in JSON_COLUMNS:
+            job[name] = json.loads(job[name]) if job[name] is not None else None
+        return job
+
+    def submit(self, algo, target, priority=0, settings=None):
+        ''' queue a job, return its id '''
+        with self.lock:
+            cursor = self.db.execute('INSERT INTO jobs (priority, status, algo, target, settings, created) '
+                                     'VALUES (?, ?, ?, ?, ?, ?)',
+                                     (int(priority), 'queued', algo, dumps(target), dumps(settings or {}),
+                                      datetime.datetime.now().isoformat()))
+            self.db.commit()
+            return cursor.lastrowid
+
+    def get(self, job_id):
+        ''' job of that id, None if there is none '''
+        with self.lock:
+            row = self.db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self.row_to_job(row) if row is not None else None
+
+    def list(self, status=None):
+        ''' every job (of one status), in the order they will run '''
+        query = 'SELECT * FROM jobs' + (' WHERE status = ?' if status else '') + ' ORDER BY priority DESC, id'
+        with self.lock:
+            rows = self.db.execute(query, (status,) if status else ()).fetchall()
+        return [self.row_to_job(row) for row in rows]
+
+    def next(self):
+        ''' take the next queued job (highest priority, then oldest) and mark it running, None if none '''
+        with self.lock:
+            while True:
+                row = self.db.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY priority DESC, id "
+                                      "LIMIT 1").fetchone()
+                if row is None:
+                    return None
+                # only claimed if no other process took it in between
+                claimed = self.db.execute("UPDATE jobs SET status = 'running', started = ? "
+                                          "WHERE id = ? AND status = 'queued'",
+                                          (datetime.datetime.now().isoformat(), row[0])).rowcount
+                self.db.commit()
+                if claimed:
+                    break
+        job = self.row_to_job(row)
+        job['status'] = 'running'
+        return job
+
+    def update(self, job_id, **fields):
+        ''' set columns of a job (json columns are serialized) '''
+        for name in fields:
+            if name not in COLUMNS[1:]:
+                raise ValueError('unknown column: '+str(name))
+        values = [dumps(value) if name in JSON_COLUMNS else value for name, value in fields.items()]
+        with self.lock:
+            self.db.execute('UPDATE jobs SET '+', '.join(name+' = ?' for name in fields)+' WHERE id = ?',
+                            values + [job_id])
+            self.db.commit()
+
+    def cancel(self, job_id):
+        ''' cancel a queued job, return the status it had (None if there is no such job) '''
+        with self.lock:
+            row = self.db.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()
+            if row is not None and row[0] == 'queued':
+                self.db.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ?",
+                                (datetime.datetime.now().isoformat(), job_id))
+                self.db.commit()
+        return row[0] if row is not None else None
+
+    def close(self):
+        self.db.close()
+
+
+class JobService():
+    ''' run the queued jobs back to back on one rig
+
+        jobs: JobQueue
+        make_engine: callable(settings) returning an engine.Engine of the rig
+        flush: callable() run after each job, e.g. water through the lines
+        poll_sec: seconds between two looks at an empty queue
+    '''
+
+    def __init__(self, jobs, make_engine, flush=None, poll_sec=1.0):
+        self.jobs = jobs
+        self.make_engine = make_engine
+        self.flush = flush if flush is not None else (lambda: None)
+        self.poll_sec = poll_sec
+        self.current = None # running job
+        self.engine = None # engine of the running job
+        self.cancelled = set() # ids of running jobs stopped by a cancel
+        self.shutdown = threading.Event()
+        self.thread = threading.Thread(target=self.work, name='JobService', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        ''' stop the running job after its current condition and end the worker '''
+        self.shutdown.set()
+        if self.engine is not None:
+            self.engine.stop()
+        self.thread.join()
+
+    def submit(self, request):
+        ''' queue a job from an API request dict, return its id (ValueError if invalid) '''
+        return submit_request(self.jobs, request)
+
+    def cancel(self, job_id):
+        ''' cancel a queued job or stop the running one, return the status it had '''
+        status = self.jobs.cancel(job_id)
+        if status == 'running':
+            self.stop_job(job_id)
+        return status
+
+    def stop_job(self, job_id):
+        ''' stop the job if it is the running one '''
+        current = self.current
+        if current is None or current['id'] != job_id:
+            return
+        self.cancelled.add(job_id)
+        engine = self.engine
+        if engine is not None: # None until make_engine returns, run_job checks cancelled then
+            engine.stop()
+
+    def work(self):
+        while not self.shutdown.is_set():
+            job = self.jobs.next()
+            if job is None:
+                self.shutdown.wait(self.poll_sec)
+                continue
+            self.run_job(job)
+            if not self.shutdown.is_set():
+                self.flush()
+
+    def run_job(self, job):
+        progress = {'measurements': 0, 'iteration': None, 'last_cost': None, 'best_cost': None, 'message': ''}
+
+        def on_plot(algo, iteration, cost, rgb):
+            progress.update(measurements=progress['measurements'] + 1, iteration=int(iteration),
+                            last_cost=float(cost), last_rgb=list(map(float, rgb)),
+                            best_cost=float(cost) if progress['best_cost'] is None else min(progress['best_cost'],
+                                                                                             float(cost)))
+            self.jobs.update(job['id'], progress=progress)
+
+        def on_status(message):
+            progress['message'] = message
+
+        self.current = job
+        try:
+            self.engine = self.make_engine(job['settings'])
+            if job['id'] in self.cancelled: # cancelled while the engine was made
+                self.jobs.update(job['id'], status='cancelled', finished=datetime.datetime.now().isoformat())
+                return
+            self.engine.subscribe('plot', on_plot)
+            self.engine.subscribe('status', on_status)
+            result = self.engine.run(eng.ALGOS[job['algo']], job['target'])
+            campaign = result.pop('campaign')
+            if campaign is not None:
+                result['best'] = [{'target': target, 'rates': rates, 'rgb': rgb, 'cost': cost}
+                                  for target, rates, rgb, cost in campaign.best()]
+            result['exp_path'] = self.engine.logger.exp_path
+            if job['id'] in self.cancelled:
+                status = 'cancelled'
+            elif result['aborted'] and self.shutdown.is_set():
+                # stopped with the service, run again at the next start
+                self.jobs.update(job['id'], status='queued', started=None, progress=None)
+                return
+            else:
+                status = 'done'
+            self.jobs.update(job['id'], status=status, result=result, progress=progress,
+                             finished=datetime.datetime.now().isoformat())
+        except Exception as msg:
+            self.jobs.update(job['id'], status='failed', error=repr(msg), progress=progress,
+                             finished=datetime.datetime.now().isoformat())
+        finally:
+            self.current = None
+            self.engine = None
+            self.cancelled.discard(job['id'])
+
+    def status(self):
+        current = self.current
+        return {'running': self.jobs.get(current['id']) if current is not None else None,
+                'queued': len(self.jobs.list('queued'))}
+
+
+def submit_request(jobs, request):
+    ''' queue a job from an API request dict in the JobQueue jobs, return its id (ValueError if invalid) '''
+    algo = request.get('algo')
+    if algo not in eng.ALGOS:
+        raise ValueError('algo must be one of '+str(list(eng.ALGOS)))
+    target = request.get('palette') if algo == 'campaign' else request.get('target')
+    target = np.asarray(target if target is not None else [], dtype=float)
+    if target.ndim != (2 if algo == 'campaign' else 1) or target.shape[-1] != 3 or len(target) == 0 \
+            or np.any(target < 0) or np.any(target > 255):
+        raise ValueError('target must be [R, G, B] (palette [[R, G, B], ...] for a campaign) within 0-255')
+    settings = request.get('settings') or {}
+    unknown = set(settings) - set(eng.DEFAULTS)
+    if unknown:
+        raise ValueError('unknown settings: '+str(sorted(unknown)))
+    return jobs.submit(algo, target.tolist(), request.get('priority', 0), settings)
+
+
+def flush_lines(pumps, rates, seconds, shutdown=None):
+    ''' run the pumps at rates for seconds (less if shutdown is set), then stop them '''
+    auto.set_pump_rates(pumps, rates)
+    auto.infuse_all(pumps)
+    if shutdown is not None:
+        shutdown.wait(seconds)
+    else:
+        time.sleep(seconds)
+    auto.stop_all(pumps)
+
+
+class Handler(BaseHTTPRequestHandler):
+    ''' JSON API of a JobService or multi_rig.Orchestrator (set as the service attribute of the server) '''
+
+    def reply(self, code, body):
+        data = dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def job_id(self, path):
+        parts = path.strip('/').split('/')
+        if len(parts) == 2 and parts[0] == 'jobs' and parts[1].isdigit():
+            return int(parts[1])
+        return None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        service = self.server.service
+        if url.path == '/status':
+            return self.reply(200, service.status())
+        if url.path.rstrip('/') == '/jobs':
+            status = parse_qs(url.query).get('status', [None])[0]
+            return self.reply(200, service.jobs.list(status))
+        job_id = self.job_id(url.path)
+        job = service.jobs.get(job_id) if job_id is not None else None
+        if job is None:
+            return self.reply(404, {'error': 'not found'})
+        self.reply(200, job)
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip('/') != '/jobs':
+            return self.reply(404, {'error': 'not found'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+            job_id = self.server.service.submit(request)
+        except ValueError as msg: # includes invalid json
+            return self.reply(400, {'error': str(msg)})
+        self.reply(201, {'id': job_id})
+
+    def do_DELETE(self):
+        job_id = self.job_id(urlparse(self.path).path)
+        status = self.server.service.cancel(job_id) if job_id is not None else None
+        if status is None:
+            return self.reply(404, {'error': 'not found'})
+        if status not in ('queued', 'running'):
+            return self.reply(409, {'error': 'job is '+status})
+        self.reply(200, {'id': job_id, 'cancelled': status})
+
+    def log_message(self, format, *args):
+        pass # keep the console for the job progress
+
+
+def serve(service, host='127.0.0.1', port=8765):
+    ''' HTTP server of the service, call serve_forever() on it '''
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run color targets submitted over a local API on the rig')
+    parser.add_argument('--port', required=True, help='serial port of the pump chain, SIMULATED for the simulated rig')
+    parser.add_argument('--ref', required=True, help="reference spectrum .npy, or 'now' to measure it as the rig is")
+    parser.add_argument('--bg', required=True, help="background spectrum .npy, or 'now' to measure it as the rig is")
+    parser.add_argument('--integ-time', type=int, default=0, help='integration time (microsecond), 0: auto')
+    parser.add_argument('--db', default='jobs.sqlite', help='file of the job queue')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--http-port', type=int, default=8765)
+    parser.add_argument('--flush-rates', nargs=4, type=float, default=[0, 0, 400, 0],
+                        help='rates [crate, mrate, wrate, yrate] of the flush after each job')
+    parser.add_argument('--flush-sec', type=float, default=30.0, help='seconds of the flush after each job')
+    args = parser.parse_args()
+
+    pumps = eng.connect_pumps(args.port)
+    spec = eng.connect_spectrometer(spm.backend_for_port(args.port))
+    integ_time = args.integ_time if args.integ_time > 0 else eng.find_integ_time(spec)
+    spec.integration_time_micros(integ_time)
+
+    logger = PrgmLogger()
+    logger.create('RGB')
+    wavelengths, bg_spec = eng.load_spectrum(spec, args.bg, background=True)
+    logger.save_data('bg', bg_spec)
+    wavelengths, ref_spec = eng.load_spectrum(spec, args.ref)
+    logger.save_data('ref', ref_spec)
+
+    def make_engine(settings):
+        engine = eng.Engine(pumps, spec, wavelengths, ref_spec, bg_spec, logger, integ_time, **settings)
+        engine.subscribe('status', print)
+        return engine
+
+    service = JobService(JobQueue(args.db), make_engine)
+    service.flush = lambda: flush_lines(pumps, args.flush_rates, args.flush_sec, service.shutdown)
+    service.start()
+    server = serve(service, args.host, args.http_port)
+    print('Job service on http://'+args.host+':'+str(args.http_port)+', '
+          +str(len(service.jobs.list('queued')))+' jobs queued')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopping after the current condition...')
+    server.server_close()
+    service.stop()
+    auto.stop_all(pumps)
+    logger.writer.close()
+
+
+if __name__ == '__main__':
+    main()
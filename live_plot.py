@@ -0,0 +1,113 @@
+''' Live MSE and rgb plot of the optimization loops
+
+    Keeps one persistent scatter per algorithm on the MSE and the 3d rgb axes
+    (and one annotation with its latest cost), and appends new points to them
+    instead of creating an artist per point. draw() redraws at most every
+    min_interval seconds, so a fast run (e.g. the plant simulator) adds many
+    points per frame and the plot stays real-time with thousands of points.
+
+    Blitting would not help here: every new point may rescale the axes and the
+    3d view is redrawn as a whole anyway.
+'''
+
+import time
+import numpy as np
+
+MARKERS = {'gd': 'o', 'campaign': 's'} # anything else (bo) is '^'
+
+
+class LivePlot():
+    ''' incremental plot of [algo, iteration, cost, rgb] points
+
+        mse_ax: axes of the cost per iteration
+        rgb_ax: 3d axes of the measured rgb
+        draw_canvas: callable redrawing the figure, e.g. canvas.draw_idle
+        min_interval: min seconds between two redraws
+    '''
+
+    def __init__(self, mse_ax, rgb_ax, draw_canvas, min_interval=0.25):
+        self.mse_ax = mse_ax
+        self.rgb_ax = rgb_ax
+        self.draw_canvas = draw_canvas
+        self.min_interval = min_interval
+        self.series = {} # algo -> points and artists
+        self.dirty = False # points added since the last redraw
+        self.last_draw = 0.0
+
+    def get_series(self, algo):
+        # the axes are cleared (cla) when a new target is picked, start over with new artists then
+        series = self.series.get(algo)
+        if series is not None and series['rgb_artist'] in self.rgb_ax.collections \
+                and series['mse_artist'] in self.mse_ax.collections:
+            return series
+        marker = MARKERS.get(algo, '^')
+        series = {'iteration': [], 'cost': [], 'rgb': [],
+                  'mse_artist': self.mse_ax.scatter([], [], marker=marker, label=algo),
+                  'rgb_artist': self.rgb_ax.scatter([], [], [], marker=marker, label=algo, depthshade=False),
+                  'annotation': self.mse_ax.annotate('', xy=(0, 0), fontsize=8, xycoords='data')}
+        self.series[algo] = series
+        return series
+
+    def add(self, algo, iteration, cost, rgb):
+        ''' append one point, shown at the next draw() '''
+        series = self.get_series(algo)
+        series['iteration'].append(int(iteration))
+        series['cost'].append(int(cost))
+        series['rgb'].append(np.asarray(rgb, dtype=float))
+        self.dirty = True
+
+    def update_artists(self):
+        for series in self.series.values():
+            if not series['rgb']:
+                continue
+            rgb = np.array(series['rgb'])
+            colors = np.clip(rgb/255.0, 0, 1)
+            points = np.column_stack([series['iteration'], series['cost']])
+            series['mse_artist'].set_offsets(points)
+            series['mse_artist'].set_facecolors(colors)
+            series['mse_artist'].set_edgecolors(colors)
+            series['rgb_artist']._offsets3d = (rgb[:, 0], rgb[:, 1], rgb[:, 2])
+            series['rgb_artist'].set_facecolors(colors)
+            series['rgb_artist'].set_edgecolors(colors)
+            # annotate the latest cost only
+            series['annotation'].xy = tuple(points[-1])
+            series['annotation'].set_text(str(series['cost'][-1]))
+            self.mse_ax.update_datalim(points)
+            self.rgb_ax.auto_scale_xyz(rgb[:, 0], rgb[:, 1], rgb[:, 2], had_data=True)
+        self.mse_ax.autoscale_view()
+
+    def draw(self, force=False):
+        ''' redraw if points were added and min_interval passed since the last redraw, return True if drawn '''
+        if not self.dirty or (not force and time.time() - self.last_draw < self.min_interval):
+            return False
+        self.update_artists()
+        self.draw_canvas()
+        self.dirty = False
+        self.last_draw = time.time()
+        return True
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = plt.Figure(figsize=(5, 5.2), dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    mse_ax = fig.add_subplot(3, 1, 1)
+    rgb_ax = fig.add_subplot(3, 1, (2, 3), projection='3d')
+    plot = LivePlot(mse_ax, rgb_ax, canvas.draw, min_interval=0.1)
+
+    rng = np.random.default_rng(0)
+    start = time.time()
+    frames = 0
+    for i in range(5000):
+        # simulator speed: a point every 0.1 ms
+        plot.add('gd' if i % 2 else 'bo', i//2, 5000*np.exp(-i/1000), rng.uniform(0, 255, 3))
+        frames += plot.draw()
+        time.sleep(0.0001)
+    plot.draw(force=True)
+    print('5000 points in %.2f sec, %d frames, %d collections on the 3d axes' % (
+        time.time()-start, frames + 1, len(rgb_ax.collections)))
@@ -0,0 +1,293 @@
+''' Several rigs driven from one controller
+
+    Discovers the pump chains (serial ports) and spectrometers (serial
+    numbers), pairs them into rigs and runs one worker process per rig. Each
+    worker connects its own pumps and spectrometer and runs jobs from the shared
+    job queue (job_service.JobQueue, the same sqlite file and JSON API as
+    job_service.py) back to back, so a job goes to the first free rig. Workers
+    do not write the color index: the measurements of every finished run are sent
+    to the controller, the only writer, which merges them into the shared color
+    index (color_index.npz) the next runs start from.
+
+    Which chain and which spectrometer belong to one rig cannot be read from the
+    devices, discovery pairs them in sorted order. Check it against the wiring
+    and keep it in a rigs file, one entry per rig:
+        [{"name": "rig1", "port": "COM3", "spectrometer": "FLMS12345", "ref": "now", "bg": "now"}, ...]
+    (optional per rig: "ref", "bg", "integ_time")
+
+    Example:
+        python multi_rig.py --discover --save-rigs rigs.json
+        python multi_rig.py --rigs rigs.json --ref Reference.npy --bg Background.npy
+        python multi_rig.py --simulate 3 --ref now --bg now
+        curl -X POST localhost:8765/jobs -d '{"algo": "gd", "target": [120, 80, 150]}'
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+
+import RGB_Project_Automation as auto
+import engine as eng
+import job_service as js
+import spectrometers as spm
+
+
+def probe_chain(port):
+    ''' True if a pump answers at address 0 on the serial port '''
+    from pump import Chain, Pump
+    try:
+        chain = Chain(port=port)
+    except Exception:
+        return False
+    try:
+        Pump(chain, address=0)
+        return True
+    except Exception:
+        return False
+    finally:
+        chain.close()
+
+
+def discover(probe=False):
+    ''' serial ports (those with a pump chain if probe) and spectrometer serial numbers '''
+    from serial.tools.list_ports import comports
+    ports = sorted(port.device for port in comports())
+    if probe:
+        ports = [port for port in ports if probe_chain(port)]
+    try:
+        serials = sorted(spm.list_spectrometers())
+    except Exception as msg: # seabreeze missing or no usb backend
+        print('No spectrometers listed: '+str(msg))
+        serials = []
+    return ports, serials
+
+
+def pair(ports, serials):
+    ''' rigs of the ports and spectrometers in sorted order, check it against the wiring '''
+    if len(ports) != len(serials):
+        print('Found '+str(len(ports))+' pump chains and '+str(len(serials))+' spectrometers, pairing '
+              +str(min(len(ports), len(serials))))
+    return [{'name': 'rig'+str(i+1), 'port': port, 'spectrometer': serial}
+            for i, (port, serial) in enumerate(zip(sorted(ports), sorted(serials)))]
+
+
+def simulated_rigs(n):
+    ''' n rigs on the simulated pumps and spectrometer, each worker simulates its own '''
+    return [{'name': 'sim'+str(i+1), 'port': spm.SIMULATED_PORT, 'spectrometer': 'SIM%05d' % (i+1)}
+            for i in range(n)]
+
+
+def load_rigs(path):
+    with open(path) as f:
+        rigs = json.load(f)
+    names = [rig['name'] for rig in rigs]
+    if len(set(names)) != len(names):
+        raise ValueError('rig names must be unique: '+str(names))
+    return rigs
+
+
+def save_rigs(path, rigs):
+    with open(path, 'w') as f:
+        json.dump(rigs, f, indent=1)
+
+
+def rig_worker(rig, db, results, control, shutdown, options):
+    ''' worker process of one rig: run jobs of the queue in db until shutdown is set
+
+        results: queue receiving (rig name, job id, measured (rates, rgb)) of every finished run
+        control: queue of ('cancel', job id) from the controller
+        options: ref, bg, integ_time, flush_rates, flush_sec (defaults of the rigs), color_index_file (shared
+                 color index the runs start from)
+    '''
+    from prgm_logger import PrgmLogger
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C reaches the whole group, the controller stops the rigs
+    name = rig['name']
+    pumps = eng.connect_pumps(rig['port'])
+    spec = eng.connect_spectrometer(spm.backend_for_port(rig['port']), serial_number=rig.get('spectrometer'))
+    integ_time = rig.get('integ_time', options['integ_time'])
+    integ_time = integ_time if integ_time > 0 else eng.find_integ_time(spec)
+    spec.integration_time_micros(integ_time)
+
+    # experiments of each rig in their own folder
+    logger = PrgmLogger()
+    logger.path = os.path.join(logger.path, name)
+    logger.create('RGB')
+    wavelengths, bg_spec = eng.load_spectrum(spec, rig.get('bg', options['bg']), background=True)
+    logger.save_data('bg', bg_spec)
+    wavelengths, ref_spec = eng.load_spectrum(spec, rig.get('ref', options['ref']))
+    logger.save_data('ref', ref_spec)
+
+    service = None
+
+    def make_engine(settings):
+        # start from the shared color index, the controller merges the measurements into it
+        engine = eng.Engine(pumps, spec, wavelengths, ref_spec, bg_spec, logger, integ_time,
+                            **dict(settings, color_index_file=options['color_index_file'], update_color_index=False))
+        job_id = service.current['id'] if service.current is not None else None
+        engine.subscribe('status', lambda message: print(name+': '+message))
+        engine.subscribe('done', lambda result: results.put((name, job_id, result['measured'])))
+        return engine
+
+    service = js.JobService(js.JobQueue(db, recover=False), make_engine)
+    service.flush = lambda: js.flush_lines(pumps, options['flush_rates'], options['flush_sec'], service.shutdown)
+    service.start()
+    print(name+': ready on '+str(rig['port'])+' with spectrometer '+str(rig.get('spectrometer')))
+    try:
+        while not shutdown.is_set():
+            try:
+                command, job_id = control.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if command == 'cancel':
+                service.stop_job(job_id)
+    finally:
+        service.stop()
+        auto.stop_all(pumps)
+        if hasattr(spec, 'stop'):
+            spec.stop()
+        logger.writer.close()
+        service.jobs.close()
+
+
+class Orchestrator():
+    ''' worker processes of the rigs on one job queue, merging their measurements into the color index
+
+        rigs: list of rig dicts (name, port, spectrometer, optional ref, bg, integ_time)
+        db: sqlite file of the job queue
+        color_index_file: shared color index the measurements are merged into
+        options: see rig_worker
+    '''
+
+    def __init__(self, rigs, db='jobs.sqlite', color_index_file=eng.DEFAULTS['color_index_file'], **options):
+        self.rigs = rigs
+        self.db = db
+        self.color_index_file = color_index_file
+        self.options = {'ref': 'now', 'bg': 'now', 'integ_time': 0, 'flush_rates': [0, 0, 400, 0],
+                        'flush_sec': 30.0}
+        self.options.update(options)
+        self.options['color_index_file'] = color_index_file
+        # first to open the queue: jobs left running by a previous controller are queued again
+        self.jobs = js.JobQueue(db)
+        self.results = multiprocessing.Queue()
+        self.shutdown = multiprocessing.Event()
+        self.controls = {}
+        self.workers = {}
+        self.merged = 0 # conditions merged into the color index
+        self.merger = threading.Thread(target=self.merge, name='merge', daemon=True)
+
+    def start(self):
+        for rig in self.rigs:
+            control = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=rig_worker, name=rig['name'], daemon=True,
+                                             args=(rig, self.db, self.results, control, self.shutdown, self.options))
+            worker.start()
+            self.controls[rig['name']] = control
+            self.workers[rig['name']] = worker
+        self.merger.start()
+
+    def stop(self, timeout=None):
+        ''' stop the running jobs after their current condition and wait for the workers '''
+        self.shutdown.set()
+        for worker in self.workers.values():
+            worker.join(timeout)
+        self.merger.join()
+        self.jobs.close()
+
+    def merge(self):
+        # the only writer of the color index
+        import color_index as ci
+        while not (self.shutdown.is_set() and self.results.empty() and not self.alive()):
+            try:
+                name, job_id, measured = self.results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if not measured:
+                continue
+            try:
+                color_index = ci.merge(self.color_index_file, [m[0] for m in measured], [m[1] for m in measured])
+            except Exception as msg: # an unreadable index is left as it is
+                print(name+': job '+str(job_id)+' not merged into the color index: '+str(msg))
+                continue
+            self.merged += len(measured)
+            print(name+': job '+str(job_id)+' merged '+str(len(measured))+' conditions into the color index ('
+                  +str(len(color_index))+' conditions)')
+
+    def alive(self):
+        return any(worker.is_alive() for worker in self.workers.values())
+
+    # ----- API of job_service.Handler -----
+    def submit(self, request):
+        return js.submit_request(self.jobs, request)
+
+    def cancel(self, job_id):
+        ''' cancel a queued job, or stop a running one on whichever rig runs it '''
+        status = self.jobs.cancel(job_id)
+        if status == 'running':
+            for control in self.controls.values():
+                control.put(('cancel', job_id))
+        return status
+
+    def status(self):
+        return {'rigs': [dict(rig, alive=self.workers[rig['name']].is_alive()) for rig in self.rigs],
+                'running': self.jobs.list('running'), 'queued': len(self.jobs.list('queued')),
+                'merged_conditions': self.merged}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run queued color targets on several rigs at once')
+    parser.add_argument('--discover', action='store_true', help='list the pump chains and spectrometers and exit')
+    parser.add_argument('--probe', action='store_true', help='keep the ports where a pump answers only')
+    parser.add_argument('--save-rigs', default=None, help='save the discovered rigs to this file')
+    parser.add_argument('--rigs', default=None, help='rigs file (default: the discovered rigs)')
+    parser.add_argument('--simulate', type=int, default=0, help='run this many simulated rigs instead')
+    parser.add_argument('--ref', default='now', help="reference spectrum .npy, or 'now' to measure it on each rig")
+    parser.add_argument('--bg', default='now', help="background spectrum .npy, or 'now' to measure it on each rig")
+    parser.add_argument('--integ-time', type=int, default=0, help='integration time (microsecond), 0: auto')
+    parser.add_argument('--db', default='jobs.sqlite', help='file of the job queue')
+    parser.add_argument('--color-index', default=eng.DEFAULTS['color_index_file'], help='shared color index')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--http-port', type=int, default=8765)
+    parser.add_argument('--flush-rates', nargs=4, type=float, default=[0, 0, 400, 0],
+                        help='rates [crate, mrate, wrate, yrate] of the flush after each job')
+    parser.add_argument('--flush-sec', type=float, default=30.0, help='seconds of the flush after each job')
+    args = parser.parse_args()
+
+    if args.simulate:
+        rigs = simulated_rigs(args.simulate)
+    elif args.rigs is not None and not args.discover:
+        rigs = load_rigs(args.rigs)
+    else:
+        ports, serials = discover(args.probe)
+        print('Pump chains: '+str(ports))
+        print('Spectrometers: '+str(serials))
+        rigs = pair(ports, serials)
+        for rig in rigs:
+            print(rig['name']+': '+rig['port']+' + '+str(rig['spectrometer'])+' (check against the wiring)')
+        if args.save_rigs is not None:
+            save_rigs(args.save_rigs, rigs)
+            print('Rigs saved to '+args.save_rigs)
+        if args.discover:
+            return
+    if not rigs:
+        parser.error('no rigs to run')
+
+    orchestrator = Orchestrator(rigs, args.db, args.color_index, ref=args.ref, bg=args.bg,
+                                integ_time=args.integ_time, flush_rates=args.flush_rates, flush_sec=args.flush_sec)
+    orchestrator.start()
+    server = js.serve(orchestrator, args.host, args.http_port)
+    print('Controller of '+str(len(rigs))+' rigs on http://'+args.host+':'+str(args.http_port)+', '
+          +str(len(orchestrator.jobs.list('queued')))+' jobs queued')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopping the rigs after their current condition...')
+    server.server_close()
+    orchestrator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -37,6 +37,37 @@ def gradient_descent_4steps(target_rgb,rgb,flowrates,prev_cost,prev_flowrates,le
 
     return step_size
 
+def cal_cost_batch(target_rgb, rgb):
+    ''' cal_cost for stacks of rgb
+        target_rgb: (3,) or (..., 3), broadcast against rgb
+        rgb: (..., 3)
+        return: (...) mean squared error of each rgb
+    '''
+    return np.square(np.asarray(target_rgb, dtype=float) - np.asarray(rgb, dtype=float)).mean(axis=-1)
+
+def gradient_descent_4steps_batch(target_rgb,rgb,flowrates,prev_cost,prev_flowrates,learning_rate=0.01):
+    ''' gradient_descent_4steps for T trajectories of N pumps in one call
+        target_rgb: (3,) or (T, 3)
+        rgb: (T, 3) measured rgb of the scout step
+        flowrates: (T, N) flowrate of the scout step
+        prev_cost: (T,) cost of the previous real step
+        prev_flowrates: (T, N) flowrate of the previous real step
+        return: (T, N) step size
+
+        Extra leading axes broadcast, e.g. all scout steps of a real step at once:
+        rgb (T, S, 3), flowrates (T, S, N), prev_cost (T, 1), prev_flowrates (T, 1, N)
+        gives (T, S, N), and .sum(axis=1) is the delta rates of get_four_scout.
+    '''
+    cost = cal_cost_batch(target_rgb, rgb)
+    denom = np.asarray(flowrates, dtype=float) - np.asarray(prev_flowrates, dtype=float)
+    diff = (cost - np.asarray(prev_cost, dtype=float))[..., None]
+
+    # if denominator is zero, i.e. flow rate did not change, step_size should be 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gradient = np.where(denom == 0, 0.0, diff/denom)
+
+    return - learning_rate*gradient
+
 
 if __name__ == '__main__':
     target_rgb = np.array([ 0,0, 200])
@@ -49,4 +80,16 @@ if __name__ == '__main__':
     step = gradient_descent_4steps(target_rgb,rgb,flowrates,prev_cost,prev_flowrates,0.01)[0]
     print(step)
     next_flowrates = flowrates + gradient_descent_4steps(target_rgb,rgb,flowrates,prev_cost,prev_flowrates,0.01)[0]
-    print(next_flowrates)
\ No newline at end of file
+    print(next_flowrates)
+
+    # batched version gives identical results
+    rng = np.random.default_rng(0)
+    T = 1000
+    targets = rng.uniform(0, 255, (T, 3))
+    rgbs = rng.uniform(0, 255, (T, 3))
+    prevs = rng.uniform(0, 600, (T, 4))
+    scouts = prevs + np.diag([30.0]*4)[rng.integers(0, 4, T)]
+    prev_costs = rng.uniform(0, 5000, T)
+    batch = gradient_descent_4steps_batch(targets,rgbs,scouts,prev_costs,prevs,0.6)
+    single = np.array([gradient_descent_4steps(*args, 0.6) for args in zip(targets,rgbs,scouts,prev_costs,prevs)])
+    print('batch == single:', np.array_equal(batch, single))
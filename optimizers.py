@@ -0,0 +1,426 @@
+''' Optimization loops of the RGB color optimization project
+
+    The loops only talk to the rig through two callbacks, so the same code runs
+    from the UI, against the plant simulator and in the benchmark harness:
+
+    get_one_data(crate, mrate, wrate, yrate, prev_cost, iteration, algo)
+        run one real step, return its MSE cost (None if aborted)
+    get_one_rgb(rates, label)
+        run one condition, return its averaged rgb (None if aborted)
+'''
+
+import numpy as np
+
+import RGB_Project_Automation as auto
+import optimization_4steps as opt
+import RGB_Project_ScaleNewRates as scale
+import campaign as camp
+import convergence as conv
+import cost_aware as ca
+# bayes_opt, scipy.optimize and incremental_gp (sklearn) are imported by create_bo
+# and create_acquisition, only the BO loops pay for them
+
+
+# Constraint for BO
+# !!! not used in bo.suggest
+def constraint_function(wrate, crate, mrate, yrate):
+    ''' constraint inequality function is about the sum of rates '''
+    return wrate+crate+mrate+yrate
+constraint_limit = 600 # total rates <= 600
+
+
+class Optimizer():
+    ''' gradient descent, bayesian optimization and campaign loops
+
+        target: target rgb (or the (T, 3) palette of a campaign)
+        init_rates: initial flow rates [crate, mrate, wrate, yrate]
+        no_iter: max number of iterations
+        no_iter_campaign: max number of measurements of a campaign
+        learning_rate: learning rate of the gradient descent optimization
+        small_step_size: size of small steps for each pump before a real step
+        kappa: BO parameter to indicate how close the next parameters are sampled
+        random_scout: use random scout steps size instead of small_step_size
+        random_state: seed of the BO optimizer (None: unseeded)
+        gp_engine: 'sklearn' refits the BO model from scratch every iteration,
+                   'incremental' uses incremental_gp.IncrementalGP for large observation sets
+        gp_settings: keyword arguments of IncrementalGP
+        bo_history: (rates, costs) of past runs registered in the BO model before the first iteration
+        noise: convergence.NoiseEstimator fed with the repeated scans of each measurement
+        stopping: keyword arguments of convergence.StoppingRule
+        acquisition: BO acquisition, 'ucb' (kappa) or 'cost_ei' (expected improvement per predicted
+                     cost in seconds and ul, see cost_aware.CostAwareEI)
+        acquisition_settings: keyword arguments of cost_aware.CostAwareEI
+        logger: object with log('log', message), e.g. PrgmLogger
+        status: callable(message), shows the progress to the user
+        finish: callable(), called once the run completed (e.g. save the plot)
+        plot: callable(algo, iteration, cost, rgb), only used by the campaign
+    '''
+
+    def __init__(self, get_one_data, get_one_rgb, target, init_rates, no_iter=21, no_iter_campaign=150, learning_rate=0.6,
+                 small_step_size=30.0, kappa=10, random_scout=False, random_state=None,
+                 gp_engine='sklearn', gp_settings=None, bo_history=None, noise=None, stopping=None,
+                 acquisition='ucb', acquisition_settings=None, logger=None, status=None, finish=None, plot=None):
+        self.get_one_data = get_one_data
+        self.get_one_rgb = get_one_rgb
+        self.target = target
+        self.init_rates = init_rates
+        self.no_iter = no_iter
+        self.no_iter_campaign = no_iter_campaign
+        self.learning_rate = learning_rate
+        self.small_step_size = small_step_size
+        self.kappa = kappa
+        self.random_scout = random_scout
+        self.random_state = random_state
+        self.gp_engine = gp_engine
+        self.gp_settings = gp_settings if gp_settings is not None else {}
+        self.bo_history = bo_history
+        self.noise = noise if noise is not None else conv.NoiseEstimator()
+        self.stopping = stopping if stopping is not None else {}
+        self.acquisition = acquisition
+        self.acquisition_settings = acquisition_settings if acquisition_settings is not None else {}
+        self.cost_model = None # cost_aware.CostAwareEI of the BO loops, follows every measurement
+        self.logger = logger
+        self.status = status if status is not None else (lambda message: None)
+        self.finish = finish if finish is not None else (lambda: None)
+        self.plot = plot if plot is not None else (lambda *args: None)
+
+        self.prev_cost = 1 # cost of previous iteration
+        self.iteration = 0 # iteration index of while loop. itr=0 : run initial condition
+
+    def log(self, message):
+        if self.logger is not None:
+            self.logger.log('log', message)
+
+    def create_bo(self):
+        ''' create a bayesian optimizer on the four flow rates '''
+        from bayes_opt import BayesianOptimization
+        try:
+            from bayes_opt.util import NotUniqueError
+        except ImportError: # older bayes_opt raise KeyError for duplicate points
+            NotUniqueError = KeyError
+        from scipy.optimize import NonlinearConstraint
+        pbounds = { "crate":(0,600), "mrate":(0,600),"wrate":(0,600), "yrate":(0,600)}
+        constraint = NonlinearConstraint(constraint_function, 0, constraint_limit)
+        bo = BayesianOptimization(f=self.get_one_data,
+                                  constraint = constraint,
+                                  pbounds = pbounds,
+                                  verbose=2,
+                                  random_state=self.random_state)
+        if self.gp_engine == 'incremental':
+            import incremental_gp as igp
+            igp.use_incremental_gp(bo, **self.gp_settings)
+        self.log('BO GP Engine: '+str(self.gp_engine))
+
+        # preload the observations of past runs
+        if self.bo_history is not None:
+            for rates, cost in zip(*self.bo_history):
+                try:
+                    bo.register(params=np.asarray(rates, dtype=float), target=-cost, constraint_value=600)
+                except NotUniqueError: # duplicate point
+                    pass
+            self.log('BO Preloaded Observations: '+str(len(bo.space)))
+        return bo
+
+    def create_acquisition(self):
+        ''' acquisition function of the BO loops '''
+        self.log('BO Acquisition: '+str(self.acquisition))
+        if self.acquisition == 'cost_ei':
+            self.cost_model = ca.CostAwareEI(self.init_rates, **self.acquisition_settings)
+            return self.cost_model
+        from bayes_opt import UtilityFunction
+        return UtilityFunction(kind="ucb", kappa=self.kappa)
+
+    def observe(self, rates):
+        # the cost-aware acquisition prices the next condition from the one in the flow cell,
+        # so it has to see every measurement (GD and scout steps too), not only the BO ones
+        if self.cost_model is not None:
+            self.cost_model.observe(rates)
+
+    def bo_step(self, bo, acquisition_function, bo_rates, bo_cost):
+        ''' register one BO result and suggest the next rates, scaled to sum(rates)=600 '''
+        bo.register(params=bo_rates, target=bo_cost,constraint_value=600)
+        bo_rates = bo.suggest(acquisition_function)
+        bo_rates_array = np.array(list(bo_rates.values()))
+        bo_rates_array = 600*bo_rates_array/sum(bo_rates_array)
+        bo_rates.update({'crate':bo_rates_array[0],
+                         'mrate':bo_rates_array[1],
+                         'wrate':bo_rates_array[2],
+                         'yrate':bo_rates_array[3]})
+        return bo_rates
+
+    def get_four_scout(self, rates, cost):
+        ''' proceed to acquire four scout data points '''
+
+        rgb_steps = [] # list to store scout steps rates
+
+        # get scout steps matrix
+        if self.random_scout:
+            small_steps_Q = auto.random_small_step_Q(rates) # random scout step size
+        else: small_steps_Q = auto.small_step_Q(rates,self.small_step_size) # fixed scout step size
+
+        self.log('Flowrates with Small Step Size: '+str(small_steps_Q))
+
+        # loop through scout steps
+        for idx, small_step in enumerate(small_steps_Q):
+            # move one scout step
+            rgb_step = self.get_one_rgb(small_step, label="Running small step #"+str(idx+1))
+            # abort if stop button is pressed
+            if rgb_step is None:
+                return None
+            self.observe(small_step)
+            # add new rgb to list
+            rgb_steps.append(rgb_step)
+
+        # Gradient Descent
+        # suggest next flow rates based on the gradients from scout steps
+        # change of rates between the new rates and current rates, summed over the scout steps
+        delta_rates = opt.gradient_descent_4steps_batch(self.target, rgb_steps, small_steps_Q, cost,
+                                                        rates, self.learning_rate).sum(axis=0)
+
+        # new rates before scaling
+        rates_new = rates + delta_rates
+        self.log('Gradient Descent Predicted Flowrate (before rescale): '+str(rates_new))
+        print('Predicted Flowrate (before rescale): '+str(rates_new))
+
+        # scale new rates
+        rates_new_scaled = scale.scale_rates(rates, delta_rates)
+
+        self.log('Gradient Descent Predicted Flowrate (after rescale): '+str(rates_new_scaled))
+        print('Predicted Flowrate (after rescale): '+str(rates_new_scaled))
+
+        return rates_new_scaled
+
+    def stopping_rule(self, **defaults):
+        # BO explores on purpose, so it gets more patience than GD unless set in self.stopping
+        settings = dict(defaults)
+        settings.update(self.stopping)
+        return conv.StoppingRule(self.noise, **settings)
+
+    def stopped(self, reason, rates):
+        # if terminated early by the stopping rule
+        self.finish()
+        self.log('Stopped: '+reason+' (noise sigma '+str(self.noise.sigma)+')')
+        if reason.startswith('converged'):
+            self.status("Optimized flow rates are found at "+str(rates))
+            self.log('Completed! Found the flow rates with the possible minimum cost')
+        else:
+            self.status("Stopped, "+reason+". Best flow rates: "+str(rates))
+
+    def max_iter_reached(self):
+        # if terminated because reached max no of iteration set
+        self.finish()
+        self.log('Experiment reached maximum number of iterations')
+        self.status("Experiment reached maximum number of iterations")
+
+    def run_BO(self):
+        ''' bayesian optimization process '''
+
+        iteration = self.iteration
+
+        # create an optimizer
+        bo = self.create_bo()
+        # set acquisition function
+        acquisition_function = self.create_acquisition()
+
+        # initialize bo rates
+        bo_rates = bo._space.array_to_params(self.init_rates)
+
+        self.log('Algorithm: BO')
+        self.log('Kappa: '+str(self.kappa))
+        bo_stop = self.stopping_rule(patience=8)
+
+        # optimize loop
+        while iteration < self.no_iter:
+
+            self.log('Iteration ' + str(iteration))
+
+            # BO
+            cost = self.get_one_data(**bo_rates, iteration=iteration,algo="bo")
+            if cost is None: # abort if user stop from UI
+                break
+            self.observe(list(bo_rates.values()))
+            # terminate if converged, stalled or out of gamut
+            reason = bo_stop.update(cost, list(bo_rates.values()))
+            if reason is not None:
+                self.stopped(reason, bo_stop.best_rates)
+                break
+            bo_cost = -cost
+            print("BO rates and MSE")
+            print(bo_rates, bo_cost)
+            bo_rates = self.bo_step(bo, acquisition_function, bo_rates, bo_cost)
+            self.log('Bayesian Optimization Cost: '+str(bo_cost))
+            self.log('Bayesian Optimization Predicted Flowrate: '+str(bo_rates))
+            print("BO predicted rates: " + str(bo_rates))
+
+            iteration += 1
+
+        if iteration >= self.no_iter:
+            self.max_iter_reached()
+
+    def run_GD(self):
+        ''' run gradient descent process '''
+
+        iteration = self.iteration
+        # initialize rates
+        gd_rates = self.init_rates
+
+        # log
+        self.log('Learning Rate: '+str(self.learning_rate))
+        gd_stop = self.stopping_rule()
+
+        # optimization loop
+        while iteration < self.no_iter:
+
+            self.log('Iteration ' + str(iteration))
+
+            gd_cost = self.get_one_data(*gd_rates, iteration=iteration, algo="gd")
+            # terminate if user stop from UI
+            if gd_cost is None:
+                break
+            # terminate if converged, stalled or out of gamut
+            reason = gd_stop.update(gd_cost, gd_rates)
+            if reason is not None:
+                self.stopped(reason, gd_stop.best_rates)
+                break
+            gd_rates = self.get_four_scout(gd_rates, gd_cost)
+
+            # terminate if user stop from UI
+            if gd_rates is None:
+                break
+            self.log('Gradient Descent Cost: '+str(gd_cost))
+            self.log('Gradient Descent Predicted Flowrate: '+str(gd_rates))
+
+            iteration += 1
+
+        if iteration >= self.no_iter:
+            self.max_iter_reached()
+
+    def run_both(self):
+        ''' run bayesian optimization and gradient descent in parallel '''
+
+        iteration = self.iteration
+        # initialize bo_rates and gd_rates
+        gd_rates = self.init_rates
+
+        # initialize bo_prev_cost and gd_prev_cost
+        bo_prev_cost = self.prev_cost
+        gd_prev_cost = self.prev_cost
+
+        # create an optimizer
+        bo = self.create_bo()
+        # set acquisition function
+        acquisition_function = self.create_acquisition()
+
+        # initialize bo rates
+        bo_rates = bo._space.array_to_params(self.init_rates)
+
+        # log
+        self.log('Algorithm: BO & GD')
+        self.log('BO Kappa: '+str(self.kappa))
+        self.log('GD Learning Rate: '+str(self.learning_rate))
+        bo_stop = self.stopping_rule(patience=8)
+        gd_stop = self.stopping_rule()
+
+        # optimize loop
+        while iteration < self.no_iter:
+
+            self.log('Iteration ' + str(iteration))
+
+            # BO
+            cost = self.get_one_data(**bo_rates, prev_cost=bo_prev_cost, iteration=iteration, algo="bo")
+            if cost is None: # abort if user stop from UI
+                break
+            self.observe(list(bo_rates.values()))
+            bo_reason = bo_stop.update(cost, list(bo_rates.values()))
+            bo_cost = -cost
+            print("BO rates and MSE")
+            print(bo_rates, bo_cost)
+            bo_prev_cost = bo_cost
+            self.log('Bayesian Optimization Cost: '+str(bo_cost))
+
+            # GD
+            gd_cost = self.get_one_data(*gd_rates, gd_prev_cost, iteration=iteration,algo="gd")
+            if gd_cost is None: # abort if user stop from UI
+                break
+            self.observe(gd_rates)
+            gd_reason = gd_stop.update(gd_cost, gd_rates)
+
+            # terminate if either converged, or both stalled or out of gamut
+            if bo_stop.converged(cost) or gd_stop.converged(gd_cost) or (bo_reason and gd_reason):
+                best = bo_stop if bo_stop.best_cost < gd_stop.best_cost else gd_stop
+                self.stopped(best.reason or bo_reason or gd_reason, best.best_rates)
+                break
+            gd_rates = self.get_four_scout(gd_rates, gd_cost)
+            if gd_rates is None: # abort if user stop from UI
+                break
+            gd_prev_cost = gd_cost
+            self.log('Gradient Descent Cost: '+str(gd_cost))
+            self.log('Gradient Descent Predicted Flowrate: '+str(gd_rates))
+            print("GD rates and MSE")
+            print(gd_rates, gd_cost)
+
+            # next BO rates, suggested once GD and its scout steps left the flow cell at their last condition
+            bo_rates = self.bo_step(bo, acquisition_function, bo_rates, bo_cost)
+            self.log('Bayesian Optimization Predicted Flowrate: '+str(bo_rates))
+            print("BO predicted rates: " + str(bo_rates))
+
+            iteration += 1
+
+        if iteration >= self.no_iter:
+            self.max_iter_reached()
+
+    def run_campaign(self):
+        ''' optimize every palette color on one shared rates-to-color model
+            returns the campaign.Campaign holding the best condition of each target
+        '''
+
+        iteration = self.iteration
+        campaign = camp.Campaign(self.target, sum_rates=600, random_state=self.random_state)
+        rates = self.init_rates
+
+        # log
+        self.log('Algorithm: Campaign')
+        self.log('Number of Targets: '+str(len(campaign.targets)))
+        campaign_stop = self.stopping_rule()
+
+        # optimize loop
+        while iteration < self.no_iter_campaign:
+
+            self.log('Iteration ' + str(iteration))
+
+            rgb = self.get_one_rgb(rates)
+            if rgb is None: # abort if user stop from UI
+                break
+            costs = campaign.register(rates, rgb)
+            self.log('Campaign Costs: '+str(costs))
+            self.log('Campaign Best Costs: '+str(campaign.best_cost))
+
+            # plot the cost of the target closest to this measurement
+            self.plot('campaign',iteration,min(costs),rgb)
+
+            # terminate if every target converged within the measurement noise
+            if all(campaign_stop.converged(cost) for cost in campaign.best_cost):
+                self.stopped('converged within measurement noise for all targets',
+                             [np.asarray(best_rates).tolist() for _, best_rates, _, _ in campaign.best()])
+                break
+
+            rates = campaign.suggest()
+            self.log('Campaign Predicted Flowrate: '+str(rates))
+
+            iteration += 1
+
+        if iteration >= self.no_iter_campaign:
+            self.max_iter_reached()
+
+        return campaign
+
+    def run(self, algo):
+        ''' run the algorithm picked in the UI '''
+        if algo == 'Gradient Descent':
+            return self.run_GD()
+        elif algo == 'Bayesian Optim':
+            return self.run_BO()
+        elif algo == 'Both':
+            return self.run_both()
+        elif algo == 'Campaign':
+            return self.run_campaign()
@@ -0,0 +1,131 @@
+''' Simulated plant of the color mixing rig
+
+    A forward mixing model (Beer-Lambert law on dye absorbance spectra) with
+    configurable measurement noise, transit delay and pump jitter. The plant keeps
+    a simulated clock so benchmarks can report wall time without waiting for it.
+'''
+
+import numpy as np
+
+import RGB_Project_Automation as auto
+
+
+def absorbance_band(wavelengths, peak, width, od):
+    ''' gaussian absorbance band of one dye, optical density od at the peak '''
+    return od*np.exp(-0.5*((wavelengths - peak)/width)**2)
+
+
+class MixingModel():
+    ''' Beer-Lambert mixing of the dyes
+
+        transmittance = 10^-(sum_i fraction_i * absorbance_i(wavelength))
+        fraction_i = rates_i/sum(rates), pumps in the order [crate, mrate, wrate, yrate]
+
+        wavelengths: wavelengths of the spectra (nm), must cover 340-830 nm
+        absorbance: (no_of_pumps, len(wavelengths)) absorbance of each undiluted pump solution
+    '''
+
+    def __init__(self, wavelengths=None, absorbance=None):
+        if wavelengths is None:
+            wavelengths = np.linspace(330, 850, 1024)
+        self.wavelengths = np.asarray(wavelengths, dtype=float)
+        if absorbance is None:
+            absorbance = np.array([absorbance_band(self.wavelengths, 630, 60, 1.6),   # cyan absorbs red
+                                   absorbance_band(self.wavelengths, 545, 45, 1.6),   # magenta absorbs green
+                                   np.zeros(len(self.wavelengths)),                   # water
+                                   absorbance_band(self.wavelengths, 430, 45, 1.6)])  # yellow absorbs blue
+        self.absorbance = np.asarray(absorbance, dtype=float)
+
+    def fractions(self, rates):
+        rates = np.clip(np.asarray(rates, dtype=float), 0, None)
+        total = rates.sum(axis=-1, keepdims=True)
+        return rates/np.where(total > 0, total, 1)
+
+    def transmittance(self, rates):
+        ''' transmittance spectra for rates of shape (..., no_of_pumps) '''
+        return 10**(-(self.fractions(rates) @ self.absorbance))
+
+    def rgb(self, rates):
+        ''' noise-free rgb 0-255 of rates of shape (no_of_pumps,) or (n, no_of_pumps) '''
+        transmittance = np.atleast_2d(self.transmittance(rates))
+        rgb = np.array([auto.transm_to_rgb(self.wavelengths, t) for t in transmittance], dtype=float)
+        return rgb if np.ndim(rates) > 1 else rgb[0]
+
+
+class SimulatedPlant():
+    ''' the rig as seen by the optimization loops: rates in, averaged rgb out
+
+        noise_rgb: standard deviation of the rgb of one scan (the rig precision is about +-3)
+        pump_jitter: relative standard deviation of the delivered flow rates
+        transit_scale: true transit time relative to calc_time_to_travel
+        dispersion_tau: time constant (sec) of the washout of the previous condition
+        tube_dist, tube_dia, extra: transit model of calc_time_to_travel
+        integ_time: spectrometer integration time (sec)
+        no_of_avg: number of spectra averaged per measurement
+        command_delay: delay per pump command (sec), as in set_pump_rates and infuse_all
+    '''
+
+    def __init__(self, model=None, noise_rgb=1.5, pump_jitter=0.01, transit_scale=1.0, dispersion_tau=5.0,
+                 tube_dist=200, tube_dia=0.254, extra=15, integ_time=0.1, no_of_avg=3, command_delay=0.1,
+                 seed=None):
+        self.model = model if model is not None else MixingModel()
+        self.noise_rgb = noise_rgb
+        self.pump_jitter = pump_jitter
+        self.transit_scale = transit_scale
+        self.dispersion_tau = dispersion_tau
+        self.tube_dist = tube_dist
+        self.tube_dia = tube_dia
+        self.extra = extra
+        self.integ_time = integ_time
+        self.no_of_avg = no_of_avg
+        self.command_delay = command_delay
+        self.rng = np.random.default_rng(seed)
+
+        self.clock = 0.0 # simulated seconds since start
+        self.evaluations = 0 # number of wet evaluations
+        self.cell_rates = None # composition currently in the flow cell
+        self.last_true_rgb = None # noise-free rgb of the last measured composition
+        self.last_scans = None # rgb of each scan of the last measurement
+        self.history = []
+
+    def deliver(self, rates):
+        ''' flow rates actually delivered by the pumps '''
+        rates = np.asarray(rates, dtype=float)
+        jitter = 1 + self.pump_jitter*self.rng.standard_normal(rates.shape)
+        return np.clip(rates*jitter, 0, None)
+
+    def measure(self, rates):
+        ''' run one condition and return the measured rgb, advancing the simulated clock '''
+        rates = np.asarray(rates, dtype=float)
+        delivered = self.deliver(rates)
+
+        # same waiting time as the rig
+        wait_sec = auto.calc_time_to_travel(rates, self.tube_dist, self.tube_dia, self.extra)
+
+        # previous condition left in the flow cell if the plug arrives late
+        transit = self.transit_scale*(wait_sec - self.extra)
+        new = self.model.fractions(delivered)
+        if self.cell_rates is None:
+            seen = new
+        else:
+            residual = np.exp(-max(wait_sec - transit, 0)/self.dispersion_tau)
+            seen = residual*self.model.fractions(self.cell_rates) + (1 - residual)*new
+        self.cell_rates = delivered
+
+        true_rgb = self.model.rgb(seen)
+        scans = np.clip(np.round(true_rgb + self.noise_rgb*self.rng.standard_normal((self.no_of_avg, 3))), 0, 255)
+        rgb = np.round(scans.mean(axis=0))
+
+        self.clock += 2*len(rates)*self.command_delay + wait_sec + self.no_of_avg*self.integ_time
+        self.evaluations += 1
+        self.last_true_rgb = true_rgb
+        self.last_scans = scans
+        self.history.append([self.clock, rates, rgb, true_rgb])
+        return rgb
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    plant = SimulatedPlant(seed=0)
+    for rates in [[5.0, 5.0, 600.0, 5.0], [200, 200, 0, 200], [600, 0, 0, 0], [0, 600, 0, 0], [0, 0, 0, 600]]:
+        print(rates, plant.measure(rates), plant.clock)
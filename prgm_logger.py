@@ -0,0 +1,182 @@
+''' Data and log output of an experiment
+
+    Shared by the UI and the headless engine (engine.py), so data can be saved
+    without a display.
+'''
+
+import os
+import datetime
+import logging
+import numpy as np
+
+import spectral_store as ss
+import background_writer as bw
+import results_table as rt
+
+
+class PrgmLogger():
+    ''' log experiment informationm and save data to local
+
+    Directory content:
+    - RGB_Optimization_(datetime):
+        - Ref_(datetime).npy
+        - BG_(datetime).npy
+        - Experiment_(datetime):
+            - Log.log
+            - rgb_tracking.log
+            - Results.csv (results_table.ResultsTable, one row per measured condition)
+            - plot.png
+            - Data: spectral_store.SpectralStore of the experiment
+                - index.csv (kind, row, iteration, condition, rates, timestamp, integ_time)
+                - meta.json
+                - spec.bin, spec.off (raw counts, compressed), reference.npz (reference and background)
+                  or spec.bin, trans.bin, avgspec.bin, avgtrans.bin if compact is False
+    '''
+
+    def __init__(self):
+        self.path = os.getcwd()
+        self.run_path = ''
+        self.exp_path = ''
+        self.data_path = ''
+        self.info_log_file = ''
+        self.rgb_log_file = ''
+        self.ref_file = ''
+        self.bg_file = ''
+        self.spec_file = ''
+        self.store = None # spectral store of the current experiment
+        self.writer = bw.BackgroundWriter(maxsize=1000, policy='block') # all data and log output, off the acquisition thread
+        self.context = {} # iteration, condition, rates, integ_time and processing recorded with the next spectra
+        self.results = None # results table of the current experiment
+        self.compact = True # store compressed raw counts only, transmittance and averages are computed on read
+        self.reference = {} # latest 'ref' and 'bg' spectra, saved with the spectra of each experiment
+
+    def setup_logger(self, name, log_file, level=logging.INFO):
+
+        handler = logging.FileHandler(log_file)        
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
+
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.addHandler(handler)
+
+        return logger
+    
+    def create(self,type=''):
+        # create folder or file path
+        cur_time = datetime.datetime.now()
+        if type == 'RGB':
+            self.run_path = os.path.join(self.path, 'Data', cur_time.strftime('RGB_Optimization_%Y-%m-%d_%H-%M-%S'))
+            os.makedirs(self.run_path, exist_ok=True)
+        if type == 'Experiment':
+            if self.run_path == '':
+                print('run path does not exist')
+            else:
+                self.exp_path = os.path.join(self.run_path, cur_time.strftime('Experiment_%Y-%m-%d_%H-%M-%S'))
+                os.makedirs(self.exp_path, exist_ok=True)
+
+        if type == 'Data':
+            if self.exp_path == '':
+                print('exp path does not exist')
+            else:
+                self.data_path = os.path.join(self.exp_path, 'Data')
+                os.makedirs(self.data_path, exist_ok=True)
+                self.flush()
+                if self.store is not None:
+                    self.store.close()
+                self.store = ss.SpectralStore(self.data_path, compact=self.compact)
+                self.save_reference()
+
+        if type == 'Log':
+            if self.exp_path == '':
+                print('exp path does not exist')
+            else:
+                self.info_log_file = os.path.join(self.exp_path, 'Log.log')
+                self.rgb_log_file = os.path.join(self.exp_path, 'RGB_history.log')
+                self.info_logger = self.setup_logger('info_logger', self.info_log_file)
+                self.rgb_logger = self.setup_logger('rgb_logger', self.rgb_log_file)
+                self.info_logger.info('Color Optimization in RGB Program -- RUN')
+                self.rgb_logger.info('R, G, B')
+                self.flush()
+                if self.results is not None:
+                    self.results.close()
+                self.results = rt.ResultsTable(os.path.join(self.exp_path, 'Results.csv'))
+                
+    def log(self,type='', input=''):
+        # write to log files
+        if type == 'log':
+            try:
+                self.write_log(self.info_logger, input)
+            except AttributeError:
+                print('logger not created')
+        if type == 'rgb':
+            try:
+                self.write_log(self.rgb_logger, input)
+            except AttributeError:
+                print('logger not created')
+
+    def write_log(self, logger, input):
+        # the record is created now, so the log keeps the time of the event; the file write is queued
+        record = logger.makeRecord(logger.name, logging.INFO, '', 0, str(input), None, None)
+        self.writer.submit(logger.handle, record)
+
+    def log_result(self, algo, iteration, rates, rgb, **values):
+        ''' add one measured condition to the results table (see results_table.ResultsTable.append) '''
+        if self.results is None:
+            print('results table not created')
+        else:
+            self.writer.submit(self.results.append, algo, iteration, list(rates), list(rgb),
+                               timestamp=datetime.datetime.now(), **values)
+
+    def flush(self):
+        ''' wait until all queued data and logs are written and force the spectra to disk '''
+        self.writer.flush()
+        if self.store is not None:
+            self.store.sync()
+
+    def save_reference(self):
+        # reference and background of the experiment, needed to compute transmittance of the raw counts
+        if self.store is not None and 'ref' in self.reference and 'bg' in self.reference:
+            self.writer.submit(self.store.set_reference, self.reference['ref'], self.reference['bg'])
+
+    def set_context(self, **context):
+        ''' iteration, condition, rates or integ_time of the spectra saved next '''
+        self.context.update(context)
+
+    def save_data(self,type='',input=None,timestamp=None):
+        # save data to local, timestamp: time of the measurement (default: now)
+        cur_time = timestamp if timestamp is not None else datetime.datetime.now()
+        if type == 'ref':
+            if self.run_path == '':
+                print('run path does not exist')
+            else:
+                self.ref_file = os.path.join(self.run_path, cur_time.strftime('Reference_%Y-%m-%d_%H-%M-%S'))
+                self.writer.submit(np.save, self.ref_file, np.array(input))
+                self.reference['ref'] = np.array(input)
+                self.save_reference()
+        if type == 'bg':
+            if self.run_path == '':
+                print('run path does not exist')
+            else:
+                self.bg_file = os.path.join(self.run_path, cur_time.strftime('Background_%Y-%m-%d_%H-%M-%S'))
+                self.writer.submit(np.save, self.bg_file, np.array(input))
+                self.reference['bg'] = np.array(input)
+                self.save_reference()
+        if type in ('spec', 'avgspec', 'trans', 'avgtrans'):
+            # one growable array per kind in the experiment store
+            if self.store is None:
+                print('data path does not exist')
+            elif self.compact and type != 'spec':
+                pass # derived from the raw counts on read (archive_reader.py)
+            else:
+                # copy the array and the context, they may change before the write runs
+                self.writer.submit(self.store.append, type, np.array(input), timestamp=cur_time, **dict(self.context))
+
+    def save_img(self,input=None):
+        ''' save mse and rgb images to local '''
+        plot_fig = input
+        if self.exp_path != '':
+            plot_file = os.path.join(self.exp_path, 'plot.png')
+            try:
+                plot_fig.savefig(plot_file)
+            except:
+                pass
@@ -0,0 +1,260 @@
+''' Deterministic replay of recorded experiments through the optimization loops
+
+    Feeds the recorded measurements of a past experiment (Results.csv, in the
+    order they were measured) back into the unchanged optimizers.Optimizer in
+    place of the rig, and checks that every condition the loop asks for is the
+    one recorded at that position. The first mismatch (other rates, a real step
+    instead of a scout step, another algorithm or iteration) is reported as the
+    divergence and ends the replay, as does the end of the recording.
+
+    The target, seed and loop settings are read from the Log.log of the
+    experiment, the scans of each measurement as well, so the noise estimate and
+    the stopping rule see the same data as on the rig. Runs recorded before the
+    seed was logged only replay deterministically without random scout steps
+    and BO.
+
+    A 21 iteration GD run replays in about 10 ms, BO runs in the time of their
+    model fits and acquisition searches (see --profile), so optimizer changes
+    can be regression tested and profiled on every recorded experiment.
+
+    Example:
+        python replay.py Data/RGB_Optimization_2023-07-20_10-00-00
+        python replay.py Data --profile
+'''
+
+import argparse
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import re
+import time
+import warnings
+import numpy as np
+
+import optimization_4steps as opt
+import optimizers as optim
+import results_table as rt
+import convergence as conv
+from color_index import parse_numbers
+
+# algorithms of a results table -> algorithm name of the UI
+ALGOS = {('gd',): 'Gradient Descent', ('bo',): 'Bayesian Optim', ('bo', 'gd'): 'Both', ('campaign',): 'Campaign'}
+# Log.log lines of the settings: name, prefix
+SETTINGS = [('target', 'Target RGB:'), ('target', 'projected to'), ('seed', 'Random Seed:'),
+            ('random_scout', 'Random Scout Steps:'), ('no_iter', 'Max Iterations:'),
+            ('small_step_size', 'Initial Scout Step Size:'), ('learning_rate', 'Learning Rate:'),
+            ('kappa', 'Kappa:'), ('gp_engine', 'BO GP Engine:'), ('acquisition', 'BO Acquisition:')]
+# how a run ended, as logged by the loops
+OUTCOMES = ['Stopped:', 'Experiment reached maximum number of iterations', 'Experiment aborted']
+LOG_RECORD = re.compile(r'\n(?=\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})')
+
+
+def read_settings(path):
+    ''' target, seed, loop settings, scans of each measurement and outcome of an experiment Log.log '''
+    with open(path, errors='replace') as f:
+        records = LOG_RECORD.split(f.read())
+    settings, scans, outcome = {}, [], None
+    current = None
+    for record in records:
+        # a message is everything after the level, printed arrays may span lines
+        message = record.split('INFO', 1)[-1].strip()
+        for name, prefix in SETTINGS:
+            if prefix in message:
+                value = message.split(prefix, 1)[1].strip()
+                if name == 'target':
+                    numbers = np.array(parse_numbers(value))
+                    settings[name] = numbers.reshape(-1, 3) if len(numbers) > 3 else numbers
+                elif name in ('gp_engine', 'acquisition'):
+                    settings[name] = value
+                elif name == 'random_scout':
+                    settings[name] = value == 'True'
+                else:
+                    settings[name] = parse_numbers(value)[0]
+        if 'Start infusing with flow rates' in message:
+            current = []
+        elif 'Converted to RGB:' in message and current is not None:
+            current.append(parse_numbers(message.split('RGB:', 1)[1]))
+        elif 'Averaged Intensities Spectra RGB:' in message and current is not None:
+            scans.append(current)
+            current = None
+        elif any(message.startswith(i) for i in OUTCOMES):
+            outcome = message
+    for name in ('seed', 'no_iter'):
+        if name in settings:
+            settings[name] = int(settings[name])
+    return settings, scans, outcome
+
+
+def same_outcome(recorded, replayed):
+    # the noise sigma of a stop is printed from the logged scans, compare the reason only
+    strip = lambda message: None if message is None else message.split(' (noise sigma')[0]
+    return strip(recorded) == strip(replayed)
+
+
+class Replay():
+    ''' recorded measurements in place of get_one_data and get_one_rgb of the rig
+
+        table: results table of one experiment (results_table.load)
+        target: target rgb, or the palette of a campaign
+        scans: per-scan rgb of each measurement for the noise estimate (optional)
+        tolerance: max difference of the requested and recorded rates (ul/min)
+    '''
+
+    def __init__(self, table, target, scans=None, tolerance=1e-6):
+        self.table = table
+        self.target = np.asarray(target, dtype=float)
+        self.scans = scans if scans is not None and len(scans) == len(table['algo']) else None
+        self.tolerance = tolerance
+        self.noise = conv.NoiseEstimator()
+        self.rates = np.stack([table[i] for i in ['crate', 'mrate', 'wrate', 'yrate']], axis=-1)
+        self.rgb = np.stack([table[i] for i in ['R', 'G', 'B']], axis=-1)
+        self.position = 0 # next recorded measurement
+        self.divergence = None # first mismatch of the loop and the recording
+        self.messages = [] # log of the loop
+
+    def __len__(self):
+        return len(self.table['algo'])
+
+    def log(self, type='', input=''):
+        # stands in for PrgmLogger.log
+        self.messages.append(str(input))
+
+    def next(self, rates, real, algo=None, iteration=None):
+        ''' recorded rgb of the next measurement, None if the loop diverged from the recording or it ended '''
+        if self.divergence is not None:
+            return None
+        if self.position >= len(self):
+            self.divergence = {'position': self.position, 'reason': 'recording ended',
+                               'requested': list(map(float, rates)), 'recorded': None}
+            return None
+        i = self.position
+        recorded_real = self.table['scout'][i] == -1 and self.table['algo'][i] != 'campaign'
+        reasons = []
+        if real != recorded_real:
+            reasons.append('real step' if real else 'scout step')
+        if algo is not None and algo != self.table['algo'][i]:
+            reasons.append('algorithm '+str(algo))
+        if iteration is not None and iteration != self.table['iteration'][i]:
+            reasons.append('iteration '+str(iteration))
+        if np.max(np.abs(np.asarray(rates, dtype=float) - self.rates[i])) > self.tolerance:
+            reasons.append('rates')
+        if reasons:
+            self.divergence = {'position': i, 'reason': ', '.join(reasons), 'requested': list(map(float, rates)),
+                               'recorded': {'algo': self.table['algo'][i], 'iteration': int(self.table['iteration'][i]),
+                                            'scout': int(self.table['scout'][i]), 'rates': self.rates[i].tolist()}}
+            return None
+        if self.scans is not None:
+            self.noise.add_scans(self.scans[i])
+        self.position += 1
+        return self.rgb[i]
+
+    def get_one_rgb(self, rates, label="Running"):
+        return self.next(rates, real=False)
+
+    def get_one_data(self, crate, mrate, wrate, yrate, prev_cost=1, iteration=0, algo="gd"):
+        rgb = self.next([crate, mrate, wrate, yrate], real=True, algo=algo, iteration=iteration)
+        if rgb is None:
+            return None
+        return opt.cal_cost(self.target, rgb)
+
+
+def replay_experiment(folder, tolerance=1e-6, seed=None, overrides=None):
+    ''' replay the experiment in folder (holding Results.csv and Log.log), return a report dict
+
+        seed: seed of the loop if none was logged
+        overrides: optimizer settings replacing the recorded ones, e.g. to test a change
+    '''
+    table = rt.load(os.path.join(folder, 'Results.csv'))
+    log_file = os.path.join(folder, 'Log.log')
+    settings, scans, outcome = read_settings(log_file) if os.path.exists(log_file) else ({}, [], None)
+    if 'target' not in settings:
+        raise ValueError('no target recorded in '+log_file)
+
+    algos = tuple(sorted(set(table['algo'])))
+    if algos not in ALGOS:
+        raise ValueError('cannot replay algorithms '+str(algos))
+    algo = ALGOS[algos]
+    seed = settings.get('seed', seed)
+
+    replay = Replay(table, settings['target'], scans, tolerance)
+    optimizer_settings = {'init_rates': replay.rates[0].tolist() if len(replay) else [5.0, 5.0, 600.0, 5.0]}
+    for name in ('small_step_size', 'learning_rate', 'kappa', 'gp_engine', 'acquisition', 'random_scout'):
+        if name in settings:
+            optimizer_settings[name] = settings[name]
+    if 'no_iter' in settings:
+        optimizer_settings['no_iter_campaign' if algo == 'Campaign' else 'no_iter'] = settings['no_iter']
+    optimizer_settings.update(overrides or {})
+
+    # same random draws as on the rig: scout steps use the global generator, BO its random_state
+    np.random.seed(seed)
+    optimizer = optim.Optimizer(replay.get_one_data, replay.get_one_rgb, replay.target, random_state=seed,
+                                noise=replay.noise, logger=replay, **optimizer_settings)
+    start = time.time()
+    # the loops print their progress, keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        optimizer.run(algo)
+    seconds = time.time() - start
+
+    replayed = next((m for m in reversed(replay.messages) if any(m.startswith(i) for i in OUTCOMES)), None)
+    divergence = replay.divergence
+    if divergence is not None and divergence['reason'] == 'recording ended' and outcome == 'Experiment aborted':
+        divergence = None # the run was stopped from the UI here
+    elif divergence is None and replay.position < len(replay):
+        divergence = {'position': replay.position, 'reason': 'loop ended before the recording',
+                      'requested': None, 'recorded': None}
+    return {'folder': folder, 'algo': algo, 'seed': seed, 'recorded': len(replay), 'replayed': replay.position,
+            'divergence': divergence, 'recorded_outcome': outcome, 'replayed_outcome': replayed,
+            'same_outcome': divergence is None and (outcome is None or same_outcome(outcome, replayed)),
+            'noise_from_scans': replay.scans is not None, 'seconds': seconds}
+
+
+def find_experiments(paths):
+    ''' folders holding a Results.csv under the given paths '''
+    folders = []
+    for path in paths:
+        folders += sorted(root for root, _, files in os.walk(path) if 'Results.csv' in files)
+    return folders
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded experiments through the optimization loops')
+    parser.add_argument('paths', nargs='+', help='experiment folders, or folders searched for them')
+    parser.add_argument('--tolerance', type=float, default=1e-6, help='max rates difference (ul/min) of a match')
+    parser.add_argument('--seed', type=int, default=None, help='seed of runs recorded without one')
+    parser.add_argument('--profile', action='store_true', help='print the functions taking the most time')
+    args = parser.parse_args()
+
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    reports = [replay_experiment(folder, args.tolerance, args.seed) for folder in find_experiments(args.paths)]
+    if profiler is not None:
+        profiler.disable()
+
+    for report in reports:
+        print(report['folder']+': '+report['algo']+', seed '+str(report['seed'])+', replayed '
+              +str(report['replayed'])+'/'+str(report['recorded'])+' measurements in %.3f sec' % report['seconds'])
+        divergence = report['divergence']
+        if divergence is not None:
+            print('    diverged at measurement '+str(divergence['position'])+' ('+divergence['reason']+')')
+            print('    requested: '+str(divergence['requested']))
+            print('    recorded:  '+str(divergence['recorded']))
+        elif not report['same_outcome']:
+            print('    outcome differs: recorded "'+str(report['recorded_outcome'])+'", replayed "'
+                  +str(report['replayed_outcome'])+'"')
+        else:
+            print('    identical decisions, outcome: '+str(report['replayed_outcome']))
+        if not report['noise_from_scans']:
+            print('    scans not found in Log.log, the noise estimate uses the rig precision only')
+    print(str(sum(r['divergence'] is None and r['same_outcome'] for r in reports))+'/'+str(len(reports))
+          +' experiments replayed identically')
+
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+
+
+if __name__ == '__main__':
+    main()
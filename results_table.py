@@ -0,0 +1,134 @@
+''' Typed per-measurement results table of an experiment
+
+    One csv row per measured condition, instead of numbers formatted into
+    Log.log lines. load() reads any number of tables back into typed column
+    arrays, which select() filters and aggregate() groups without regex parsing.
+
+    Columns (SCHEMA): time of the event, algorithm, iteration, scout index (-1
+    for a real step), rates, measured rgb and Lab, cost, and phase timings:
+    wait_sec (pumping until the condition reaches the cell) and total_sec (the
+    whole measurement, including the spectra).
+'''
+
+import csv
+import datetime
+import os
+import numpy as np
+
+import color_convert as cc
+
+SCHEMA = [('timestamp', 'datetime64[us]'), ('algo', object), ('iteration', int), ('scout', int),
+          ('crate', float), ('mrate', float), ('wrate', float), ('yrate', float),
+          ('R', float), ('G', float), ('B', float), ('L', float), ('a', float), ('b', float),
+          ('cost', float), ('wait_sec', float), ('total_sec', float)]
+COLUMNS = [name for name, _ in SCHEMA]
+
+
+class ResultsTable():
+    ''' append-only results csv '''
+
+    def __init__(self, path):
+        self.path = path
+        new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if new_file:
+            self.writer.writerow(COLUMNS)
+            self.file.flush()
+
+    def append(self, algo, iteration, rates, rgb, cost=None, scout=-1, wait_sec=None, total_sec=None,
+               timestamp=None):
+        ''' add one measured condition '''
+        timestamp = timestamp if timestamp is not None else datetime.datetime.now()
+        lab = cc.rgb_to_lab(rgb)
+        blank = lambda value: '' if value is None else value
+        self.writer.writerow([timestamp.isoformat(), algo, iteration, scout, *[float(i) for i in rates],
+                              *[float(i) for i in rgb], *[round(float(i), 4) for i in lab],
+                              blank(cost), blank(wait_sec), blank(total_sec)])
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def parse(value, dtype):
+    if dtype is object:
+        return value
+    if value == '':
+        return -1 if dtype is int else (np.datetime64('NaT') if dtype == 'datetime64[us]' else np.nan)
+    if dtype == 'datetime64[us]':
+        return np.datetime64(datetime.datetime.fromisoformat(value))
+    return dtype(float(value)) if dtype is int else dtype(value)
+
+
+def load(paths):
+    ''' typed columns of one or more results tables, with a 'run' column (folder of each table)
+
+        paths: csv files, or folders searched for Results.csv
+    '''
+    paths = [paths] if isinstance(paths, str) else paths
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += [os.path.join(root, 'Results.csv') for root, _, names in os.walk(path) if 'Results.csv' in names]
+        else:
+            files.append(path)
+
+    columns = {name: [] for name in ['run'] + COLUMNS}
+    for path in sorted(files):
+        run = os.path.basename(os.path.dirname(os.path.abspath(path)))
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                columns['run'].append(run)
+                for name, dtype in SCHEMA:
+                    columns[name].append(parse(row[name], dtype))
+    table = {'run': np.array(columns['run'], dtype=object)}
+    for name, dtype in SCHEMA:
+        table[name] = np.array(columns[name], dtype=dtype)
+    return table
+
+
+def select(table, mask=None, **equals):
+    ''' rows matching a boolean mask and column == value (or value in a list/tuple/set) '''
+    keep = np.ones(len(table['run']), dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+    for name, value in equals.items():
+        if isinstance(value, (list, tuple, set)):
+            keep &= np.isin(table[name], list(value))
+        else:
+            keep &= table[name] == value
+    return {name: column[keep] for name, column in table.items()}
+
+
+def aggregate(table, by, column, func=np.nanmean):
+    ''' func of a column for each value of the by column(s), {key: value} '''
+    by = [by] if isinstance(by, str) else list(by)
+    keys = list(zip(*[table[name] for name in by]))
+    groups = {}
+    for i, key in enumerate(keys):
+        groups.setdefault(key if len(by) > 1 else key[0], []).append(i)
+    return {key: func(table[column][idx]) for key, idx in groups.items()}
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    import tempfile
+
+    root = tempfile.mkdtemp()
+    rng = np.random.default_rng(0)
+    for run in range(3):
+        os.makedirs(os.path.join(root, 'Experiment_'+str(run)))
+        table = ResultsTable(os.path.join(root, 'Experiment_'+str(run), 'Results.csv'))
+        for iteration in range(21):
+            for algo in ['gd', 'bo']:
+                table.append(algo, iteration, rng.uniform(0, 600, 4), rng.uniform(0, 255, 3),
+                             cost=rng.uniform(0, 5000), wait_sec=16.0, total_sec=17.5)
+            for scout in range(1, 5):
+                table.append('gd', iteration, rng.uniform(0, 600, 4), rng.uniform(0, 255, 3), scout=scout,
+                             wait_sec=16.0, total_sec=17.4)
+        table.close()
+
+    results = load(root)
+    print(str(len(results['run']))+' rows, columns: '+str(list(results)))
+    steps = select(results, scout=-1)
+    print('min cost per run and algorithm: '+str(aggregate(steps, ['run', 'algo'], 'cost', np.nanmin)))
+    print('mean measurement time per algorithm: '+str(aggregate(results, 'algo', 'total_sec')))
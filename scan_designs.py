@@ -0,0 +1,140 @@
+''' Scan designs on the composition simplex
+
+    Every design returns flow rates of shape (n, n_pumps) summing to sum_rates,
+    in the pump order of the caller (explore_color_space.py uses [W, M, Y, C]).
+
+    lattice: the nested ratio loops of explore_color_space.py, without duplicate ratios
+    sobol, lhs: space-filling points, uniform on the simplex
+    refine: adaptive points between measured neighbours whose colors differ most
+
+    Designs are seeded, so a resumed scan regenerates the same conditions.
+'''
+
+import itertools
+from functools import reduce
+from math import gcd
+import numpy as np
+
+import color_convert as cc
+
+
+def lattice(explore_ratio=(3, 2, 1, 0), water_ratio=(0,), sum_rates=600, unique=True):
+    ''' ratio lattice [W, M, Y, C] in the order of the nested loops
+
+        unique: keep one condition per ratio (reduced by the gcd), False keeps the repeats
+    '''
+    conditions = []
+    for ratio in itertools.product(water_ratio, explore_ratio, explore_ratio, explore_ratio):
+        if sum(ratio) == 0:
+            continue
+        if unique and reduce(gcd, ratio) != 1:
+            continue
+        conditions.append([sum_rates/sum(ratio)*i for i in ratio])
+    return np.array(conditions, dtype=float)
+
+
+def cube_to_simplex(u):
+    ''' map points uniform in the unit cube (n, d-1) to points uniform on the simplex (n, d)
+
+        inverse cdf stick breaking: the map preserves volume, so the stratification
+        of Sobol and Latin hypercube points carries over to the simplex
+    '''
+    u = np.asarray(u, dtype=float)
+    n, k = u.shape
+    x = np.zeros((n, k + 1))
+    remaining = np.ones(n)
+    for j in range(k):
+        # share of what is left, Beta(1, k-j) by its inverse cdf
+        share = 1 - (1 - u[:, j])**(1/(k - j))
+        x[:, j] = remaining*share
+        remaining = remaining - x[:, j]
+    x[:, k] = remaining
+    return x
+
+
+def space_filling(n, kind='sobol', n_pumps=4, sum_rates=600, fixed=None, seed=0):
+    ''' Sobol or Latin hypercube design on the simplex
+
+        fixed: {pump index: fraction} of pumps held at a fixed fraction of sum_rates,
+               e.g. {0: 0} for the old scan without water
+    '''
+    from scipy.stats import qmc # slow import, only needed for these designs
+    fixed = fixed if fixed is not None else {}
+    free = [i for i in range(n_pumps) if i not in fixed]
+    d = len(free) - 1
+    if kind == 'sobol':
+        sampler = qmc.Sobol(d, scramble=True, seed=seed)
+        # Sobol points are balanced for powers of 2
+        u = sampler.random(2**int(np.ceil(np.log2(max(n, 1)))))[:n]
+    elif kind == 'lhs':
+        u = qmc.LatinHypercube(d, seed=seed).random(n)
+    else:
+        raise ValueError('unknown design: '+str(kind))
+
+    rates = np.zeros((n, n_pumps))
+    rates[:, free] = cube_to_simplex(u)*(1 - sum(fixed.values()))
+    for i, fraction in fixed.items():
+        rates[:, i] = fraction
+    return sum_rates*rates
+
+
+def sobol(n, n_pumps=4, sum_rates=600, fixed=None, seed=0):
+    return space_filling(n, 'sobol', n_pumps, sum_rates, fixed, seed)
+
+
+def lhs(n, n_pumps=4, sum_rates=600, fixed=None, seed=0):
+    return space_filling(n, 'lhs', n_pumps, sum_rates, fixed, seed)
+
+
+def refine(rates, rgb, n, k=6, min_distance=0.02):
+    ''' adaptive refinement: midpoints of the neighbouring conditions whose colors differ most
+
+        rates, rgb: measured conditions and their rgb 0-255
+        n: number of new conditions
+        k: number of nearest neighbours (in composition) of each condition
+        min_distance: skip midpoints closer than this (composition fraction) to a measured condition
+    '''
+    from scipy.spatial import cKDTree
+    rates = np.asarray(rates, dtype=float)
+    sum_rates = rates.sum(axis=1, keepdims=True)
+    fractions = rates/sum_rates
+    lab = cc.rgb_to_lab(rgb)
+
+    tree = cKDTree(fractions)
+    _, neighbours = tree.query(fractions, k=min(k + 1, len(fractions)))
+    pairs = {(min(i, j), max(i, j)) for i, row in enumerate(neighbours) for j in row[1:]}
+    pairs = np.array(sorted(pairs))
+    if len(pairs) == 0:
+        return np.empty((0, rates.shape[1]))
+
+    # color change between neighbours, the largest first
+    change = cc.delta_e(lab[pairs[:, 0]], lab[pairs[:, 1]])
+    order = np.argsort(-change, kind='stable')
+
+    new = []
+    for i, j in pairs[order]:
+        midpoint = (fractions[i] + fractions[j])/2
+        if tree.query(midpoint)[0] < min_distance:
+            continue
+        if any(np.linalg.norm(midpoint - m) < min_distance for m in new):
+            continue
+        new.append(midpoint)
+        if len(new) == n:
+            break
+    return np.array(new).reshape(-1, rates.shape[1])*np.median(sum_rates)
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    print('lattice without water: '+str(len(lattice(unique=False)))+' conditions, '
+          +str(len(lattice()))+' unique ratios')
+    points = sobol(64)
+    print('sobol sums: '+str(np.unique(np.round(points.sum(axis=1), 6))))
+    print('sobol mean fractions: '+str(points.mean(axis=0)/600))
+
+    import plant_simulator as sim
+    model = sim.MixingModel()
+    # the model pump order is [crate, mrate, wrate, yrate]
+    rates = lhs(40, seed=1)
+    new = refine(rates, model.rgb(rates), 10)
+    print('refined: '+str(np.round(new)))
@@ -0,0 +1,101 @@
+''' Changeover-minimizing ordering of scan conditions
+
+    Consecutive conditions far apart in composition need the longest flush.
+    order_conditions() reorders any list of conditions into a short path through
+    composition space: a nearest-neighbour tour improved by 2-opt moves.
+
+    changeover between two conditions = half the L1 distance of their fractions,
+    i.e. the fraction of the flow that changes (0: same ratio, 1: no dye in common)
+'''
+
+import numpy as np
+
+
+def fractions(rates):
+    rates = np.asarray(rates, dtype=float)
+    return rates/rates.sum(axis=-1, keepdims=True)
+
+
+def changeover_matrix(rates):
+    ''' changeover between every pair of conditions, shape (n, n) '''
+    x = fractions(rates)
+    return 0.5*np.abs(x[:, None, :] - x[None, :, :]).sum(axis=-1)
+
+
+def path_length(order, D):
+    ''' total changeover of visiting the conditions in order '''
+    order = np.asarray(order)
+    return float(D[order[:-1], order[1:]].sum())
+
+
+def nearest_neighbour(D, start=0):
+    ''' greedy path from start, always to the closest condition not visited yet '''
+    n = len(D)
+    visited = np.zeros(n, dtype=bool)
+    order = [start]
+    visited[start] = True
+    for _ in range(n - 1):
+        d = np.where(visited, np.inf, D[order[-1]])
+        order.append(int(np.argmin(d)))
+        visited[order[-1]] = True
+    return np.array(order)
+
+
+def two_opt(order, D, max_passes=50):
+    ''' improve an open path (first condition fixed) by reversing segments
+
+        reversing order[i+1..j] replaces the edges (a,b) and (c,d) by (a,c) and (b,d)
+    '''
+    order = np.array(order)
+    n = len(order)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n - 2):
+            a, b = order[i], order[i+1]
+            c = order[i+2:]                           # j = i+2 .. n-1
+            d = np.append(order[i+3:], -1)            # j+1, none past the end of the path
+            has_d = d >= 0
+            delta = D[a, c] - D[a, b]
+            delta -= np.where(has_d, D[c, np.where(has_d, d, 0)], 0)
+            delta += np.where(has_d, D[b, np.where(has_d, d, 0)], 0)
+            k = int(np.argmin(delta))
+            if delta[k] < -1e-12:
+                j = i + 2 + k
+                order[i+1:j+1] = order[i+1:j+1][::-1]
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def order_conditions(rates, start=None, max_passes=50):
+    ''' indices that visit the conditions with the least total changeover
+
+        start: composition in the flow cell before the scan (e.g. the last condition
+               of the previous run), the path begins at the closest condition
+    '''
+    rates = np.asarray(rates, dtype=float)
+    if len(rates) < 3:
+        return np.arange(len(rates))
+    D = changeover_matrix(rates)
+    if start is None:
+        # begin at the most extreme condition, so the path does not have to come back to it
+        first = int(np.argmax(D.sum(axis=1)))
+    else:
+        first = int(np.argmin(0.5*np.abs(fractions(rates) - fractions(start)).sum(axis=1)))
+    order = nearest_neighbour(D, first)
+    return two_opt(order, D, max_passes)
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    import time
+    import scan_designs as designs
+
+    for rates in [designs.lattice(), designs.sobol(256, fixed={0: 0}), designs.lhs(500)]:
+        D = changeover_matrix(rates)
+        start = time.time()
+        order = order_conditions(rates)
+        print('%4d conditions: changeover %.1f in loop order, %.1f ordered (%.2f sec)' % (
+            len(rates), path_length(np.arange(len(rates)), D), path_length(order, D), time.time()-start))
+        assert sorted(order) == list(range(len(rates)))
@@ -0,0 +1,81 @@
+''' Compact lossless encoding of spectra
+
+    Detector counts are integers, so a spectrum is stored as uint16 (uint32 if
+    a count is above 65535), delta encoded along the wavelengths, byte shuffled
+    and zlib compressed. Rows that are not integer counts (e.g. averaged on the
+    device) fall back to compressed float64, so the encoding is always lossless.
+
+    Transmittance and averages are not stored, they are recomputed from the
+    counts and the reference and background spectra of the experiment.
+
+    blob = codec (1 byte) + number of points (uint32) + compressed payload
+'''
+
+import struct
+import zlib
+import numpy as np
+
+DELTA16, DELTA32, FLOAT64 = 0, 1, 2
+HEADER = struct.Struct('<BI')
+
+
+def shuffle(values):
+    # bytes of equal significance next to each other, the high bytes of small deltas are mostly 0
+    return values.view(np.uint8).reshape(-1, values.itemsize).T.tobytes()
+
+
+def unshuffle(payload, dtype, n_points):
+    dtype = np.dtype(dtype)
+    return np.frombuffer(payload, dtype=np.uint8).reshape(dtype.itemsize, n_points).T.copy().view(dtype).ravel()
+
+
+def encode(values, level=6):
+    ''' encode one spectrum as bytes '''
+    values = np.asarray(values).ravel()
+    integral = np.all(np.isfinite(values)) and np.all(values == np.round(values)) and values.min(initial=0) >= 0
+    if integral and values.max(initial=0) <= np.iinfo(np.uint16).max:
+        codec, dtype = DELTA16, np.dtype('<u2')
+    elif integral and values.max(initial=0) <= np.iinfo(np.uint32).max:
+        codec, dtype = DELTA32, np.dtype('<u4')
+    else:
+        codec, dtype = FLOAT64, np.dtype('<f8')
+
+    if codec == FLOAT64:
+        payload = shuffle(values.astype(dtype))
+    else:
+        counts = values.astype(dtype)
+        # differences wrap around modulo 2^16 (2^32), the cumulative sum of decode wraps them back
+        payload = shuffle(np.diff(counts, prepend=dtype.type(0)))
+    return HEADER.pack(codec, len(values)) + zlib.compress(payload, level)
+
+
+def decode(blob):
+    ''' spectrum (float64) of bytes made by encode '''
+    codec, n_points = HEADER.unpack_from(blob)
+    payload = zlib.decompress(blob[HEADER.size:])
+    if codec == FLOAT64:
+        return unshuffle(payload, '<f8', n_points)
+    dtype = np.dtype('<u2' if codec == DELTA16 else '<u4')
+    return np.cumsum(unshuffle(payload, dtype, n_points), dtype=dtype).astype(float)
+
+
+def transmittance(counts, ref_intensities, bg_intensities):
+    ''' transmittance within 0-1, same as RGB_Project_Automation.to_transmittance '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.clip((counts - bg_intensities)/(ref_intensities - bg_intensities), 0, 1)
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    wavelengths = np.linspace(340, 1020, 2048)
+    ref = 12000*np.exp(-0.5*((wavelengths - 600)/150)**2) + 1500
+    counts = np.round(rng.poisson(0.4*ref)).astype(float)
+
+    for name, spectrum, codec in [('counts', counts, DELTA16), ('counts > 65535', counts*20, DELTA32),
+                                  ('averaged', counts/3, FLOAT64)]:
+        blob = encode(spectrum)
+        assert blob[0] == codec
+        assert np.array_equal(decode(blob), spectrum)
+        print('%-15s %6d bytes, float64 npy %6d bytes, %.1fx smaller' % (
+            name, len(blob), spectrum.nbytes + 128, (spectrum.nbytes + 128)/len(blob)))
@@ -0,0 +1,239 @@
+''' Append-only spectral store of one experiment
+
+    Replaces one .npy file per spectrum: every kind of array (spec, trans,
+    avgspec, avgtrans) is one growable binary file of fixed-length float64 rows,
+    and index.csv records one line per saved row. Nothing is overwritten, so
+    scans within the same second are all kept.
+
+    A compact store keeps rows encoded by spectral_codec (raw counts as
+    compressed uint16 deltas), with the (offset, length) of each row in
+    <kind>.off. Only raw spectra need to be saved in it: transmittance and
+    averages are recomputed on read from the reference and background saved
+    once per experiment (see archive_reader.py).
+
+    Directory content:
+        index.csv       kind, row, iteration, condition, crate, mrate, wrate, yrate, timestamp, integ_time,
+                        scans_to_average, boxcar_width, processing (device or host, see acquisition.py)
+        meta.json       number of points and dtype (or codec) of each kind
+        <kind>.bin      rows of that kind, in the order of index.csv
+        <kind>.off      compact store: uint64 offset and length of each row in <kind>.bin
+        reference.npz   compact store: reference and background spectra
+'''
+
+import csv
+import datetime
+import json
+import os
+import numpy as np
+
+import spectral_codec as codec
+
+INDEX_COLUMNS = ['kind', 'row', 'iteration', 'condition', 'crate', 'mrate', 'wrate', 'yrate', 'timestamp',
+                 'integ_time', 'scans_to_average', 'boxcar_width', 'processing']
+
+
+class SpectralStore():
+    ''' append-only store in the directory path (created if needed, reopened to append if it exists)
+
+        dtype: dtype of the stored rows
+        compact: encode new kinds with spectral_codec instead of fixed-length rows
+    '''
+
+    def __init__(self, path, dtype='float64', compact=False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.compact = compact
+        os.makedirs(path, exist_ok=True)
+        self.meta_file = os.path.join(path, 'meta.json')
+        self.index_file = os.path.join(path, 'index.csv')
+
+        self.meta = {}
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file) as f:
+                self.meta = json.load(f)
+        self.files = {} # open binary file of each kind
+        self.offsets = {} # open offsets file of each encoded kind
+        self.ends = {} # end of the last complete row in the binary file of each encoded kind
+        self.rows = {kind: self.recover(kind) for kind in self.meta}
+
+        new_index = not os.path.exists(self.index_file)
+        self.columns = INDEX_COLUMNS
+        if not new_index:
+            # keep appending the columns of an older index
+            with open(self.index_file, newline='') as f:
+                self.columns = next(csv.reader(f), INDEX_COLUMNS)
+        self.index = open(self.index_file, 'a', newline='')
+        self.index_writer = csv.DictWriter(self.index, self.columns, extrasaction='ignore')
+        if new_index:
+            self.index_writer.writeheader()
+            self.index.flush()
+
+    def bin_file(self, kind):
+        return os.path.join(self.path, kind+'.bin')
+
+    def off_file(self, kind):
+        return os.path.join(self.path, kind+'.off')
+
+    def encoded(self, kind):
+        return 'codec' in self.meta[kind]
+
+    def row_bytes(self, kind):
+        return self.meta[kind]['n_points']*np.dtype(self.meta[kind]['dtype']).itemsize
+
+    def recover(self, kind):
+        ''' number of complete rows of a kind, dropping a row cut short by a crash '''
+        path = self.bin_file(kind)
+        if not os.path.exists(path):
+            self.ends[kind] = 0
+            return 0
+        if self.encoded(kind):
+            offsets = read_offsets(self.off_file(kind))
+            size = os.path.getsize(path)
+            rows = len(offsets)
+            while rows and offsets[rows-1].sum() > size:
+                rows -= 1
+            self.ends[kind] = int(offsets[rows-1].sum()) if rows else 0
+            with open(path, 'r+b') as f:
+                f.truncate(self.ends[kind])
+            with open(self.off_file(kind), 'r+b') as f:
+                f.truncate(rows*16)
+            return rows
+        rows, extra = divmod(os.path.getsize(path), self.row_bytes(kind))
+        if extra:
+            with open(path, 'r+b') as f:
+                f.truncate(rows*self.row_bytes(kind))
+        return rows
+
+    def append(self, kind, data, iteration=None, condition=None, rates=None, integ_time=None, timestamp=None,
+               processing=None):
+        ''' append one array of a kind and its index line, return its row number within the kind
+
+            timestamp: time of the measurement (default: now), e.g. when the write is deferred
+            processing: scans to average and boxcar of the spectrum (acquisition.configure_processing)
+        '''
+        data = np.asarray(data, dtype=self.dtype).ravel()
+        if kind not in self.meta:
+            if self.compact:
+                self.meta[kind] = {'n_points': len(data), 'codec': 'spectral_codec'}
+            else:
+                self.meta[kind] = {'n_points': len(data), 'dtype': self.dtype.str}
+            with open(self.meta_file, 'w') as f:
+                json.dump(self.meta, f, indent=1)
+            self.rows[kind] = 0
+            self.ends[kind] = 0
+        if len(data) != self.meta[kind]['n_points']:
+            raise ValueError(kind+' rows have '+str(self.meta[kind]['n_points'])+' points, got '+str(len(data)))
+        if kind not in self.files:
+            self.files[kind] = open(self.bin_file(kind), 'ab')
+
+        # data first, an index line always points to a complete row
+        if self.encoded(kind):
+            blob = codec.encode(data)
+            self.files[kind].write(blob)
+            self.files[kind].flush()
+            if kind not in self.offsets:
+                self.offsets[kind] = open(self.off_file(kind), 'ab')
+            self.offsets[kind].write(np.array([self.ends[kind], len(blob)], dtype='<u8').tobytes())
+            self.offsets[kind].flush()
+            self.ends[kind] += len(blob)
+        else:
+            self.files[kind].write(data.astype(self.meta[kind]['dtype'], copy=False).tobytes())
+            self.files[kind].flush()
+        row = self.rows[kind]
+        self.rows[kind] += 1
+
+        rates = list(rates) if rates is not None else ['']*4
+        timestamp = timestamp if timestamp is not None else datetime.datetime.now()
+        processing = processing or {}
+        values = [kind, row, '' if iteration is None else iteration, '' if condition is None else condition, *rates,
+                  timestamp.isoformat(), '' if integ_time is None else integ_time,
+                  processing.get('scans_to_average', ''), processing.get('boxcar_width', ''),
+                  processing.get('processing', '')]
+        self.index_writer.writerow(dict(zip(INDEX_COLUMNS, values)))
+        self.index.flush()
+        return row
+
+    def set_reference(self, ref_intensities, bg_intensities):
+        ''' save the reference and background spectra the stored spectra are measured against '''
+        np.savez(os.path.join(self.path, 'reference.npz'), ref=np.asarray(ref_intensities, dtype=float),
+                 bg=np.asarray(bg_intensities, dtype=float))
+
+    def sync(self):
+        ''' force everything written so far to disk '''
+        for f in list(self.files.values()) + list(self.offsets.values()) + [self.index]:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def read(self, kind):
+        ''' all rows of a kind, (n_rows, n_points), memory mapped (decoded in memory if encoded) '''
+        for f in self.files.values():
+            f.flush()
+        if self.rows.get(kind, 0) == 0:
+            return np.empty((0, self.meta[kind]['n_points'] if kind in self.meta else 0))
+        if self.encoded(kind):
+            for f in self.offsets.values():
+                f.flush()
+            return read_encoded(self.bin_file(kind), read_offsets(self.off_file(kind))[:self.rows[kind]])
+        return np.memmap(self.bin_file(kind), dtype=self.meta[kind]['dtype'], mode='r',
+                         shape=(self.rows[kind], self.meta[kind]['n_points']))
+
+    def read_index(self):
+        ''' index.csv as a list of dicts '''
+        self.index.flush()
+        with open(self.index_file, newline='') as f:
+            return list(csv.DictReader(f))
+
+    def close(self):
+        self.sync()
+        for f in list(self.files.values()) + list(self.offsets.values()):
+            f.close()
+        self.files = {}
+        self.offsets = {}
+        self.index.close()
+
+
+def read_offsets(path):
+    ''' (offset, length) of each row of an encoded kind '''
+    if not os.path.exists(path):
+        return np.empty((0, 2), dtype='<u8')
+    offsets = np.fromfile(path, dtype='<u8')
+    return offsets[:len(offsets)//2*2].reshape(-1, 2)
+
+
+def read_encoded(path, offsets):
+    ''' decode the rows at offsets of an encoded binary file, (len(offsets), n_points) '''
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    return np.stack([codec.decode(data[start:start+length].tobytes()) for start, length in offsets])
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(), 'Spectra')
+    store = SpectralStore(path)
+    for condition in range(3):
+        for scan in range(3):
+            store.append('spec', np.random.rand(2048), iteration=0, condition=condition,
+                         rates=[5, 5, 600, 5], integ_time=10000)
+        store.append('avgspec', np.random.rand(2048), iteration=0, condition=condition, rates=[5, 5, 600, 5])
+    store.close()
+
+    store = SpectralStore(path) # reopen and keep appending
+    store.append('spec', np.random.rand(2048), iteration=1, condition=3)
+    print('spec: '+str(store.read('spec').shape)+', avgspec: '+str(store.read('avgspec').shape))
+    print('index lines: '+str(len(store.read_index())))
+    print(os.listdir(path))
+    store.close()
+
+    path = os.path.join(tempfile.mkdtemp(), 'Spectra')
+    store = SpectralStore(path, compact=True)
+    counts = np.round(np.random.poisson(4000, (60, 2048))).astype(float)
+    for scan, spectrum in enumerate(counts):
+        store.append('spec', spectrum, iteration=0, condition=scan//3, integ_time=10000)
+    store.set_reference(np.full(2048, 10000.0), np.full(2048, 1500.0))
+    assert np.array_equal(store.read('spec'), counts)
+    store.close()
+    print('compact spec: %d bytes, float64 rows: %d bytes' % (
+        os.path.getsize(os.path.join(path, 'spec.bin')) + os.path.getsize(os.path.join(path, 'spec.off')),
+        counts.nbytes))
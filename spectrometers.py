@@ -0,0 +1,312 @@
+''' Spectrometer backends and a simulated rig
+
+    open_spectrometer(backend) returns an object with the part of the seabreeze
+    Spectrometer interface the project uses (spectrum, intensities, wavelengths,
+    integration_time_micros, ...):
+
+    seabreeze   the first available Ocean Insight device (or the one with a serial number)
+    simulated   SimulatedSpectrometer on the shared SimulatedRig
+
+    The simulated rig pushes the liquid set by its SimulatedPump stand-ins
+    through the tube to the flow cell, whose transmittance follows the
+    Beer-Lambert mixing model of plant_simulator. The spectrometer turns it into
+    raw counts with the lamp spectrum, integration-time scaling, dark counts,
+    shot and read noise and saturation at 65535 counts, and blocks for the
+    integration time as a real device does. Connecting the pumps on the port
+    SIMULATED (UI, engine.py, explore_color_space.py) runs the whole closed loop
+    on any computer.
+'''
+
+import time
+import numpy as np
+
+import plant_simulator as sim
+import acquisition as acq
+
+BACKENDS = ['seabreeze', 'simulated']
+SIMULATED_PORT = 'SIMULATED' # pump port of the simulated rig
+DEFAULT_RIG = None # rig shared by the simulated pumps and spectrometer of this process
+
+
+class SimulatedRig():
+    ''' tube and flow cell fed by the simulated pumps
+
+        model: plant_simulator.MixingModel on the spectrometer wavelengths (default: 2048 pixels, 339-1024 nm)
+        tube_dist, tube_dia: tube from the mixer to the flow cell (mm), as in calc_time_to_travel
+        washout_ul: volume (ul) washing out the previous liquid in the cell (dispersion in the tube)
+        pump_jitter: relative standard deviation of the delivered flow rates
+        lamp_on: False to measure a background
+    '''
+
+    def __init__(self, model=None, tube_dist=200, tube_dia=0.254, washout_ul=2.0, pump_jitter=0.01, seed=None):
+        self.model = model if model is not None else sim.MixingModel(np.linspace(339.0, 1024.0, 2048))
+        self.tube_ul = tube_dist*np.pi*(tube_dia/2)**2 # mm3 = ul
+        self.washout_ul = washout_ul
+        self.pump_jitter = pump_jitter
+        self.rng = np.random.default_rng(seed)
+        self.lamp_on = True
+
+        no_of_pumps = len(self.model.absorbance)
+        self.rates = np.zeros(no_of_pumps) # delivered flow rates (ul/min)
+        self.running = np.zeros(no_of_pumps, dtype=bool)
+        self.volume = 0.0 # ul pumped since start
+        self.last_time = time.time()
+        # (pumped volume when it entered the tube, fractions) of each liquid, the tube starts full of water
+        water = np.zeros(no_of_pumps)
+        water[2] = 1
+        self.segments = [(-np.inf, water), (-np.inf, water)]
+
+    def flow(self):
+        return float(np.sum(self.rates*self.running))
+
+    def advance(self):
+        now = time.time()
+        self.volume += self.flow()*(now - self.last_time)/60
+        self.last_time = now
+
+    def change(self):
+        # the liquid entering the tube from now on
+        self.advance()
+        if self.flow() > 0:
+            self.segments.append((self.volume, self.model.fractions(self.rates*self.running)))
+            self.segments = self.segments[-50:]
+
+    def set_rate(self, address, rate):
+        self.advance()
+        self.rates[address] = max(rate, 0)*(1 + self.pump_jitter*self.rng.standard_normal())
+        self.change()
+
+    def run(self, address, running):
+        self.advance()
+        self.running[address] = running
+        self.change()
+
+    def composition(self):
+        ''' fractions of the pump solutions in the flow cell now '''
+        self.advance()
+        at = self.volume - self.tube_ul # volume when the liquid in the cell entered the tube
+        i = max(j for j, (start, _) in enumerate(self.segments) if start <= at or j == 0)
+        start, fractions = self.segments[i]
+        if i == 0 or np.isinf(start):
+            return fractions
+        residual = np.exp(-(at - start)/self.washout_ul)
+        return residual*self.segments[i-1][1] + (1 - residual)*fractions
+
+    def transmittance(self):
+        return self.model.transmittance(self.composition())
+
+
+class SimulatedPump():
+    ''' stand-in of pump.Pump on a SimulatedRig '''
+
+    def __init__(self, rig, address=0):
+        self.rig = rig
+        self.address = address
+        self.diameter = None
+
+    def set_diameter(self, diameter):
+        self.diameter = diameter
+
+    def set_infuse_rate(self, flowrate, unit='ul/min'):
+        if unit != 'ul/min':
+            raise ValueError('the simulated pumps only take ul/min')
+        self.rig.set_rate(self.address, flowrate)
+
+    def infuse(self):
+        self.rig.run(self.address, True)
+
+    def stop(self):
+        self.rig.run(self.address, False)
+
+
+class SimulatedSpectrumProcessing():
+    ''' spectrum_processing feature (scans to average and boxcar width) of the simulated spectrometer '''
+
+    def __init__(self):
+        self.scans_to_average = 1
+        self.boxcar_width = 0
+
+    def get_scans_to_average(self):
+        return self.scans_to_average
+
+    def set_scans_to_average(self, scans_to_average):
+        if not 1 <= scans_to_average <= 5000:
+            raise ValueError('scans to average must be within 1-5000')
+        self.scans_to_average = int(scans_to_average)
+
+    def get_boxcar_width(self):
+        return self.boxcar_width
+
+    def set_boxcar_width(self, boxcar_width):
+        if not 0 <= boxcar_width <= 15:
+            raise ValueError('boxcar width must be within 0-15')
+        self.boxcar_width = int(boxcar_width)
+
+
+class SimulatedFeatures():
+    ''' spec.f of the simulated spectrometer, None for a feature it does not have '''
+
+    def __init__(self, spectrum_processing=None):
+        self.spectrum_processing = spectrum_processing
+
+
+class SimulatedSpectrometer():
+    ''' seabreeze Spectrometer stand-in measuring the flow cell of a SimulatedRig
+
+        lamp: counts per microsecond of integration of each pixel through water (default: broad halogen-like band)
+        dark_counts: offset of every pixel, dark_rate: dark current (counts per microsecond)
+        read_noise: standard deviation of the readout (counts), gain: counts per photoelectron (shot noise)
+        realtime: block for the integration time as the device does
+        device_processing: have the spectrum_processing feature (scans to average and boxcar on the device)
+    '''
+
+    model = 'SIMULATED'
+    max_intensity = 65535.0
+    integration_time_micros_limits = (1000, 65000000)
+
+    def __init__(self, rig=None, lamp=None, dark_counts=1500.0, dark_rate=0.002, read_noise=8.0, gain=1.0,
+                 realtime=True, serial_number='SIM00001', seed=None, device_processing=False):
+        self.rig = rig if rig is not None else default_rig()
+        wavelengths = self.rig.model.wavelengths
+        if lamp is None:
+            # peak of about 57000 counts at 40 ms, the integration time find_integ_time settles on
+            lamp = 1.4*(0.03 + 0.97*np.exp(-0.5*((wavelengths - 600)/170)**2))
+        self.lamp = np.asarray(lamp, dtype=float)
+        self.dark_counts = dark_counts
+        self.dark_rate = dark_rate
+        self.read_noise = read_noise
+        self.gain = gain
+        self.realtime = realtime
+        self.serial_number = serial_number
+        self.pixels = len(wavelengths)
+        self.rng = np.random.default_rng(seed)
+        self.integ_time = 10000 # microsecond
+        self.f = SimulatedFeatures(SimulatedSpectrumProcessing() if device_processing else None)
+
+    @classmethod
+    def from_first_available(cls):
+        return cls()
+
+    @classmethod
+    def from_serial_number(cls, serial=None):
+        return cls(serial_number=serial or 'SIM00001')
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def wavelengths(self):
+        return self.rig.model.wavelengths.copy()
+
+    def integration_time_micros(self, integration_time_micros):
+        low, high = self.integration_time_micros_limits
+        if not low <= integration_time_micros <= high:
+            raise ValueError('integration time must be within '+str(low)+'-'+str(high)+' microsecond')
+        self.integ_time = int(integration_time_micros)
+
+    def intensities(self, correct_dark_counts=False, correct_nonlinearity=False):
+        ''' counts of one read, averaged and smoothed as set in spectrum_processing
+            (the linear simulated detector needs no nonlinearity correction)
+        '''
+        processing = self.f.spectrum_processing
+        n = processing.scans_to_average if processing is not None else 1
+        if self.realtime:
+            time.sleep(n*self.integ_time/1e6)
+        signal = self.lamp*self.integ_time*self.rig.transmittance() if self.rig.lamp_on else np.zeros(self.pixels)
+        counts = self.rng.poisson(signal/self.gain, (n, self.pixels))*self.gain + self.dark_rate*self.integ_time \
+            + self.read_noise*self.rng.standard_normal((n, self.pixels))
+        if not correct_dark_counts:
+            counts = counts + self.dark_counts
+        counts = np.clip(np.round(counts), 0, self.max_intensity)
+        if processing is None:
+            return counts[0]
+        return acq.boxcar(counts.mean(axis=0), processing.boxcar_width)
+
+    def spectrum(self, correct_dark_counts=False, correct_nonlinearity=False):
+        ''' wavelengths and intensities as one (2, pixels) array '''
+        return np.vstack((self.wavelengths(), self.intensities(correct_dark_counts, correct_nonlinearity)))
+
+
+def default_rig():
+    ''' SimulatedRig shared by the simulated pumps and spectrometer of this process '''
+    global DEFAULT_RIG
+    if DEFAULT_RIG is None:
+        DEFAULT_RIG = SimulatedRig()
+    return DEFAULT_RIG
+
+
+def open_spectrometer(backend='seabreeze', serial_number=None):
+    ''' spectrometer of a backend, the first available one without a serial number '''
+    if backend == 'simulated':
+        return SimulatedSpectrometer(serial_number=serial_number or 'SIM00001')
+    if backend != 'seabreeze':
+        raise ValueError('unknown spectrometer backend: '+str(backend)+', one of '+str(BACKENDS))
+    from seabreeze.spectrometers import Spectrometer
+    if serial_number is not None:
+        return Spectrometer.from_serial_number(serial_number)
+    return Spectrometer.from_first_available()
+
+
+def list_spectrometers(backend='seabreeze'):
+    ''' serial numbers of the connected spectrometers of a backend '''
+    if backend == 'simulated':
+        return []
+    from seabreeze.spectrometers import list_devices
+    return [device.serial_number for device in list_devices()]
+
+
+def backend_for_port(port):
+    ''' spectrometer backend going with the pumps on port '''
+    return 'simulated' if port == SIMULATED_PORT else 'seabreeze'
+
+
+def open_pumps(no_of_pumps=4, rig=None, order=None):
+    ''' simulated pumps [crate, mrate, wrate, yrate] on a rig (default: the shared one)
+
+        order: pump of the rig ([crate, mrate, wrate, yrate] index) in each position of the returned
+               list, for callers with another pump order (e.g. explore_color_space.py [W, M, Y, C])
+    '''
+    rig = rig if rig is not None else default_rig()
+    order = order if order is not None else range(no_of_pumps)
+    return [SimulatedPump(rig, address=i) for i in order]
+
+
+def measure_background(spec):
+    ''' wavelengths and background spectrum, with the lamp of a simulated rig off
+        (on the rig the light path is blocked by hand before the scan)
+    '''
+    rig = getattr(spec, 'rig', None)
+    if rig is None:
+        return spec.spectrum()
+    rig.lamp_on = False
+    try:
+        return spec.spectrum()
+    finally:
+        rig.lamp_on = True
+
+
+# ============= Test =========================
+if __name__ == '__main__':
+    import RGB_Project_Automation as auto
+
+    rig = SimulatedRig(seed=0)
+    spec = SimulatedSpectrometer(rig, seed=0)
+    pumps = open_pumps(rig=rig)
+    spec.integration_time_micros(40000)
+    wavelengths, bg = measure_background(spec)
+    wavelengths, ref = spec.spectrum()
+    print('reference max %d counts, background mean %.0f counts' % (ref.max(), bg.mean()))
+
+    for rates in [[600, 0, 0, 0], [0, 600, 0, 0], [0, 0, 0, 600], [200, 200, 0, 200]]:
+        auto.set_pump_rates(pumps, rates)
+        auto.infuse_all(pumps)
+        time.sleep(2) # 20 ul through the 10 ul tube
+        intensities = np.mean([spec.intensities() for _ in range(3)], axis=0)
+        rgb = auto.transm_to_rgb(wavelengths, auto.to_transmittance(intensities, ref, bg))
+        print(str(rates)+': rgb '+str(rgb)+', noise-free '+str(np.round(rig.model.rgb(rates)).astype(int)))
+    auto.stop_all(pumps)
+
+    spec.integration_time_micros(200000)
+    print('200 ms through water: %d pixels saturated' % np.sum(spec.intensities() >= spec.max_intensity))